@@ -2,20 +2,19 @@ import argparse
 
 import yaml
 
-from experiment_utils import create_name, get_summary_results
+from results_store import ResultsStore, load_summary
 
 parser = argparse.ArgumentParser(description='Run a grid defined in a given ')
 
 parser.add_argument('--config', default="config/experiment_with_predictor_3_4.yml", required=False)
+parser.add_argument('--store', default="results.sqlite", required=False)
 
 args = parser.parse_args()
 
 with open(args.config) as f:
-    config = yaml.load(f)
+    config = yaml.safe_load(f)
 
 
-name = create_name(config)
-
-results_summary = get_summary_results(name)
+results_summary = load_summary(ResultsStore(args.store), config)
 
 print(results_summary)
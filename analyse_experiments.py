@@ -1,13 +1,18 @@
 import argparse
-import matplotlib
-from matplotlib import pyplot as plt
 import yaml
 import numpy as np
 
-from experiment_utils import create_name, get_summary_results_filtered
+from results_store import ResultsStore, import_legacy_results
 
 parser = argparse.ArgumentParser(description='Run a grid defined in a given ')
 
+parser.add_argument('--store', default="results.sqlite", required=False)
+parser.add_argument('--no_plot', action='store_true', help='Only print the summaries, without importing matplotlib')
+
+args = parser.parse_args()
+
+store = ResultsStore(args.store)
+
 configs = [
     "config/experiment_with_predictor_3_4_high_weight.yml",
     "config/experiment_with_predictor_3_4.yml",
@@ -34,17 +39,22 @@ groupnames = []
 means = []
 stds = []
 
+loaded_configs = []
 for config_name in configs:
-
     with open(config_name) as f:
-        config = yaml.load(f)
+        loaded_configs.append(yaml.safe_load(f))
+    ### Makes sure that the old yaml results are in the store
+    import_legacy_results(store, loaded_configs[-1])
+
+### All the summaries come out of the store in one query
+summaries = store.summaries(loaded_configs, filter_metric="val_accuracy_epoch")
+
+for config_name, results_summary in zip(configs, summaries):
 
     print(config_name)
 
-    name = create_name(config)
     #keep_out = set(["val accuracy predictor_epoch","msg_len","distinct symbols","bigram entropy","symbol entropy"])
     keep_out = set(["val accuracy predictor_epoch","msg_len","distinct symbols","bigram entropy","symbol entropy"])
-    results_summary = get_summary_results_filtered(name)
     for key, value in results_summary.items():
         print(key + ":   " + str(value))
         print("HOI")
@@ -61,6 +71,12 @@ for config_name in configs:
     print("")
 
 
+if args.no_plot:
+    raise SystemExit
+
+### matplotlib is slow to import, it is only needed for the plot
+from matplotlib import pyplot as plt
+
 #groupnames=["Bigram Entropy", "Distinct Symbols", "MSG Length", "Symbol Entropy", "Validation ACC"]
 groupnames = ["accuracy on held out set"]
 
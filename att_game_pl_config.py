@@ -3,6 +3,7 @@ import pytorch_lightning as pl
 
 from attribute_game.pl_model import AttributeBaseLineModel
 from attribute_game.utils import get_sender, get_receiver
+from callbacks.async_logger import get_logger
 from callbacks.msg_callback import MsgCallback, MsgFrequencyCallback, EntropyMeasure, MeasureCallbacks, \
     ResetDatasetCallback, DistinctSymbolMeasure
 
@@ -49,6 +50,7 @@ def run(n_attributes, attributes_size, n_receiver, n_symbols, msg_len,
     reset_trainer = ResetDatasetCallback(train_dataloader.dataset)
 
     trainer = pl.Trainer(default_root_dir='logs',
+                        logger=get_logger('logs'),
                         checkpoint_callback=False,
                         # checkpoint_callback=ModelCheckpoint(save_weights_only=True, mode="min", monitor="val_loss"),
                         gpus=1 if torch.cuda.is_available() else 0,
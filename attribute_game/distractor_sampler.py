@@ -0,0 +1,109 @@
+import torch
+from torch import nn
+
+from datasets.AttributeDataset import get_held_out_classes, place_values
+
+
+class ConfusionSampler(nn.Module):
+    def __init__(self, n_attributes, size_attributes, n_receiver, n_remove_classes=0, uniform_mixture=0.5,
+                 decay=0.99, class_ids=False, max_classes=2 ** 12):
+        '''
+        Draws the distractors of the training episodes on the device, so that classes the receiver confuses with the
+        target are chosen more often. A running [n_classes, n_classes] matrix counts how often the receiver chose
+        class j when the target was class i, and decays every step so it follows the current receiver.
+        The distractors of target i are drawn from a mixture of row i of the matrix and the uniform distribution over
+        the other classes of the train set, with one multinomial for the whole batch.
+        :param n_remove_classes: the held out classes are never drawn, see get_held_out_classes
+        :param uniform_mixture: weight of the uniform distribution, keeps every class in the episodes
+        :param decay: factor with which the counts are multiplied every step
+        :param class_ids: the items are class ids instead of one hot attributes
+        :param max_classes: the matrix enumerates the classes, so it is only kept for small attribute spaces
+        '''
+        super(ConfusionSampler, self).__init__()
+        self.n_attributes = n_attributes
+        self.size_attributes = size_attributes
+        self.n_receiver = n_receiver
+        self.n_classes = size_attributes ** n_attributes
+        self.uniform_mixture = uniform_mixture
+        self.decay = decay
+        self.class_ids = class_ids
+        if self.n_classes > max_classes:
+            raise ValueError("The confusion matrix of {} classes would be too large, the limit is {}".format(
+                self.n_classes, max_classes))
+        if not 0 < uniform_mixture <= 1:
+            raise ValueError("uniform_mixture should be in (0, 1], got {}".format(uniform_mixture))
+
+        keep = torch.ones(self.n_classes, dtype=torch.bool)
+        keep[torch.from_numpy(get_held_out_classes(n_attributes, size_attributes, n_remove_classes))] = False
+        self.register_buffer('keep', keep)
+        self.register_buffer('confusion', torch.zeros(self.n_classes, self.n_classes))
+        self.register_buffer('place_values', torch.from_numpy(place_values(n_attributes, size_attributes)))
+        self.register_buffer('offsets', torch.arange(n_attributes, dtype=torch.long) * size_attributes)
+
+    def to_classes(self, items):
+        '''
+        The class ids of a batch of items
+        '''
+        if self.class_ids:
+            return items
+        values = items.view(len(items), self.n_attributes, self.size_attributes).argmax(dim=-1)
+        return (values * self.place_values).sum(dim=-1)
+
+    def to_items(self, ids):
+        '''
+        The items of a batch of class ids, see AttributeGameDataset.to_item
+        '''
+        if self.class_ids:
+            return ids
+        columns = (ids.unsqueeze(dim=-1) // self.place_values) % self.size_attributes + self.offsets
+        one_hot = torch.zeros(len(ids), self.n_attributes * self.size_attributes, device=ids.device)
+        return one_hot.scatter_(1, columns, 1)
+
+    def distractor_probabilities(self, targets):
+        '''
+        [batch, n_classes] distribution of the distractors of every target
+        '''
+        rows = torch.arange(len(targets), device=targets.device)
+        allowed = self.keep.float().expand(len(targets), -1).clone()
+        allowed[rows, targets] = 0
+        uniform = allowed / allowed.sum(dim=1, keepdim=True)
+
+        confusion = self.confusion[targets] * allowed
+        total = confusion.sum(dim=1, keepdim=True)
+        ### Targets that were never confused yet only get uniform distractors
+        confused = torch.where(total > 0, confusion / total.clamp(min=1e-12), uniform)
+        return self.uniform_mixture * uniform + (1 - self.uniform_mixture) * confused
+
+    @torch.no_grad()
+    def sample(self, sender_img):
+        '''
+        New candidates for the targets of a batch, the target at a random position
+        :return: the list of n_receiver candidate items, the index of the target and the [batch, n_receiver] class ids
+        of the candidates, which update needs
+        '''
+        targets = self.to_classes(sender_img)
+        rows = torch.arange(len(targets), device=targets.device)
+        distractors = torch.multinomial(self.distractor_probabilities(targets), self.n_receiver - 1)
+
+        target_index = torch.randint(self.n_receiver, (len(targets),), device=targets.device)
+        candidates = torch.cat([distractors, targets.unsqueeze(dim=-1)], dim=1)
+        ### Swap the target from the last position to its own
+        candidates[rows, -1] = candidates[rows, target_index]
+        candidates[rows, target_index] = targets
+
+        return [self.to_items(candidates[:, i]) for i in range(self.n_receiver)], target_index, candidates
+
+    @torch.no_grad()
+    def update(self, candidates, target, predicted):
+        '''
+        Counts the classes the receiver chose instead of the targets, without waiting for the device
+        :param candidates: the class ids of the candidates, from sample
+        :param target: [batch] index of the target
+        :param predicted: [batch] index of the candidate the receiver chose
+        '''
+        rows = torch.arange(len(target), device=target.device)
+        true_classes = candidates[rows, target]
+        chosen_classes = candidates[rows, predicted]
+        self.confusion.mul_(self.decay)
+        self.confusion.index_put_((true_classes, chosen_classes), (chosen_classes != true_classes).float(),
+                                  accumulate=True)
@@ -41,6 +41,45 @@ class FeatureEncoder(nn.Module):
 
 
 
+class ClassEmbeddingEncoder(nn.Module):
+
+    def __init__(self, feature_encoder, max_table_size=2 ** 16):
+        '''
+        A frozen copy of a pretrained FeatureEncoder that takes class ids instead of one hot attributes.
+        The encoder is linear in the one hot attributes, so the embedding of a class is the bias plus one column of the
+        weight per attribute. When there are at most max_table_size classes, all embeddings are computed once into
+        a [n_classes, hidden] table and encoding is a single gather.
+        '''
+        super(ClassEmbeddingEncoder, self).__init__()
+        self.n_attributes = feature_encoder.n_attributes
+        self.size_attributes = feature_encoder.size_attributes
+        self.n_classes = feature_encoder.n_classes
+        self.hidden_state_size = feature_encoder.hidden_state_size
+
+        linear = feature_encoder.to_hidden[0]
+        self.register_buffer('columns', linear.weight.detach().t().clone())
+        self.register_buffer('bias', linear.bias.detach().clone())
+        self.register_buffer('place_values',
+                             self.size_attributes ** torch.arange(self.n_attributes - 1, -1, -1, dtype=torch.long))
+        self.register_buffer('offsets', torch.arange(self.n_attributes, dtype=torch.long) * self.size_attributes)
+
+        if self.n_classes <= max_table_size:
+            self.register_buffer('table', self.embed(torch.arange(self.n_classes, device=self.bias.device)))
+        else:
+            self.register_buffer('table', None)
+
+    def embed(self, ids):
+        ### The columns of the one hot attributes of every class, see datasets.AttributeDataset.decode_classes
+        columns = (ids.unsqueeze(dim=-1) // self.place_values) % self.size_attributes + self.offsets
+        hidden = torch.nn.functional.embedding_bag(columns.reshape(-1, self.n_attributes), self.columns, mode='sum')
+        return hidden.reshape(*ids.shape, self.hidden_state_size) + self.bias
+
+    def forward(self, ids):
+        if self.table is not None:
+            return torch.nn.functional.embedding(ids, self.table)
+        return self.embed(ids)
+
+
 class PredictionRNN(nn.Module):
     def __init__(self, n_words, hidden_size):
         '''
@@ -58,6 +97,14 @@ class PredictionRNN(nn.Module):
         self.n_words = n_words
 
     def forward(self, input):
+        predictions_logits, out_probs, out = self.forward_states(input)
+
+        return predictions_logits, out_probs, out[-1]
+
+    def forward_states(self, input):
+        '''
+        Like forward, but returns the hidden states of all positions instead of only the last one
+        '''
         batch_size = input.shape[1]
         input = input.view(-1, self.n_words)
         embedded = self.embedding(input)
@@ -71,12 +118,59 @@ class PredictionRNN(nn.Module):
 
         out_probs = torch.softmax(predictions_logits, dim=-1)
 
-        return predictions_logits, out_probs, hidden.squeeze(dim=0)
+        return predictions_logits, out_probs, out
 
     def initHidden(self):
         return torch.zeros(1, 1, self.hidden_size)
 
 
+class PredictionTransformer(nn.Module):
+    def __init__(self, n_words, hidden_size, max_len, n_heads=4, n_layers=2):
+        '''
+        A transformer encoder that predicts the next symbol in the language. All positions are processed in parallel,
+        a causal mask makes sure that every position only sees the symbols before it.
+        :param n_words: number of symbols
+        :param max_len: the longest input, the message length plus the start symbol
+        '''
+        super(PredictionTransformer, self).__init__()
+        self.hidden_size = hidden_size
+
+        self.embedding = nn.Linear(n_words, hidden_size)
+        self.position_embedding = nn.Embedding(max_len, hidden_size)
+        self.encoder = nn.TransformerEncoder(
+            nn.TransformerEncoderLayer(hidden_size, n_heads, dim_feedforward=hidden_size * 2, dropout=0.0),
+            n_layers)
+
+        self.predictions = nn.Linear(hidden_size, n_words)
+        self.n_words = n_words
+
+    def forward(self, input):
+        '''
+        :param input: [len, batch, n_words] one hot symbols, starting with the start symbol
+        :return: the logits and probabilities of the next symbol at every position and the last hidden state,
+        like PredictionRNN
+        '''
+        predictions_logits, out_probs, out = self.forward_states(input)
+
+        return predictions_logits, out_probs, out[-1]
+
+    def forward_states(self, input):
+        '''
+        Like forward, but returns the hidden states of all positions instead of only the last one
+        '''
+        length = input.shape[0]
+        embedded = self.embedding(input) + self.position_embedding.weight[:length].unsqueeze(dim=1)
+
+        causal_mask = torch.triu(torch.full((length, length), float('-inf'), device=input.device), diagonal=1)
+        out = self.encoder(embedded, mask=causal_mask)
+
+        predictions_logits = self.predictions(out)
+
+        out_probs = torch.softmax(predictions_logits, dim=-1)
+
+        return predictions_logits, out_probs, out
+
+
 class OnePlayer(nn.Module):
     def __init__(self, feature_encoder, n_xs, ):
         '''
@@ -3,44 +3,77 @@ import torch
 import numpy as np
 from torch.nn.utils.rnn import pack_padded_sequence
 
+from attribute_game.population import AgentMetrics
 from attribute_game.utils import pack
+from callbacks.profiler_callback import profile_phase
+from decoding import use_decode_mode
+from message import Message
+
+
+def unpack_batch(batch, device, in_batch_negatives=False):
+    '''
+    Returns the sender input, the receiver candidates and the target of a batch.
+    With in batch negatives the candidates of every message are all the sender inputs of the batch,
+    so the target of the i-th message is i.
+    '''
+    sender_img = batch[0].to(device)
+    if in_batch_negatives:
+        return sender_img, sender_img, torch.arange(len(sender_img), device=device)
+
+    return sender_img, batch[1], batch[2].to(device)
 
 
 class AttributeBaseLineModel(pl.LightningModule):
     def __init__(self, sender, receiver, loss_module,
-                 hparams=None, pack_message=False):
+                 hparams=None, pack_message=False, in_batch_negatives=False, eval_decode_mode='argmax',
+                 distractor_sampler=None):
+        '''
+        :param distractor_sampler: draws the distractors of the training episodes instead of the dataset, see
+        attribute_game.distractor_sampler.ConfusionSampler
+        '''
         super().__init__()
         self.sender = sender
         self.receiver = receiver
+        self.distractor_sampler = distractor_sampler
 
         self.loss_module = loss_module
         self.pack_message = pack_message
+        self.in_batch_negatives = in_batch_negatives
+        ### The decode mode of the sender during validation and the measures
+        self.eval_decode_mode = eval_decode_mode
         self.msg_len = sender.msg_len
         self.hparams = hparams
 
     def forward(self, sender_img, receiver_choices):
-        msg = self.sender(sender_img)
+        with profile_phase('sender'):
+            msg = Message(self.sender(sender_img))
         if self.pack_message:
-            msg_packed = pack(msg, self.msg_len)
-            out, out_probs = self.receiver(receiver_choices, msg_packed)
+            with profile_phase('pack'):
+                msg_packed = pack(msg, self.msg_len)
+            with profile_phase('receiver'):
+                out, out_probs = self.receiver(receiver_choices, msg_packed)
         else:
             msg_packed = None
-            out, out_probs = self.receiver(receiver_choices, msg)
+            with profile_phase('receiver'):
+                out, out_probs = self.receiver(receiver_choices, msg)
 
         return msg, msg_packed, out, out_probs, None, None
 
     def training_step(self, batch, batch_idx):
         batch_size = len(batch[0])
 
-        sender_img = batch[0].to(self.device)
-        receiver_imgs = batch[1]
-        target = batch[2].to(self.device)
+        sender_img, receiver_imgs, target = unpack_batch(batch, self.device, self.in_batch_negatives)
+        if self.distractor_sampler is not None:
+            receiver_imgs, target, candidates = self.distractor_sampler.sample(sender_img)
 
         msg, msg_packed, out, out_probs, _, _ = self.forward(sender_img, receiver_imgs)
 
-        loss = self.loss_module(out_probs, target)
+        with profile_phase('loss'):
+            loss = self.loss_module(out_probs, target)
 
         predicted_indices = torch.argmax(out_probs, dim=-1)
+        if self.distractor_sampler is not None:
+            self.distractor_sampler.update(candidates, target, predicted_indices)
 
         correct = (predicted_indices == target).sum().item() / batch_size
 
@@ -58,13 +91,12 @@ class AttributeBaseLineModel(pl.LightningModule):
 
         batch_size = len(batch[0])
 
-        sender_img = batch[0].to(self.device)
-        receiver_imgs = batch[1]
-        target = batch[2].to(self.device)
+        sender_img, receiver_imgs, target = unpack_batch(batch, self.device, self.in_batch_negatives)
 
 
 
-        msg, msg_packed, out, out_probs, _, _ = self.forward(sender_img, receiver_imgs)
+        with use_decode_mode(self.sender, self.eval_decode_mode):
+            msg, msg_packed, out, out_probs, _, _ = self.forward(sender_img, receiver_imgs)
 
         loss = self.loss_module(out_probs, target)
 
@@ -90,55 +122,69 @@ class AttributeBaseLineModel(pl.LightningModule):
 
 class AttributeModelWithPrediction(pl.LightningModule):
     def __init__(self, sender, receiver, loss_module, predictor, predictor_loss_module,
-                 hparams=None, pack_message=True):
+                 hparams=None, pack_message=True, in_batch_negatives=False, eval_decode_mode='argmax',
+                 distractor_sampler=None):
+        '''
+        :param distractor_sampler: draws the distractors of the training episodes instead of the dataset, see
+        attribute_game.distractor_sampler.ConfusionSampler
+        '''
         super().__init__()
         self.sender = sender
         self.receiver = receiver
         self.predictor = predictor
+        self.distractor_sampler = distractor_sampler
         self.loss_module_predictor = predictor_loss_module
 
         self.loss_module = loss_module
         self.pack_message = pack_message
+        self.in_batch_negatives = in_batch_negatives
+        ### The decode mode of the sender during validation and the measures
+        self.eval_decode_mode = eval_decode_mode
         self.hparams = hparams
 
     def forward(self, sender_img, receiver_choices):
-        msg = self.sender(sender_img)
+        with profile_phase('sender'):
+            msg = Message(self.sender(sender_img))
 
-        start_symbols = torch.zeros(1, len(sender_img), self.sender.n_symbols).to(self.device)
+        with profile_phase('predictor'):
+            start_symbols = torch.zeros(1, len(sender_img), self.sender.n_symbols).to(self.device)
 
-        msgs = torch.cat([start_symbols, msg], dim=0)
+            msgs = torch.cat([start_symbols, msg.one_hot], dim=0)
 
-        prediction_logits, prediction_probs, hidden = self.predictor(msgs)
+            prediction_logits, prediction_probs, hidden = self.predictor(msgs)
 
-        prediction_logits = prediction_logits[:-1, :, :]
-        prediction_probs = prediction_probs[:-1, :, :]
+            prediction_logits = prediction_logits[:-1, :, :]
+            prediction_probs = prediction_probs[:-1, :, :]
 
         packed_msg = None
         if self.pack_message:
-            packed_msg = pack(msg, self.sender.msg_len)
-            out, out_probs = self.receiver(receiver_choices, packed_msg)
+            with profile_phase('pack'):
+                packed_msg = pack(msg, self.sender.msg_len)
+            with profile_phase('receiver'):
+                out, out_probs = self.receiver(receiver_choices, packed_msg)
         else:
-            out, out_probs = self.receiver(receiver_choices, msg)
+            with profile_phase('receiver'):
+                out, out_probs = self.receiver(receiver_choices, msg)
 
         return msg, packed_msg, out, out_probs, prediction_logits, prediction_probs
 
     def training_step(self, batch, batch_idx):
         batch_size = len(batch[0])
 
-        sender_img = batch[0].to(self.device)
-        receiver_imgs = batch[1]
-        target = batch[2].to(self.device)
+        sender_img, receiver_imgs, target = unpack_batch(batch, self.device, self.in_batch_negatives)
+        if self.distractor_sampler is not None:
+            receiver_imgs, target, candidates = self.distractor_sampler.sample(sender_img)
 
         msg, packed_msg, out, out_probs, prediction_logits, prediction_probs = self.forward(sender_img, receiver_imgs)
 
         ### Get loss of the predictor
         prediction_squeezed = prediction_logits.reshape(-1, self.sender.n_symbols)
         prediction_probs = prediction_probs.reshape(-1, self.sender.n_symbols)
-        msg_target = msg.reshape(-1, self.sender.n_symbols)
+        indices = msg.indices.reshape(-1)
 
-        loss_predictor = self.loss_module_predictor(prediction_squeezed, msg_target,
-                                                    ignore_index=self.sender.n_symbols - 1)
-        indices = torch.argmax(msg_target, dim=-1)
+        with profile_phase('loss'):
+            loss_predictor = self.loss_module_predictor(prediction_squeezed, indices,
+                                                        ignore_index=self.sender.n_symbols - 1)
         accuracyPredictions = torch.argmax(prediction_probs, dim=-1)
 
         correct = (accuracyPredictions == indices).sum().item()
@@ -146,10 +192,13 @@ class AttributeModelWithPrediction(pl.LightningModule):
         ### Log the accuracy
         self.log("accuracy predictor", predictor_accuracy, on_step=True, on_epoch=True)
 
-        loss_receiver = self.loss_module(out_probs, target)
-        loss = loss_receiver + self.hparams["predictor_loss_weight"] * loss_predictor
+        with profile_phase('loss'):
+            loss_receiver = self.loss_module(out_probs, target)
+            loss = loss_receiver + self.hparams["predictor_loss_weight"] * loss_predictor
 
         predicted_indices = torch.argmax(out_probs, dim=-1)
+        if self.distractor_sampler is not None:
+            self.distractor_sampler.update(candidates, target, predicted_indices)
 
         correct = (predicted_indices == target).sum().item() / batch_size
 
@@ -171,23 +220,21 @@ class AttributeModelWithPrediction(pl.LightningModule):
 
         batch_size = len(batch[0])
 
-        sender_img = batch[0].to(self.device)
-        receiver_imgs = batch[1]
-        target = batch[2].to(self.device)
+        sender_img, receiver_imgs, target = unpack_batch(batch, self.device, self.in_batch_negatives)
 
 
 
 
-        msg, msg_packed, out, out_probs, prediction_logits, prediction_probs = self.forward(sender_img, receiver_imgs)
+        with use_decode_mode(self.sender, self.eval_decode_mode):
+            msg, msg_packed, out, out_probs, prediction_logits, prediction_probs = self.forward(sender_img, receiver_imgs)
 
         ### Get loss of the predictor
         prediction_squeezed = prediction_logits.reshape(-1, self.sender.n_symbols)
         prediction_probs = prediction_probs.reshape(-1, self.sender.n_symbols)
-        msg_target = msg.reshape(-1, self.sender.n_symbols)
+        indices = msg.indices.reshape(-1)
 
-        loss_predictor = self.loss_module_predictor(prediction_squeezed, msg_target,
+        loss_predictor = self.loss_module_predictor(prediction_squeezed, indices,
                                                     ignore_index=self.sender.n_symbols - 1)
-        indices = torch.argmax(msg_target, dim=-1)
         accuracyPredictions = torch.argmax(prediction_probs, dim=-1)
 
         correct = (accuracyPredictions == indices).sum().item()
@@ -223,80 +270,157 @@ class AttributeModelWithPrediction(pl.LightningModule):
         return optimizer
 
 
-class AttributeModelMerged(pl.LightningModule):
-    def __init__(self, sender, receiver, loss_module, predictor, predictor_loss_module,
-                 hparams=None):
+class AttributeModelMerged(AttributeModelWithPrediction):
+    '''
+    The game with prediction in which the predictor and the receiver share the recurrent pass over the message.
+    The hidden states of the predictor predict the next symbols and the state after the last symbol of every message
+    is the message encoding of the receiver (a ReceiverPredictor).
+    The training and validation steps are those of AttributeModelWithPrediction.
+    '''
+
+    def forward(self, sender_img, receiver_choices):
+        with profile_phase('sender'):
+            msg = Message(self.sender(sender_img))
+
+        with profile_phase('predictor'):
+            start_symbols = torch.zeros(1, len(sender_img), self.sender.n_symbols).to(self.device)
+
+            msgs = torch.cat([start_symbols, msg.one_hot], dim=0)
+            prediction_logits, prediction_probs, hidden_states = self.predictor.forward_states(msgs)
+
+            prediction_logits = prediction_logits[:-1, :, :]
+            prediction_probs = prediction_probs[:-1, :, :]
+
+        with profile_phase('pack'):
+            ### Position 0 is the start symbol, so the state after the last symbol is at the length of the message
+            if self.pack_message:
+                lengths = msg.lengths.to(self.device)
+            else:
+                lengths = torch.full((len(sender_img),), self.sender.msg_len, dtype=torch.long, device=self.device)
+            last_hidden = hidden_states[lengths, torch.arange(len(sender_img), device=self.device)]
+
+        with profile_phase('receiver'):
+            out, out_probs = self.receiver(receiver_choices, last_hidden)
+
+        return msg, None, out, out_probs, prediction_logits, prediction_probs
+
+
+class PopulationModel(pl.LightningModule):
+    '''
+    The game with a population of senders and receivers, every episode is played by a random (sender, receiver) pair.
+    The agents are a SenderPool and a ReceiverPool, so a batch with pairs of many different agents is still computed
+    in one pass, and a single optimizer trains the stacked weights of all agents. The accuracy of every agent is
+    counted on the device and logged at the end of the epoch.
+    '''
+
+    def __init__(self, sender, receiver, loss_module, hparams=None, eval_decode_mode='argmax', distractor_sampler=None):
+        '''
+        :param distractor_sampler: draws the distractors of the training episodes instead of the dataset, see
+        attribute_game.distractor_sampler.ConfusionSampler
+        '''
         super().__init__()
         self.sender = sender
         self.receiver = receiver
-        self.predictor = predictor
-        self.loss_module_predictor = predictor_loss_module
+        self.distractor_sampler = distractor_sampler
+        self.population_size = sender.population_size
 
         self.loss_module = loss_module
-
+        ### The pools read the messages themselves, the population is not played with in batch negatives
+        self.pack_message = False
+        self.in_batch_negatives = False
+        ### The decode mode of the sender during validation and the measures
+        self.eval_decode_mode = eval_decode_mode
+        self.msg_len = sender.msg_len
         self.hparams = hparams
 
-    def forward(self, sender_img, receiver_choices):
-        msg = self.sender(sender_img)
+        self.train_metrics = AgentMetrics(self.population_size)
+        self.val_metrics = AgentMetrics(self.population_size)
+
+    def sample_pairs(self, batch_size):
+        '''
+        A random sender and a random receiver for every episode of a batch
+        '''
+        senders = torch.randint(self.population_size, (batch_size,), device=self.device)
+        receivers = torch.randint(self.population_size, (batch_size,), device=self.device)
+        return senders, receivers
+
+    def forward(self, sender_img, receiver_choices, senders=None, receivers=None):
+        '''
+        :param senders: [batch] index of the sender of every episode, without the pairs episode i is played by sender
+        and receiver i % population_size, as the callbacks do
+        :param receivers: [batch] index of the receiver of every episode
+        '''
+        with profile_phase('sender'):
+            msg = Message(self.sender(sender_img, senders))
+        with profile_phase('receiver'):
+            out, out_probs = self.receiver(receiver_choices, msg, receivers)
+
+        return msg, None, out, out_probs, None, None
 
-        start_symbols = torch.zeros(1, len(sender_img), self.sender.n_symbols).to(self.device)
+    def training_step(self, batch, batch_idx):
+        sender_img, receiver_imgs, target = unpack_batch(batch, self.device)
+        if self.distractor_sampler is not None:
+            receiver_imgs, target, candidates = self.distractor_sampler.sample(sender_img)
+        senders, receivers = self.sample_pairs(len(target))
 
-        packed_msg = pack(msg, self.sender.msg_len)
+        msg, msg_packed, out, out_probs, _, _ = self.forward(sender_img, receiver_imgs, senders, receivers)
 
-        msgs = torch.cat([start_symbols, msg], dim=0)
-        msg_in = msgs
-        prediction_logits, prediction_probs, hidden = self.predictor(msg_in)
+        with profile_phase('loss'):
+            loss = self.loss_module(out_probs, target)
 
-        prediction_logits = prediction_logits[:-1, :, :]
-        prediction_probs = prediction_probs[:-1, :, :]
+        predicted_indices = torch.argmax(out_probs, dim=-1)
+        if self.distractor_sampler is not None:
+            self.distractor_sampler.update(candidates, target, predicted_indices)
 
-        last_hidden = hidden
-        out, out_probs = self.receiver(receiver_choices, last_hidden)
+        correct = predicted_indices == target
+        self.train_metrics.update(senders, receivers, correct)
 
-        return msg, packed_msg, out, out_probs, prediction_logits, prediction_probs
+        self.log("loss_receiver", loss, on_step=True, on_epoch=True)
+        self.log("total_loss", loss, on_step=True, on_epoch=True)
+        self.log("accuracy", correct.float().mean(), on_step=True, on_epoch=True)
 
-    def training_step(self, batch, batch_idx):
-        batch_size = len(batch[0])
+        return loss
 
-        sender_img = batch[0].to(self.device)
-        receiver_imgs = batch[1]
-        target = batch[2].to(self.device)
+    @torch.no_grad()
+    def validation_step(self, batch, batch_idx):
+        self.sender.eval()
+        self.receiver.eval()
 
-        msg, out, out_probs, prediction_logits, prediction_probs = self.forward(sender_img, receiver_imgs)
+        sender_img, receiver_imgs, target = unpack_batch(batch, self.device)
+        senders, receivers = self.sample_pairs(len(target))
 
-        ### Get loss of the predictor
-        prediction_squeezed = prediction_logits.reshape(-1, self.sender.n_symbols)
-        prediction_probs = prediction_probs.reshape(-1, self.sender.n_symbols)
-        msg_target = msg.reshape(-1, self.sender.n_symbols)
+        with use_decode_mode(self.sender, self.eval_decode_mode):
+            msg, msg_packed, out, out_probs, _, _ = self.forward(sender_img, receiver_imgs, senders, receivers)
 
-        loss_predictor = self.loss_module_predictor(prediction_squeezed, msg_target)
-        indices = torch.argmax(msg_target, dim=-1)
-        accuracyPredictions = torch.argmax(prediction_probs, dim=-1)
+        loss = self.loss_module(out_probs, target)
 
-        correct = (accuracyPredictions == indices).sum().item()
-        predictor_accuracy = correct / len(indices)
-        ### Log the accuracy
-        self.log("accuracy predictor", predictor_accuracy, on_step=True, on_epoch=True)
+        correct = torch.argmax(out_probs, dim=-1) == target
+        self.val_metrics.update(senders, receivers, correct)
 
-        loss_receiver = self.loss_module(out_probs, target)
-        loss = loss_receiver + self.hparams["predictor_loss_weight"] * loss_predictor
+        self.log("val_loss_receiver", loss, on_step=True, on_epoch=True)
+        self.log("val_total_loss", loss, on_step=True, on_epoch=True)
+        self.log("val_accuracy", correct.float().mean(), on_step=True, on_epoch=True)
 
-        predicted_indices = torch.argmax(out_probs, dim=-1)
+        self.sender.train()  # make sure to set it back to training
+        self.receiver.train()
 
-        correct = (predicted_indices == target).sum().item() / batch_size
+    def on_train_epoch_start(self):
+        self.train_metrics.reset(self.device)
 
-        self.log("loss_predictor", loss_predictor, on_step=True, on_epoch=True)
-        self.log("loss_receiver", loss_receiver, on_step=True, on_epoch=True)
-        self.log("total_loss", loss, on_step=True, on_epoch=True)
-        self.log("accuracy", correct, on_step=True, on_epoch=True)
+    def on_validation_epoch_start(self):
+        self.val_metrics.reset(self.device)
 
-        return loss
+    def training_epoch_end(self, outputs):
+        for name, value in self.train_metrics.results().items():
+            self.log(name, value)
 
-    def configure_optimizers(self):
-        parameters = list(self.sender.parameters()) + list(self.receiver.parameters()) + list(
-            self.predictor.parameters())
+    def validation_epoch_end(self, outputs):
+        for name, value in self.val_metrics.results("val_").items():
+            self.log(name, value)
 
+    def configure_optimizers(self):
+        ### One optimizer for the stacked weights of all agents, the agents that did not play get zero gradients
         optimizer = torch.optim.Adam(
-            parameters,
+            self.parameters(),
             lr=self.hparams['learning_rate'])
         return optimizer
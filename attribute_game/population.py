@@ -0,0 +1,304 @@
+import copy
+
+import torch
+from torch import nn
+
+from attribute_game.models import FeatureEncoder, ClassEmbeddingEncoder
+from attribute_game.receiver import ReceiverFixed, ReceiverLSTM
+from attribute_game.sender import SenderFixed, SenderRnn, add_stop_symbols
+from decoding import decode_symbols
+from message import Message, to_one_hot
+
+
+def stack_parameters(tensors):
+    return nn.Parameter(torch.stack([tensor.detach().clone() for tensor in tensors]))
+
+
+class StackedLinear(nn.Module):
+    def __init__(self, linears):
+        '''
+        The weights of a population of nn.Linear layers of the same shape in one [population, out, in] parameter.
+        Every sample of a batch is computed with the weights of its own agent, which are gathered once per batch.
+        '''
+        super(StackedLinear, self).__init__()
+        self.in_features = linears[0].in_features
+        self.weight = stack_parameters([linear.weight for linear in linears])
+        self.bias = stack_parameters([linear.bias for linear in linears])
+
+    def gather(self, agents):
+        '''
+        :param agents: [batch] index of the agent of every sample
+        :return: the [batch, out, in] weights and [batch, out] biases of the samples
+        '''
+        return self.weight[agents], self.bias[agents]
+
+    def apply(self, x, weights):
+        weight, bias = weights
+        return torch.bmm(weight, x.unsqueeze(dim=-1)).squeeze(dim=-1) + bias
+
+    def forward(self, x, agents):
+        return self.apply(x, self.gather(agents))
+
+
+class StackedSequential(nn.Module):
+    def __init__(self, sequentials):
+        '''
+        A population of nn.Sequential models of Linear layers and layers without weights (ReLU, Flatten)
+        '''
+        super(StackedSequential, self).__init__()
+        layers = []
+        for stacked_layers in zip(*sequentials):
+            if isinstance(stacked_layers[0], nn.Linear):
+                layers.append(StackedLinear(stacked_layers))
+            elif len(list(stacked_layers[0].parameters())) == 0:
+                layers.append(copy.deepcopy(stacked_layers[0]))
+            else:
+                raise ValueError("Only Linear layers and layers without weights can be stacked, got {}".format(
+                    stacked_layers[0]))
+        self.layers = nn.ModuleList(layers)
+
+    def gather(self, agents):
+        return [layer.gather(agents) if isinstance(layer, StackedLinear) else None for layer in self.layers]
+
+    def apply(self, x, weights):
+        for layer, layer_weights in zip(self.layers, weights):
+            x = layer.apply(x, layer_weights) if isinstance(layer, StackedLinear) else layer(x)
+        return x
+
+    def forward(self, x, agents):
+        return self.apply(x, self.gather(agents))
+
+
+class StackedLSTMCell(nn.Module):
+    def __init__(self, lstms):
+        '''
+        A population of single layer nn.LSTM, run one step at a time. The two biases of every LSTM are summed.
+        '''
+        super(StackedLSTMCell, self).__init__()
+        if any(lstm.num_layers != 1 or lstm.bidirectional for lstm in lstms):
+            raise ValueError("Only single layer, unidirectional LSTMs can be stacked")
+        self.weight_ih = stack_parameters([lstm.weight_ih_l0 for lstm in lstms])
+        self.weight_hh = stack_parameters([lstm.weight_hh_l0 for lstm in lstms])
+        self.bias = stack_parameters([lstm.bias_ih_l0 + lstm.bias_hh_l0 for lstm in lstms])
+
+    def gather(self, agents):
+        return self.weight_ih[agents], self.weight_hh[agents], self.bias[agents]
+
+    def apply(self, x, state, weights):
+        '''
+        One step of the LSTM, with the gate order of nn.LSTM (input, forget, cell, output)
+        :param state: ([batch, hidden], [batch, hidden]) hidden and cell state
+        '''
+        weight_ih, weight_hh, bias = weights
+        hidden, cell = state
+        gates = torch.bmm(weight_ih, x.unsqueeze(dim=-1)).squeeze(dim=-1) + \
+            torch.bmm(weight_hh, hidden.unsqueeze(dim=-1)).squeeze(dim=-1) + bias
+        input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=-1)
+        cell = torch.sigmoid(forget_gate) * cell + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+        hidden = torch.sigmoid(output_gate) * torch.tanh(cell)
+        return hidden, cell
+
+
+class StackedClassEmbedding(nn.Module):
+    def __init__(self, encoders):
+        '''
+        A population of frozen ClassEmbeddingEncoders, with their class tables in one [population, n_classes, hidden]
+        buffer
+        '''
+        super(StackedClassEmbedding, self).__init__()
+        if any(encoder.table is None for encoder in encoders):
+            raise ValueError("Only ClassEmbeddingEncoders with a table of all classes can be stacked")
+        self.register_buffer('table', torch.stack([encoder.table for encoder in encoders]))
+
+    def forward(self, ids, agents):
+        return self.table[agents, ids]
+
+
+def stack_encoders(encoders):
+    '''
+    Stacks the feature encoders of a population, FeatureEncoders or frozen ClassEmbeddingEncoders
+    '''
+    if all(isinstance(encoder, ClassEmbeddingEncoder) for encoder in encoders):
+        return StackedClassEmbedding(encoders)
+    if all(isinstance(encoder, FeatureEncoder) for encoder in encoders):
+        return StackedSequential([encoder.to_hidden for encoder in encoders])
+    raise ValueError("The encoders of a population should all be FeatureEncoders or all be ClassEmbeddingEncoders")
+
+
+def round_robin(batch_size, population_size, device):
+    '''
+    Agent i % population_size for sample i, used when no agents are given
+    '''
+    return torch.arange(batch_size, device=device) % population_size
+
+
+class SenderPool(nn.Module):
+    def __init__(self, senders):
+        '''
+        A population of SenderFixed or SenderRnn senders as one module with stacked weights.
+        The sender of every sample is chosen with an index, so any assignment of agents to the samples of a batch is
+        computed with batched matrix products instead of one call per agent.
+        :param senders: list of senders of the same type and shape, their weights are copied
+        '''
+        super(SenderPool, self).__init__()
+        first = senders[0]
+        if not all(type(sender) == type(first) for sender in senders) or type(first) not in (SenderFixed, SenderRnn):
+            raise ValueError("A sender pool is made of SenderFixed or SenderRnn senders of one type")
+        self.population_size = len(senders)
+        self.fixed_size = type(first) == SenderFixed
+        self.feature_encoder = stack_encoders([sender.feature_encoder for sender in senders])
+        self.hidden_state_size = first.hidden_state_size
+        if self.fixed_size:
+            self.to_msg = StackedSequential([sender.to_msg for sender in senders])
+        else:
+            self.rnn = StackedLSTMCell([sender.rnn for sender in senders])
+            self.to_symbol = StackedSequential([sender.to_symbol for sender in senders])
+
+        self.tau = first.tau
+        self.msg_len = first.msg_len
+        self.n_symbols = first.n_symbols
+        ### How the symbols are chosen from the logits, see decoding.decode_symbols
+        self.decode_mode = first.decode_mode
+        self.top_k = first.top_k
+
+    def forward(self, x, agents=None):
+        '''
+        :param agents: [batch] index of the sender of every sample, sample i goes to sender i % population_size if
+        not given
+        :return: the messages, as the senders of the pool return them
+        '''
+        if agents is None:
+            agents = round_robin(len(x), self.population_size, x.device)
+        hidden_state = self.feature_encoder(x, agents)
+
+        if self.fixed_size:
+            msg_logits = self.to_msg(hidden_state, agents)
+            msg_logits = msg_logits.reshape(self.msg_len, len(x), self.n_symbols)
+            return decode_symbols(msg_logits, self.decode_mode, tau=self.tau, top_k=self.top_k)
+
+        ### See SenderRnn.forward, the weights of the agents are gathered once for the whole message
+        rnn_weights = self.rnn.gather(agents)
+        symbol_weights = self.to_symbol.gather(agents)
+        state = (hidden_state, torch.zeros_like(hidden_state))
+        current_symbol = torch.zeros(len(x), self.n_symbols, device=hidden_state.device)
+        result = []
+        for i in range(self.msg_len):
+            state = self.rnn.apply(current_symbol, state, rnn_weights)
+            out = self.to_symbol.apply(state[0], symbol_weights)
+
+            current_symbol = decode_symbols(out, self.decode_mode, tau=self.tau, top_k=self.top_k)
+            result.append(out)
+
+        return add_stop_symbols(torch.stack(result), self.n_symbols)
+
+
+class ReceiverPool(nn.Module):
+    def __init__(self, receivers):
+        '''
+        A population of ReceiverFixed or ReceiverLSTM receivers as one module with stacked weights, see SenderPool
+        :param receivers: list of receivers of the same type and shape, their weights are copied
+        '''
+        super(ReceiverPool, self).__init__()
+        first = receivers[0]
+        if not all(type(receiver) == type(first) for receiver in receivers) or \
+                type(first) not in (ReceiverFixed, ReceiverLSTM):
+            raise ValueError("A receiver pool is made of ReceiverFixed or ReceiverLSTM receivers of one type")
+        self.population_size = len(receivers)
+        self.fixed_size = type(first) == ReceiverFixed
+        self.n_symbols = first.n_symbols
+        self.n_xs = first.n_xs
+        self.hidden_state_size = first.hidden_state_size
+        self.feature_encoder = stack_encoders([receiver.feature_encoder for receiver in receivers])
+        if self.fixed_size:
+            self.msg_to_hidden = StackedSequential([receiver.msg_to_hidden for receiver in receivers])
+        else:
+            self.rnn = StackedLSTMCell([receiver.rnn for receiver in receivers])
+        self.to_prediction = StackedSequential([receiver.to_prediction for receiver in receivers])
+
+    def encode_message(self, msg, agents):
+        if self.fixed_size:
+            linear = self.msg_to_hidden.layers[2]
+            if isinstance(msg, Message) and not msg.requires_grad:
+                ### See message.linear_of_flat_message, the columns of agent a start at row a * in_features of the
+                ### table of all the weights
+                msg_len, batch_size = msg.indices.shape
+                columns = msg.indices.reshape(batch_size, msg_len) + \
+                    torch.arange(msg_len, device=agents.device) * self.n_symbols
+                columns = columns + agents.unsqueeze(dim=-1) * linear.in_features
+                table = linear.weight.transpose(1, 2).reshape(-1, self.hidden_state_size)
+                return torch.nn.functional.embedding_bag(columns, table, mode='sum') + linear.bias[agents]
+            one_hot = to_one_hot(msg)
+            return self.msg_to_hidden(one_hot.reshape(one_hot.shape[1], -1), agents)
+
+        ### The state after the last symbol of every message, as with the packed messages of ReceiverLSTM
+        if not isinstance(msg, Message):
+            msg = Message(msg)
+        one_hot = msg.one_hot
+        weights = self.rnn.gather(agents)
+        hidden = torch.zeros(one_hot.shape[1], self.hidden_state_size, device=one_hot.device)
+        state = (hidden, torch.zeros_like(hidden))
+        hidden_states = []
+        for symbol in one_hot:
+            state = self.rnn.apply(symbol, state, weights)
+            hidden_states.append(state[0])
+        lengths = msg.lengths.to(one_hot.device)
+        return torch.stack(hidden_states)[lengths - 1, torch.arange(len(lengths), device=one_hot.device)]
+
+    def forward(self, xs, msg, agents=None):
+        '''
+        :param agents: [batch] index of the receiver of every sample, sample i goes to receiver i % population_size if
+        not given
+        '''
+        if agents is None:
+            agents = round_robin(len(xs[0]), self.population_size, xs[0].device)
+        hidden_states = [self.feature_encoder(x, agents) for x in xs]
+        hidden_states.append(self.encode_message(msg, agents))
+
+        out = self.to_prediction(torch.cat(hidden_states, dim=1), agents)
+
+        out_probs = torch.softmax(out, dim=-1)
+        return out, out_probs
+
+
+class AgentMetrics:
+    '''
+    The number of played and won episodes of every (sender, receiver) pair of a population, kept on the device so
+    no step waits for the gpu. They are read once, at the end of the epoch.
+    '''
+
+    def __init__(self, population_size):
+        self.population_size = population_size
+        self.played = None
+        self.won = None
+
+    def reset(self, device):
+        self.played = torch.zeros(self.population_size ** 2, device=device)
+        self.won = torch.zeros(self.population_size ** 2, device=device)
+
+    def update(self, senders, receivers, correct):
+        '''
+        :param correct: [batch] bool, if the receiver chose the target
+        '''
+        if self.played is None:
+            self.reset(senders.device)
+        pairs = senders * self.population_size + receivers
+        self.played += torch.bincount(pairs, minlength=self.population_size ** 2).float()
+        self.won += torch.bincount(pairs, weights=correct.float(), minlength=self.population_size ** 2)
+
+    def results(self, prefix=""):
+        '''
+        :return: dict with the accuracy of every sender and every receiver, over all the partners it played with, and
+        the accuracy of the pairs of the same agent index (self play) and of all other pairs (cross play)
+        '''
+        played = self.played.view(self.population_size, self.population_size)
+        won = self.won.view(self.population_size, self.population_size)
+        results = {}
+        sender_accuracy = won.sum(dim=1) / played.sum(dim=1).clamp(min=1)
+        receiver_accuracy = won.sum(dim=0) / played.sum(dim=0).clamp(min=1)
+        for i in range(self.population_size):
+            results["{}accuracy_sender_{}".format(prefix, i)] = sender_accuracy[i]
+            results["{}accuracy_receiver_{}".format(prefix, i)] = receiver_accuracy[i]
+        self_played, self_won = torch.diagonal(played).sum(), torch.diagonal(won).sum()
+        results[prefix + "self_play_accuracy"] = self_won / self_played.clamp(min=1)
+        results[prefix + "cross_play_accuracy"] = (won.sum() - self_won) / (played.sum() - self_played).clamp(min=1)
+        return results
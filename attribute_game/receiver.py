@@ -1,5 +1,8 @@
 import torch
 from torch import nn
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+
+from message import Message, linear_of_flat_message, to_one_hot
 
 
 class ReceiverFixed(nn.Module):
@@ -28,6 +31,22 @@ class ReceiverFixed(nn.Module):
             nn.Linear(self.hidden_state_size, self.n_xs)
         )
 
+    def encode_message(self, msg):
+        '''
+        :param msg: a [msg_len, batch, n_symbols] one hot tensor or a Message. When no gradients have to flow back
+        through the symbols of a Message, the hidden state is looked up from its indices.
+        '''
+        if isinstance(msg, Message) and not msg.requires_grad:
+            ### The relu of a one hot message does nothing, so only the linear layer is left
+            return linear_of_flat_message(self.msg_to_hidden[2], msg.indices, self.n_symbols)
+
+        msg = to_one_hot(msg)
+        # Permute the msg to make sure that the batch is second
+
+        msg = msg.view(msg.shape[1], -1)
+
+        return self.msg_to_hidden(msg)
+
     def forward(self, xs, msg):
         hidden_states = []
         for x in xs:
@@ -35,11 +54,7 @@ class ReceiverFixed(nn.Module):
 
             hidden_states.append(hidden_state)
 
-        # Permute the msg to make sure that the batch is second
-
-        msg = msg.view(msg.shape[1], -1)
-
-        hidden_msg = self.msg_to_hidden(msg)
+        hidden_msg = self.encode_message(msg)
         # Permute back
 
         hidden_states.append(hidden_msg)
@@ -52,6 +67,59 @@ class ReceiverFixed(nn.Module):
         return out, out_probs
 
 
+class ReceiverFactorized(nn.Module):
+    def __init__(self, feature_encoder, n_xs, n_symbols=3, msg_len=5):
+        '''
+        A receiver of fixed length messages that embeds every symbol and weighs it with the embedding of its position.
+        The number of parameters grows with n_symbols instead of msg_len * n_symbols.
+        '''
+        super(ReceiverFactorized, self).__init__()
+        self.feature_encoder = feature_encoder
+        self.n_symbols = n_symbols
+        self.n_xs = n_xs
+
+        self.hidden_state_size = self.feature_encoder.hidden_state_size
+
+        self.symbol_embedding = nn.Embedding(n_symbols, self.hidden_state_size)
+        self.position_embedding = nn.Embedding(msg_len, self.hidden_state_size)
+
+        self.to_prediction = nn.Sequential(
+
+            nn.ReLU(),
+            nn.Linear(self.hidden_state_size * (self.n_xs + 1), self.hidden_state_size),
+            nn.ReLU(),
+            nn.Linear(self.hidden_state_size, self.n_xs)
+        )
+
+    def encode_message(self, msg):
+        '''
+        :param msg: a [msg_len, batch, n_symbols] one hot tensor or a Message. When no gradients have to flow back
+        through the symbols of a Message, the symbols are looked up from its indices.
+        '''
+        if isinstance(msg, Message) and not msg.requires_grad:
+            symbols = self.symbol_embedding(msg.indices)
+        else:
+            symbols = to_one_hot(msg) @ self.symbol_embedding.weight
+
+        return (symbols * self.position_embedding.weight.unsqueeze(dim=1)).sum(dim=0)
+
+    def forward(self, xs, msg):
+        hidden_states = []
+        for x in xs:
+            hidden_state = self.feature_encoder(x)
+
+            hidden_states.append(hidden_state)
+
+        hidden_states.append(self.encode_message(msg))
+
+        hidden = torch.cat(hidden_states, dim=1)
+
+        out = self.to_prediction(hidden)
+
+        out_probs = torch.softmax(out, dim=-1)
+        return out, out_probs
+
+
 class ReceiverPredictor(nn.Module):
     def __init__(self, feature_encoder, n_xs, n_symbols=3, msg_len=5):
         '''
@@ -127,7 +195,7 @@ class ReceiverLSTM(nn.Module):
 
         #msg = self.embedding_layer(msg.view(-1, self.n_symbols))
 
-        out, hidden = self.rnn(msg)
+        out, hidden = self.rnn(to_one_hot(msg))
 
         hidden = hidden[0][0]
 
@@ -141,3 +209,142 @@ class ReceiverLSTM(nn.Module):
         out_probs = torch.softmax(out, dim=-1)
         return out, out_probs
 
+
+
+class ReceiverDotProduct(nn.Module):
+    def __init__(self, feature_encoder, n_symbols=3, msg_len=5, fixed_size=True):
+        '''
+        A receiver that scores every candidate against the message with a shared bilinear head.
+        The candidates are encoded in one batch, so the model works for any number of candidates.
+        :param fixed_size: read the message with a linear layer (fixed length) or with a LSTM (variable length)
+        '''
+        super(ReceiverDotProduct, self).__init__()
+        self.feature_encoder = feature_encoder
+        self.n_symbols = n_symbols
+        self.msg_len = msg_len
+        self.fixed_size = fixed_size
+
+        self.hidden_state_size = self.feature_encoder.hidden_state_size
+
+        if fixed_size:
+            self.msg_to_hidden = nn.Sequential(
+                nn.Flatten(),
+                nn.Linear(n_symbols * msg_len, self.hidden_state_size)
+            )
+        else:
+            self.rnn = nn.LSTM(self.n_symbols, self.hidden_state_size)
+
+        self.bilinear = nn.Linear(self.hidden_state_size, self.hidden_state_size, bias=False)
+
+    def encode_message(self, msg):
+        if self.fixed_size:
+            if isinstance(msg, Message) and not msg.requires_grad:
+                return linear_of_flat_message(self.msg_to_hidden[1], msg.indices, self.n_symbols)
+            # Same layout as ReceiverFixed, so the senders can be used with both
+            msg = to_one_hot(msg)
+            msg = msg.view(msg.shape[1], -1)
+            return self.msg_to_hidden(msg)
+
+        out, hidden = self.rnn(to_one_hot(msg))
+        return hidden[0][0]
+
+    def encode_candidates(self, xs):
+        '''
+        Encodes all the candidates with a single call of the feature encoder
+        :param xs: list of [batch, features] tensors or a [batch, n_candidates, features] tensor.
+        A [n_candidates, features] tensor is a set of candidates that is shared by all messages.
+        With class ids the features dimension is left out.
+        :return: [batch, n_candidates, hidden] or [n_candidates, hidden] tensor
+        '''
+        if isinstance(xs, (list, tuple)):
+            xs = torch.stack(xs, dim=1)
+        if not xs.is_floating_point():
+            ### Class ids, the encoder is a ClassEmbeddingEncoder that takes any shape
+            return self.feature_encoder(xs)
+        hidden = self.feature_encoder(xs.reshape(-1, xs.shape[-1]))
+        return hidden.reshape(*xs.shape[:-1], self.hidden_state_size)
+
+    def score(self, candidates, msg):
+        '''
+        Scaled dot product between the candidate encodings and the message.
+        :param candidates: [batch, n_candidates, hidden] or [n_candidates, hidden] when all messages share the
+        same candidates (in batch negatives)
+        '''
+        hidden_msg = self.bilinear(self.encode_message(msg))
+        if candidates.dim() == 2:
+            out = hidden_msg @ candidates.t()
+        else:
+            out = torch.bmm(candidates, hidden_msg.unsqueeze(dim=-1)).squeeze(dim=-1)
+        return out / self.hidden_state_size ** 0.5
+
+    def forward(self, xs, msg):
+        out = self.score(self.encode_candidates(xs), msg)
+
+        out_probs = torch.softmax(out, dim=-1)
+        return out, out_probs
+
+
+class ReceiverTransformer(nn.Module):
+    def __init__(self, feature_encoder, n_xs, n_symbols=3, msg_len=5, n_heads=4, n_layers=2):
+        '''
+        A receiver that reads the whole message in parallel with a transformer encoder.
+        Packed messages are padded again, the padding is masked out with their lengths.
+        '''
+        super(ReceiverTransformer, self).__init__()
+        self.feature_encoder = feature_encoder
+        self.n_symbols = n_symbols
+        self.n_xs = n_xs
+        self.hidden_state_size = self.feature_encoder.hidden_state_size
+
+        self.embedding = nn.Linear(n_symbols, self.hidden_state_size)
+        self.position_embedding = nn.Embedding(msg_len, self.hidden_state_size)
+        self.encoder = nn.TransformerEncoder(
+            nn.TransformerEncoderLayer(self.hidden_state_size, n_heads, dim_feedforward=self.hidden_state_size * 2,
+                                       dropout=0.0),
+            n_layers)
+
+        self.to_prediction = nn.Sequential(
+
+            nn.Linear(self.hidden_state_size * (self.n_xs + 1), self.hidden_state_size),
+            nn.ReLU(),
+            nn.Linear(self.hidden_state_size, self.n_xs)
+        )
+
+    def encode_message(self, msg):
+        '''
+        :param msg: a PackedSequence, a Message or a [msg_len, batch, n_symbols] one hot tensor.
+        Only packed messages have a length, the others are read in full.
+        '''
+        if isinstance(msg, PackedSequence):
+            msg, lengths = pad_packed_sequence(msg)
+        else:
+            msg = to_one_hot(msg)
+            lengths = torch.full((msg.shape[1],), msg.shape[0], dtype=torch.long)
+        length = msg.shape[0]
+
+        ### [batch, length], True at the positions after the end of the message
+        padding_mask = torch.arange(length).unsqueeze(dim=0) >= lengths.unsqueeze(dim=1)
+        padding_mask = padding_mask.to(msg.device)
+
+        embedded = self.embedding(msg) + self.position_embedding.weight[:length].unsqueeze(dim=1)
+        out = self.encoder(embedded, src_key_padding_mask=padding_mask)
+
+        ### Mean over the symbols of the message
+        keep = (~padding_mask).t().unsqueeze(dim=-1).float()
+        return (out * keep).sum(dim=0) / keep.sum(dim=0)
+
+    def forward(self, xs, msg):
+        hidden_states = []
+        for x in xs:
+            hidden_state = self.feature_encoder(x)
+
+            hidden_states.append(hidden_state)
+
+        hidden_states.append(self.encode_message(msg))
+
+        hidden = torch.cat(hidden_states, dim=1)
+
+        out = self.to_prediction(hidden)
+
+        out_probs = torch.softmax(out, dim=-1)
+        return out, out_probs
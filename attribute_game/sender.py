@@ -2,8 +2,64 @@ import torch
 from torch import nn
 import numpy as np
 
+from decoding import decode_symbols
+
+
+def add_stop_symbols(msg, n_symbols):
+    '''
+    Fills every message after its first stop symbol (0) with the last symbol of the alphabet
+    :param msg: [msg_len, batch, n_symbols] tensor
+    '''
+    device = msg.device
+
+    ### Get the symbols
+    symbol_tensor = torch.argmax(msg, dim=-1)
+
+    ### Get tensor which has true whenever there is a stop symbol
+    stop_symbol_tensor = symbol_tensor == 0
+
+    ### Move it to numpy
+    np_stop_symbol_tensor = stop_symbol_tensor.cpu().numpy()
+
+    def fill_true(mask, ):
+        start_index = 0
+
+        for i, s in enumerate(mask):
+            if i == len(mask) - 1:
+                break
+            if s:
+                start_index = i
+                break
+        mask[start_index] = False
+        if start_index < len(mask):
+            start_index += 1
+        mask[start_index + 1:] = True
+        return mask
+
+    ###Once we pack from the first true onward
+    np_stop_symbol_tensor = np.apply_along_axis(fill_true, 0, np_stop_symbol_tensor)
+
+    ### Get the masks
+    mask = torch.tensor(np_stop_symbol_tensor).to(device)
+
+    m = symbol_tensor * ~mask + torch.ones(symbol_tensor.shape).to(device) * (n_symbols - 1) * mask
+    m = m.long()
+
+    ### We not create it unto the one hot encoding with the mask
+    mask = mask.unsqueeze(dim=-1).repeat(1, 1, n_symbols)
+
+    one_hot = torch.nn.functional.one_hot(m, num_classes=n_symbols)
+
+    msg = msg * ~mask + one_hot * mask
+
+    # Make sure it is off the right type
+    msg = msg.float()
+
+    return msg
+
+
 class SenderRnn(nn.Module):
-    def __init__(self, feature_encoder, msg_len=5, n_symbols=3, tau=0.8):
+    def __init__(self, feature_encoder, msg_len=5, n_symbols=3, tau=0.8, decode_mode='gumbel', top_k=2):
         '''
         A sender that send fixed length messages
         '''
@@ -26,6 +82,9 @@ class SenderRnn(nn.Module):
         self.msg_len = msg_len
         self.n_symbols = n_symbols
         self.n_symbols = n_symbols
+        ### How the symbols are chosen from the logits, see decoding.decode_symbols
+        self.decode_mode = decode_mode
+        self.top_k = top_k
 
     def forward(self, x):
 
@@ -45,7 +104,7 @@ class SenderRnn(nn.Module):
             out = out.view(-1, self.feature_encoder.hidden_state_size)
             out = self.to_symbol(out).view(1, -1, self.n_symbols)
 
-            symbol = torch.nn.functional.gumbel_softmax(out, tau=self.tau, hard=True, dim=-1)
+            symbol = decode_symbols(out, self.decode_mode, tau=self.tau, top_k=self.top_k)
             current_symbol = symbol
 
             result.append(out)
@@ -60,85 +119,82 @@ class SenderRnn(nn.Module):
         return msg
 
     def add_stop_symbols(self, msg):
+        return add_stop_symbols(msg, self.n_symbols)
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        ### Get the symbols
-        symbol_tensor = torch.argmax(msg, dim=-1)
 
-        ### Get tensor which has true whenever there is a stop symbol
-        stop_symbol_tensor = symbol_tensor == 0
 
-        ### Move it to numpy
-        np_stop_symbol_tensor = stop_symbol_tensor.cpu().numpy()
 
-        def fill_true(mask, ):
-            start_index = 0
-
-            for i, s in enumerate(mask):
-                if i == len(mask) - 1:
-                    break
-                if s:
-                    start_index = i
-                    break
-            mask[start_index] = False
-            if start_index < len(mask):
-                start_index += 1
-            mask[start_index + 1:] = True
-            return mask
+class SenderFixed(nn.Module):
+    def __init__(self, feature_encoder, msg_len=5, n_symbols=3, tau=0.8, decode_mode='gumbel', top_k=2):
+        '''
+        A sender that send fixed length messages
+        '''
+        super(SenderFixed, self).__init__()
+        self.feature_encoder = feature_encoder
+        self.n_symbols = n_symbols
 
-        ###Once we pack from the first true onward
-        np_stop_symbol_tensor = np.apply_along_axis(fill_true, 0, np_stop_symbol_tensor)
+        self.hidden_state_size = self.feature_encoder.hidden_state_size
 
-        ### Get the masks
-        mask = torch.tensor(np_stop_symbol_tensor).to(device)
+        self.to_msg = nn.Sequential(
+            nn.ReLU(),
+            nn.Linear(self.hidden_state_size, msg_len * n_symbols)
+        )
 
-        m = symbol_tensor * ~mask + torch.ones(symbol_tensor.shape).to(device) * (self.n_symbols - 1) * mask
-        m = m.long()
+        self.tau = tau
+        self.msg_len = msg_len
+        self.n_symbols = n_symbols
+        ### How the symbols are chosen from the logits, see decoding.decode_symbols
+        self.decode_mode = decode_mode
+        self.top_k = top_k
 
-        ### We not create it unto the one hot encoding with the mask
-        mask = mask.unsqueeze(dim=-1).repeat(1, 1, self.n_symbols)
+    def forward(self, x):
+        ###Generate messages of length msg_len. Once the stop symbol (highest number in our alphabet) is generated the rest of the string will be filled with that sign
 
-        one_hot = torch.nn.functional.one_hot(m, num_classes=self.n_symbols)
+        hidden_state = self.feature_encoder(x)
+        msg_logits = self.to_msg(hidden_state)
+        msg_logits = msg_logits.reshape(self.msg_len, len(x), self.n_symbols)
+        msg = decode_symbols(msg_logits, self.decode_mode, tau=self.tau, top_k=self.top_k)
 
-        msg = msg * ~mask + one_hot * mask
 
-        # Make sure it is off the right type
-        msg = msg.float()
 
         return msg
 
 
-
-
-class SenderFixed(nn.Module):
-    def __init__(self, feature_encoder, msg_len=5, n_symbols=3, tau=0.8):
+class SenderFactorized(nn.Module):
+    def __init__(self, feature_encoder, msg_len=5, n_symbols=3, tau=0.8, decode_mode='gumbel', top_k=2):
         '''
-        A sender that send fixed length messages
+        A sender that send fixed length messages with one output layer that is shared by all positions.
+        The positions are told apart by a position embedding, so the number of parameters grows with n_symbols
+        instead of msg_len * n_symbols.
         '''
-        super(SenderFixed, self).__init__()
+        super(SenderFactorized, self).__init__()
         self.feature_encoder = feature_encoder
         self.n_symbols = n_symbols
 
         self.hidden_state_size = self.feature_encoder.hidden_state_size
 
-        self.to_msg = nn.Sequential(
+        self.position_embedding = nn.Embedding(msg_len, self.hidden_state_size)
+
+        self.to_symbol = nn.Sequential(
             nn.ReLU(),
-            nn.Linear(self.hidden_state_size, msg_len * n_symbols)
+            nn.Linear(self.hidden_state_size, self.hidden_state_size),
+            nn.ReLU(),
+            nn.Linear(self.hidden_state_size, n_symbols)
         )
 
         self.tau = tau
         self.msg_len = msg_len
         self.n_symbols = n_symbols
+        ### How the symbols are chosen from the logits, see decoding.decode_symbols
+        self.decode_mode = decode_mode
+        self.top_k = top_k
 
     def forward(self, x):
-        ###Generate messages of length msg_len. Once the stop symbol (highest number in our alphabet) is generated the rest of the string will be filled with that sign
-
         hidden_state = self.feature_encoder(x)
-        msg_logits = self.to_msg(hidden_state)
-        msg_logits = msg_logits.reshape(self.msg_len, len(x), self.n_symbols)
-        msg = torch.nn.functional.gumbel_softmax(msg_logits, tau=self.tau, hard=True, dim=-1)
-
 
+        ### [msg_len, batch, hidden], the same layout as the messages of SenderFixed
+        hidden_states = hidden_state.unsqueeze(dim=0) + self.position_embedding.weight.unsqueeze(dim=1)
+        msg_logits = self.to_symbol(hidden_states)
+        msg = decode_symbols(msg_logits, self.decode_mode, tau=self.tau, top_k=self.top_k)
 
         return msg
@@ -2,15 +2,22 @@ import torch
 from torch.nn.utils.rnn import pack_padded_sequence
 from torch.utils.data import DataLoader
 
-from attribute_game.models import FeatureEncoder, PredictionRNN
-from attribute_game.receiver import ReceiverLSTM, ReceiverFixed, ReceiverPredictor
-from attribute_game.sender import SenderFixed, SenderRnn
+from attribute_game.models import FeatureEncoder, PredictionRNN, PredictionTransformer, ClassEmbeddingEncoder
+from attribute_game.receiver import ReceiverLSTM, ReceiverFixed, ReceiverPredictor, ReceiverDotProduct, \
+    ReceiverFactorized, ReceiverTransformer
+from attribute_game.sender import SenderFixed, SenderRnn, SenderFactorized
 from datasets.AttributeDataset import AttributeDataset
+from message import Message
 
 import numpy as np
 
 
-def get_pretrained_feature_encoder(n_attributes, size_attributes, n_epochs=3, hidden_state_size=128):
+def get_pretrained_feature_encoder(n_attributes, size_attributes, n_epochs=3, hidden_state_size=128,
+                                   frozen_encoder=False):
+    '''
+    Pretrains a feature encoder by classifying the attributes
+    :param frozen_encoder: return a frozen ClassEmbeddingEncoder, which takes class ids, instead of the encoder
+    '''
     dataset = AttributeDataset(n_attributes, size_attributes, samples_per_epoch=1000)
 
     train_dataloader = DataLoader(dataset, batch_size=32)
@@ -47,34 +54,74 @@ def get_pretrained_feature_encoder(n_attributes, size_attributes, n_epochs=3, hi
             batch_count += 1
         print("accuracy")
         print(train_accuracy / batch_count)
+    if frozen_encoder:
+        return ClassEmbeddingEncoder(classifier).to(device)
     return classifier
 
 
+def get_encoder(encoder, n_attributes, attributes_size, pretrain_n_epochs, hidden_state_size, frozen_encoder, device):
+    '''
+    Pretrains a feature encoder, or takes the given pretrained one
+    '''
+    if encoder is None:
+        return get_pretrained_feature_encoder(n_attributes, attributes_size, n_epochs=pretrain_n_epochs,
+                                              hidden_state_size=hidden_state_size, frozen_encoder=frozen_encoder)
+    encoder = encoder.to(device)
+    if frozen_encoder:
+        return ClassEmbeddingEncoder(encoder).to(device)
+    return encoder
+
+
 def get_sender(n_attributes, attributes_size, n_symbols, msg_len, device, fixed_size=True, pretrain_n_epochs=3,
-               encoder_hidden_state_size=128):
+               encoder_hidden_state_size=128, decode_mode='gumbel', top_k=2, message_head="dense", frozen_encoder=False,
+               encoder=None):
     '''
     Get the sender model
+    :param decode_mode: how the sender chooses its symbols during training, see decoding.decode_symbols
+    :param message_head: "dense" outputs all symbols of a fixed size message with one linear layer, "factorized"
+    shares the output layer between the positions, for large numbers of symbols
+    :param frozen_encoder: freeze the pretrained encoder and take class ids as input, see ClassEmbeddingEncoder
+    :param encoder: an already pretrained FeatureEncoder to use instead of pretraining one
     '''
 
-    encoder = get_pretrained_feature_encoder(n_attributes, attributes_size, n_epochs=pretrain_n_epochs,
-                                             hidden_state_size=encoder_hidden_state_size)
-    if fixed_size:
-        sender = SenderFixed(encoder, n_symbols=n_symbols, msg_len=msg_len,
+    encoder = get_encoder(encoder, n_attributes, attributes_size, pretrain_n_epochs, encoder_hidden_state_size,
+                          frozen_encoder, device)
+    if fixed_size and message_head == "factorized":
+        sender = SenderFactorized(encoder, n_symbols=n_symbols, msg_len=msg_len, decode_mode=decode_mode,
+                                  top_k=top_k).to(device)
+    elif fixed_size:
+        sender = SenderFixed(encoder, n_symbols=n_symbols, msg_len=msg_len, decode_mode=decode_mode, top_k=top_k
                              ).to(device)
     else:
-        sender = SenderRnn(encoder, n_symbols=n_symbols, msg_len=msg_len, ).to(device)
+        sender = SenderRnn(encoder, n_symbols=n_symbols, msg_len=msg_len, decode_mode=decode_mode,
+                           top_k=top_k).to(device)
     return sender
 
 
 def get_receiver(n_attributes, attributes_size, n_receiver, n_symbols, msg_len, device, fixed_size=True,
-                 pretrain_n_epochs=3, encoder_hidden_state_size=128):
+                 pretrain_n_epochs=3, encoder_hidden_state_size=128, receiver_type="concat", message_head="dense",
+                 n_heads=4, n_layers=2, frozen_encoder=False, encoder=None):
     '''
-    Get the sender model
+    Get the receiver model
+    :param receiver_type: "concat" concatenates all candidates and the message, "dot_product" scores every
+    candidate against the message and works for any number of candidates, "transformer" reads the message with a
+    transformer encoder of n_layers layers with n_heads heads
+    :param message_head: "dense" reads a fixed size message with one linear layer, "factorized" embeds the symbols,
+    for large numbers of symbols. Used by the "concat" receiver.
+    :param frozen_encoder: freeze the pretrained encoder and take class ids as input, see ClassEmbeddingEncoder
+    :param encoder: an already pretrained FeatureEncoder to use instead of pretraining one
     '''
 
-    encoder = get_pretrained_feature_encoder(n_attributes, attributes_size, n_epochs=pretrain_n_epochs,
-                                             hidden_state_size=encoder_hidden_state_size)
-    if fixed_size:
+    encoder = get_encoder(encoder, n_attributes, attributes_size, pretrain_n_epochs, encoder_hidden_state_size,
+                          frozen_encoder, device)
+    if receiver_type == "transformer":
+        receiver = ReceiverTransformer(encoder, n_receiver, n_symbols=n_symbols, msg_len=msg_len, n_heads=n_heads,
+                                       n_layers=n_layers).to(device)
+    elif receiver_type == "dot_product":
+        receiver = ReceiverDotProduct(encoder, n_symbols=n_symbols, msg_len=msg_len, fixed_size=fixed_size).to(device)
+    elif fixed_size and message_head == "factorized":
+        receiver = ReceiverFactorized(encoder, n_receiver, n_symbols=n_symbols, msg_len=msg_len).to(device)
+    elif fixed_size:
         receiver = ReceiverFixed(encoder, n_receiver, n_symbols=n_symbols, msg_len=msg_len,
                                  ).to(device)
     else:
@@ -82,24 +129,40 @@ def get_receiver(n_attributes, attributes_size, n_receiver, n_symbols, msg_len,
     return receiver
 
 
-def get_predictor(n_symbols, hidden_size, device):
+def get_predictor(n_symbols, hidden_size, device, predictor_type="lstm", msg_len=None, n_heads=4, n_layers=2):
+    '''
+    Get the predictor of the next symbol
+    :param predictor_type: "lstm" or "transformer", which predicts all positions in parallel with a causal mask
+    :param msg_len: length of the messages, needed for the transformer
+    '''
+    if predictor_type == "transformer":
+        return PredictionTransformer(n_symbols, hidden_size, msg_len + 1, n_heads=n_heads, n_layers=n_layers).to(device)
     return PredictionRNN(n_symbols, hidden_size).to(device)
 
 
 def get_receiver_predictor(n_attributes, attributes_size, n_receiver, n_symbols, msg_len, device, fixed_size=True,
-                           pretrain_n_epochs=3, encoder_hidden_state_size=128):
+                           pretrain_n_epochs=3, encoder_hidden_state_size=128, frozen_encoder=False, encoder=None):
     '''
     Get the receiver predictor
+    :param encoder: an already pretrained FeatureEncoder to use instead of pretraining one
     '''
 
-    encoder = get_pretrained_feature_encoder(n_attributes, attributes_size, n_epochs=pretrain_n_epochs,
-                                             hidden_state_size=encoder_hidden_state_size)
+    encoder = get_encoder(encoder, n_attributes, attributes_size, pretrain_n_epochs, encoder_hidden_state_size,
+                          frozen_encoder, device)
 
     return ReceiverPredictor(encoder, n_receiver, n_symbols=n_symbols, msg_len=msg_len, ).to(device)
 
 
 def pack(msg, msg_len):
-    lengths = get_lengths(msg, msg_len)
+    '''
+    Packs the messages up to and including their stop symbol
+    :param msg: a [msg_len, batch, n_symbols] one hot tensor or a Message, which has its lengths already
+    '''
+    if isinstance(msg, Message):
+        lengths = msg.lengths
+        msg = msg.one_hot
+    else:
+        lengths = get_lengths(msg, msg_len)
 
     msg_packed = pack_padded_sequence(msg, lengths, enforce_sorted=False)
 
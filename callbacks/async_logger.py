@@ -0,0 +1,189 @@
+import atexit
+import functools
+import queue
+import threading
+import time
+import warnings
+
+import torch
+from pytorch_lightning.loggers import LightningLoggerBase, TensorBoardLogger
+
+### Put in the queue by close, the writer thread stops when it reaches it
+STOP = object()
+
+
+class AsyncExperiment:
+    '''
+    The experiment (SummaryWriter) of an AsyncLogger. Its add_* calls, as the callbacks make them with add_scalar and
+    add_text, are queued for the writer thread, everything else is the experiment of the wrapped logger.
+    '''
+
+    def __init__(self, logger, experiment):
+        self._logger = logger
+        self._experiment = experiment
+
+    def __getattr__(self, name):
+        attribute = getattr(self._experiment, name)
+        if name.startswith("add_") and callable(attribute):
+            return functools.partial(self._logger.enqueue, attribute)
+        return attribute
+
+
+class AsyncLogger(LightningLoggerBase):
+    '''
+    Wraps a logger so the metrics and the text are written to disk by a background thread instead of the training
+    thread. The records go through a bounded queue and are written in batches, the writer is flushed every flush_secs
+    seconds and when the training ends.
+    When the queue is full the training thread waits up to block_timeout seconds for room (backpressure), after that
+    the record is dropped. The number of dropped records is logged as logger/dropped_records.
+    '''
+
+    def __init__(self, logger, max_queue=10000, flush_secs=5.0, max_batch=512, block_timeout=0.1):
+        '''
+        :param logger: the logger that does the writing, e.g. a TensorBoardLogger
+        :param max_queue: maximum number of records waiting to be written
+        :param max_batch: maximum number of records the writer thread writes before it checks the flush interval
+        :param block_timeout: seconds to wait for room in a full queue before dropping, None waits forever
+        '''
+        super().__init__()
+        self.logger = logger
+        self.max_queue = max_queue
+        self.flush_secs = flush_secs
+        self.max_batch = max_batch
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.last_step = 0
+        self._queue = None
+        self._thread = None
+
+    def __getstate__(self):
+        ### Spawned processes get a copy of the trainer, they start their own writer thread
+        state = self.__dict__.copy()
+        state["_queue"] = None
+        state["_thread"] = None
+        return state
+
+    def start(self):
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._thread = threading.Thread(target=self.write_records, name="async-logger", daemon=True)
+        self._thread.start()
+        ### The records that are still queued are also written when the process exits without finalize
+        atexit.register(self.close)
+
+    def enqueue(self, function, *args, **kwargs):
+        '''
+        Queues the call function(*args, **kwargs) for the writer thread
+        '''
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put((function, args, kwargs), timeout=self.block_timeout)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_records(self):
+        last_flush = time.monotonic()
+        written_dropped = 0
+        stop = False
+        while not stop:
+            try:
+                records = [self._queue.get(timeout=self.flush_secs)]
+            except queue.Empty:
+                records = []
+            while len(records) < self.max_batch:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in records:
+                if record is STOP:
+                    stop = True
+                    continue
+                function, args, kwargs = record
+                try:
+                    function(*args, **kwargs)
+                except Exception as e:
+                    ### A record that can not be written should not stop the writing of all the others
+                    warnings.warn("The async logger could not write a record: {}".format(e))
+
+            if self.dropped != written_dropped:
+                written_dropped = self.dropped
+                self.logger.experiment.add_scalar("logger/dropped_records", written_dropped, self.last_step)
+            if stop or time.monotonic() - last_flush >= self.flush_secs:
+                self.logger.experiment.flush()
+                last_flush = time.monotonic()
+
+    def close(self):
+        '''
+        Writes all the queued records and stops the writer thread, a new one starts with the next record
+        '''
+        if self._thread is None:
+            return
+        self._queue.put(STOP)
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+
+    @property
+    def experiment(self):
+        return AsyncExperiment(self, self.logger.experiment)
+
+    def log_metrics(self, metrics, step=None):
+        if step is not None:
+            self.last_step = step
+        ### The metrics are read by the writer thread, later steps should not change them
+        metrics = {key: value.detach() if isinstance(value, torch.Tensor) else value for key, value in metrics.items()}
+        self.enqueue(self.logger.log_metrics, metrics, step)
+
+    def log_hyperparams(self, params, *args, **kwargs):
+        self.enqueue(self.logger.log_hyperparams, params, *args, **kwargs)
+
+    def log_graph(self, model, input_array=None):
+        ### Traces the model, so it can not wait for the writer thread while the model trains
+        self.logger.log_graph(model, input_array)
+
+    def save(self):
+        ### Writes the aggregated metrics of the last step through log_metrics
+        super().save()
+        self.enqueue(self.logger.save)
+
+    def finalize(self, status):
+        super().finalize(status)
+        self.close()
+        self.logger.finalize(status)
+
+    @property
+    def name(self):
+        return self.logger.name
+
+    @property
+    def version(self):
+        return self.logger.version
+
+    @property
+    def save_dir(self):
+        return self.logger.save_dir
+
+    @property
+    def log_dir(self):
+        return self.logger.log_dir
+
+    @property
+    def _default_hp_metric(self):
+        return self.logger._default_hp_metric
+
+    @_default_hp_metric.setter
+    def _default_hp_metric(self, value):
+        self.logger._default_hp_metric = value
+
+
+def get_logger(save_dir, async_logger=True, max_queue=10000, flush_secs=5.0, block_timeout=0.1):
+    '''
+    The logger of a pl.Trainer: the tensorboard logger the trainer would make for default_root_dir save_dir, written
+    from a background thread unless async_logger is False
+    '''
+    logger = TensorBoardLogger(save_dir, name="lightning_logs")
+    if not async_logger:
+        return logger
+    return AsyncLogger(logger, max_queue=max_queue, flush_secs=flush_secs, block_timeout=block_timeout)
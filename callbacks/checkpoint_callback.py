@@ -0,0 +1,146 @@
+import glob
+import os
+import queue
+import random
+import re
+import threading
+import warnings
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+
+def to_cpu(obj):
+    '''
+    Makes a copy of the given (nested) checkpoint in which all tensors are on the cpu,
+    so it can be written to disk while training continues.
+    '''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return obj.__class__((key, to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu(value) for value in obj)
+    return obj
+
+
+def latest_checkpoint(dirpath):
+    '''
+    Returns the path to the checkpoint of the latest epoch in dirpath, or None if there is none
+    '''
+    checkpoints = sorted(glob.glob(os.path.join(dirpath, 'checkpoint_epoch_*.ckpt')), key=checkpoint_epoch)
+    if len(checkpoints) == 0:
+        return None
+    return checkpoints[-1]
+
+
+def checkpoint_epoch(path):
+    return int(re.search(r'checkpoint_epoch_(\d+)\.ckpt$', path).group(1))
+
+
+class AsyncCheckpointCallback(pl.Callback):
+    '''
+    Saves a checkpoint every N epochs, which contains the model (sender, receiver and predictor), the optimizer,
+    the epoch and the random states. The training thread only copies the state to the cpu, writing it to disk
+    happens in a background thread. Only the last keep_last_k checkpoints are kept.
+
+    Place this callback before the ResetDatasetCallback: the epoch of the dataset is then saved before it is reset,
+    and the dataset of the next epoch is generated again after resuming.
+    '''
+
+    def __init__(self, dirpath, every_n_epochs=1, keep_last_k=2, dataset=None):
+        """
+        Inputs:
+            dirpath - Directory the checkpoints are written to
+            every_n_epochs - Only save a checkpoint every N epochs
+            keep_last_k - Number of checkpoints that are kept on disk, at least 1 to be able to resume
+            dataset - Training dataset (an EpochDataset) that continues from the saved epoch when resuming
+        """
+        super().__init__()
+        if keep_last_k < 1:
+            raise ValueError("keep_last_k should be at least 1, got {}".format(keep_last_k))
+        self.dirpath = dirpath
+        self.every_n_epochs = every_n_epochs
+        self.keep_last_k = keep_last_k
+        self.dataset = dataset
+
+        ### Created on the first save, so the callback can still be sent to spawned processes
+        self.queue = None
+        self.writer = None
+
+    def on_save_checkpoint(self, trainer, pl_module):
+        state = {
+            'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            state['cuda'] = torch.cuda.get_rng_state_all()
+        if self.dataset is not None:
+            state['dataset_epoch'] = int(self.dataset.epoch[0])
+        return state
+
+    def on_load_checkpoint(self, checkpointed_state):
+        ### Generate the same dataset as the interrupted run did after this checkpoint
+        if self.dataset is not None and 'dataset_epoch' in checkpointed_state:
+            self.dataset.set_epoch(checkpointed_state['dataset_epoch'])
+            self.dataset.reset()
+
+        ### With data parallel training every rank keeps its own random stream, only the weights are restored
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return
+        random.setstate(checkpointed_state['python'])
+        np.random.set_state(checkpointed_state['numpy'])
+        torch.set_rng_state(checkpointed_state['torch'])
+        if 'cuda' in checkpointed_state and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(checkpointed_state['cuda'])
+
+    def on_epoch_end(self, trainer, pl_module):
+        """
+        This function is called after every epoch.
+        Queue a checkpoint every N epochs.
+        """
+        if (trainer.current_epoch + 1) % self.every_n_epochs != 0 or trainer.global_rank != 0:
+            return
+        ### Also restarts the writer if its thread died
+        if self.writer is None or not self.writer.is_alive():
+            os.makedirs(self.dirpath, exist_ok=True)
+            ### Holds at most one checkpoint, if the writer is still busy the next save is skipped instead of waiting
+            self.queue = queue.Queue(maxsize=1)
+            self.writer = threading.Thread(target=self.write_checkpoints, daemon=True)
+            self.writer.start()
+
+        if self.queue.full():
+            print("Checkpoint of epoch {} skipped, the previous one is still being written".format(
+                trainer.current_epoch))
+            return
+
+        checkpoint = to_cpu(trainer.checkpoint_connector.dump_checkpoint())
+
+        self.queue.put((trainer.current_epoch, checkpoint))
+
+    def write_checkpoints(self):
+        while True:
+            epoch, checkpoint = self.queue.get()
+            try:
+                path = os.path.join(self.dirpath, 'checkpoint_epoch_{:04d}.ckpt'.format(epoch))
+                ### Write to a temporary file first, so a killed run never leaves a broken checkpoint behind
+                torch.save(checkpoint, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                self.rotate()
+            except Exception as e:
+                ### A checkpoint that can not be written should not stop the writing of the next ones
+                warnings.warn("Checkpoint of epoch {} could not be written: {}".format(epoch, e))
+            finally:
+                self.queue.task_done()
+
+    def rotate(self):
+        checkpoints = sorted(glob.glob(os.path.join(self.dirpath, 'checkpoint_epoch_*.ckpt')), key=checkpoint_epoch)
+        for path in checkpoints[:-self.keep_last_k]:
+            os.remove(path)
+
+    def on_train_end(self, trainer, pl_module):
+        ### Wait for the last checkpoint to be on disk
+        if self.queue is not None and self.writer.is_alive():
+            self.queue.join()
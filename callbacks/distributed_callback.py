@@ -0,0 +1,78 @@
+import pytorch_lightning as pl
+import torch
+
+
+def is_distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def all_gather_cat(tensor):
+    '''
+    Concatenates the tensors of all the ranks, they should have the same shape on every rank
+    '''
+    if not is_distributed():
+        return tensor
+    gathered = [torch.zeros_like(tensor) for _ in range(torch.distributed.get_world_size())]
+    torch.distributed.all_gather(gathered, tensor.contiguous())
+    return torch.cat(gathered)
+
+
+def get_distributed_trainer_kwargs(num_processes=1):
+    '''
+    The arguments of pl.Trainer for training with num_processes data parallel processes.
+    On the cpu the processes communicate with gloo.
+    The datasets are sharded by the DistributedDatasetCallback, so lightning should not replace the samplers.
+    '''
+    if num_processes <= 1:
+        return {"gpus": 1 if torch.cuda.is_available() else 0}
+    if torch.cuda.is_available():
+        return {"gpus": num_processes, "accelerator": "ddp_spawn", "replace_sampler_ddp": False}
+    return {"num_processes": num_processes, "accelerator": "ddp_cpu", "replace_sampler_ddp": False}
+
+
+class DistributedDatasetCallback(pl.Callback):
+    '''
+    Makes every dataset generate only the items of an epoch that belong to the rank, every rank takes every
+    world_size-th item.
+    The setup hook runs in the parent before the processes are spawned, so the datasets are sharded in the hooks that
+    run in the spawned processes, with the rank of the process group. Sharding again with the same rank does nothing.
+    '''
+
+    def __init__(self, datasets):
+        super().__init__()
+        self.datasets = datasets
+
+    def shard(self):
+        if not is_distributed():
+            return
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        for dataset in self.datasets:
+            if (dataset.rank, dataset.world_size) != (rank, world_size):
+                dataset.shard(rank, world_size)
+
+    def on_pretrain_routine_start(self, trainer, pl_module):
+        self.shard()
+
+    def on_sanity_check_start(self, trainer, pl_module):
+        self.shard()
+
+    def on_train_start(self, trainer, pl_module):
+        self.shard()
+
+
+class SaveResultsCallback(pl.Callback):
+    '''
+    Saves the final metrics of rank 0 to a file, as the spawned processes can not return them to the parent.
+    '''
+
+    def __init__(self, path, measure_callbacks):
+        super().__init__()
+        self.path = path
+        self.measure_callbacks = measure_callbacks
+
+    def on_train_end(self, trainer, pl_module):
+        if trainer.global_rank != 0:
+            return
+        results = {key: value.item() if isinstance(value, torch.Tensor) else value
+                   for key, value in trainer.callback_metrics.items()}
+        torch.save({**results, **self.measure_callbacks.latest}, self.path)
@@ -4,6 +4,27 @@ import pytorch_lightning as pl
 import numpy as np
 import torch
 
+from callbacks.distributed_callback import all_gather_cat, is_distributed
+from callbacks.profiler_callback import profile_phase
+from decoding import use_decode_mode
+from message import to_indices
+
+
+def to_device(receiver_imgs, device):
+    '''
+    Moves the candidates of the receiver to the device, they are either a list of tensors or one tensor
+    '''
+    if isinstance(receiver_imgs, torch.Tensor):
+        return receiver_imgs.to(device)
+    return [receiver_img.to(device) for receiver_img in receiver_imgs]
+
+
+def eval_decode_mode(pl_module):
+    '''
+    The decode mode the sender of the game uses outside of training
+    '''
+    return getattr(pl_module, 'eval_decode_mode', 'argmax')
+
 
 class MsgCallback(pl.Callback):
     '''
@@ -33,10 +54,9 @@ class MsgCallback(pl.Callback):
         """
         if (trainer.current_epoch + 1) % self.every_n_epochs == 0:
             self.receiver_imgs = self.receiver_imgs.to(pl_module.device)
-            choices = []
-            for choice in self.sender_choices:
-                choices.append(choice.to(pl_module.device))
-            msg, msg_packed, out, out_probs, prediction_logits, prediction_probs = pl_module.forward(self.receiver_imgs, choices)
+            choices = to_device(self.sender_choices, pl_module.device)
+            with use_decode_mode(pl_module.sender, eval_decode_mode(pl_module)):
+                msg, msg_packed, out, out_probs, prediction_logits, prediction_probs = pl_module.forward(self.receiver_imgs, choices)
 
             logger = trainer.logger.experiment
 
@@ -46,7 +66,7 @@ class MsgCallback(pl.Callback):
 
     def msg_to_text(self, msg):
 
-        indices = torch.argmax(msg.permute(1,0,2), dim=-1)
+        indices = to_indices(msg).permute(1,0)
 
         indices_numpy = indices.cpu().numpy()
 
@@ -84,10 +104,9 @@ class MsgFrequencyCallback(pl.Callback):
         """
         if (trainer.current_epoch + 1) % self.every_n_epochs == 0:
             self.receiver_imgs = self.receiver_imgs.to(pl_module.device)
-            choices = []
-            for choice in self.sender_choices:
-                choices.append(choice.to(pl_module.device))
-            msg, msg_packed, out, out_probs, prediction_logits, prediction_probs = pl_module.forward(self.receiver_imgs, choices)
+            choices = to_device(self.sender_choices, pl_module.device)
+            with use_decode_mode(pl_module.sender, eval_decode_mode(pl_module)):
+                msg, msg_packed, out, out_probs, prediction_logits, prediction_probs = pl_module.forward(self.receiver_imgs, choices)
 
             logger = trainer.logger.experiment
 
@@ -96,7 +115,7 @@ class MsgFrequencyCallback(pl.Callback):
             logger.add_text('freqs', freq, trainer.current_epoch)
 
     def msg_to_freq(self, msg):
-        indices = list(torch.argmax(msg, dim=-1).flatten().cpu().numpy())
+        indices = list(to_indices(msg).flatten().cpu().numpy())
         counter = Counter(indices)
 
         return str([(key, value) for key, value in sorted(counter.items())])
@@ -131,26 +150,84 @@ class MeasureCallbacks(pl.Callback):
         """
 
         if (trainer.current_epoch + 1) % self.every_n_epochs == 0:
+            with profile_phase('measures'), use_decode_mode(pl_module.sender, eval_decode_mode(pl_module)):
+                ## We generate all the messages
+                msgs = []
 
-            ## We generate all the messages
-            msgs = []
+                for sender_imgs, receiver_imgs, target in self.dataloader:
+                    sender_imgs = sender_imgs.to(pl_module.device)
+                    receiver_imgs = to_device(receiver_imgs, pl_module.device)
 
-            for sender_imgs, receiver_imgs, target in self.dataloader:
-                sender_imgs = sender_imgs.to(pl_module.device)
-                receiver_imgs = [receiver_img.to(pl_module.device) for receiver_img in receiver_imgs]
+                    msg, msg_packed, out, out_probs, prediction_logits, prediction_probs = pl_module.forward(sender_imgs, receiver_imgs)
 
-                msg, msg_packed, out, out_probs, prediction_logits, prediction_probs = pl_module.forward(sender_imgs, receiver_imgs)
+                    #Make batch first
+                    msg = to_indices(msg).permute(1,0)
+                    msgs.append(msg)
 
-                #Make batch first
-                msg = torch.argmax(msg, dim=-1).permute(1,0)
-                msgs.append(msg)
+                ### With data parallel training every rank only has its own part of the test set
+                msgs = all_gather_cat(torch.cat(msgs))
+                logger = trainer.logger.experiment
+                for measure in self.measures:
+                    m = measure.make_measure(msgs)
+                    self.latest[measure.name] = m
+                    logger.add_scalar(measure.name, m, trainer.current_epoch)
 
-            msgs = torch.cat(msgs)
-            logger = trainer.logger.experiment
-            for measure in self.measures:
-                m = measure.make_measure(msgs)
-                self.latest[measure.name] = m
-                logger.add_scalar(measure.name, m, trainer.current_epoch)
+
+class MessageTableCallback(pl.Callback):
+    '''
+    Computes the measures on the message of every distinct sender input instead of on the whole test set.
+    The sender runs once per class in argmax mode, the measures weigh every message with the frequency of its class.
+    '''
+
+    def __init__(self, dataset, measures, every_n_epochs=1, batch_size=1024):
+        """
+        Inputs:
+            dataset - Dataset with a class_table, the classes and frequencies of its targets are used
+            measures - The measures that are computed on the table
+            every_n_epochs - Only compute the measures every N epochs
+            batch_size - Number of classes that are sent through the sender at once
+        """
+        super().__init__()
+        self.every_n_epochs = every_n_epochs
+        self.measures = measures
+        self.batch_size = batch_size
+
+        self.inputs, self.frequencies = dataset.class_table()
+        ### The class -> message table of the last evaluation, batch first
+        self.table = None
+
+        self.latest = {
+            measure.name: 0 for measure in measures
+        }
+
+    @torch.no_grad()
+    def make_table(self, sender, device):
+        training = sender.training
+        sender.eval()
+
+        msgs = []
+        with use_decode_mode(sender, 'argmax'):
+            for i in range(0, len(self.inputs), self.batch_size):
+                msg = sender(self.inputs[i:i + self.batch_size].to(device))
+                msgs.append(torch.argmax(msg, dim=-1).permute(1, 0))
+
+        sender.train(training)
+        return torch.cat(msgs)
+
+    def on_epoch_end(self, trainer, pl_module):
+        """
+        This function is called after every epoch.
+        Computes the table and the measures every N epochs.
+        """
+        if (trainer.current_epoch + 1) % self.every_n_epochs == 0:
+            with profile_phase('measures'):
+                ### Every rank has all the classes, so no gathering is needed
+                self.table = self.make_table(pl_module.sender, pl_module.device)
+                logger = trainer.logger.experiment
+                for measure in self.measures:
+                    m = measure.make_measure(self.table, weights=self.frequencies)
+                    self.latest[measure.name] = m
+                    logger.add_scalar(measure.name, m, trainer.current_epoch)
 
 
 class Measure:
@@ -158,7 +235,11 @@ class Measure:
     def __init__(self, name):
         self.name = name
 
-    def make_measure(self, msgs):
+    def make_measure(self, msgs, weights=None):
+        '''
+        :param msgs: the messages as symbol indices, batch first
+        :param weights: how often every message occurs, every message counts once if None
+        '''
         pass
 
 
@@ -175,11 +256,14 @@ class EntropyMeasure(Measure):
         self.stop_symbol = stop_symbol
         self.n_gram = n_gram
 
-    def make_measure(self, msgs):
+    def make_measure(self, msgs, weights=None):
 
-        n_grams = self.create_n_grams(msgs)
+        n_grams, n_gram_weights = self.create_n_grams(msgs, weights)
 
-        count = [val for key, val in Counter(n_grams).items()]
+        counter = Counter()
+        for n_gram, weight in zip(n_grams, n_gram_weights):
+            counter[n_gram] += weight
+        count = [val for key, val in counter.items() if val > 0]
 
         total = sum(count)
 
@@ -187,22 +271,31 @@ class EntropyMeasure(Measure):
 
         return float(-sum([p * np.log2(p) for p in percentages]))
 
-    def create_n_grams(self, msgs):
+    def create_n_grams(self, msgs, weights=None):
+        '''
+        Returns the n grams of the messages and for every n gram the weight of its message
+        '''
+        if weights is None:
+            weights = np.ones(len(msgs))
+        else:
+            weights = weights.cpu().numpy()
+
         if self.n_gram == 1:
-            msgs = msgs.flatten()
-            msgs = list(msgs.cpu().numpy())
-            return msgs
+            n_grams = list(msgs.flatten().cpu().numpy())
+            return n_grams, list(np.repeat(weights, msgs.shape[1]))
 
         msgs_list = list(msgs.cpu().numpy())
         result = []
+        result_weights = []
         if self.n_gram > 1:
             l = len(msgs_list[0])
-            for msg in msgs_list:
+            for msg, weight in zip(msgs_list, weights):
                 for i in range(l - self.n_gram):
                     if self.stop_symbol != msg[i]:
                         result.append(tuple(msg[i:i + self.n_gram]))
+                        result_weights.append(weight)
 
-        return result
+        return result, result_weights
 
 
 def clean(msg, stop_symbol):
@@ -218,7 +311,11 @@ class MsgLength(Measure):
         super().__init__(name)
         self.stop_symbol = stop_symbol
 
-    def make_measure(self, msg):
+    def make_measure(self, msg, weights=None):
+        if weights is not None:
+            lengths = (~msg.ge(self.stop_symbol)).sum(dim=-1).float()
+            weights = weights.to(lengths.device)
+            return 1.0 + float((lengths * weights).sum() / weights.sum())
 
         msgs = clean(msg, self.stop_symbol)
 
@@ -240,7 +337,10 @@ class DistinctSymbolMeasure(Measure):
         super().__init__(name)
         self.stop_symbol = stop_symbol
 
-    def make_measure(self, msgs):
+    def make_measure(self, msgs, weights=None):
+        if weights is not None:
+            ### Messages of classes that never occur do not count
+            msgs = msgs[weights.to(msgs.device) > 0]
         return float(len(torch.unique(msgs)))
 
 
@@ -257,5 +357,9 @@ class ResetDatasetCallback(pl.Callback):
         Call the save_and_sample function every N epochs.
         """
         if (trainer.current_epoch + 1) % self.every_n_epochs == 0:
-            self.dataset.reset()
+            with profile_phase('dataset_reset'):
+                self.dataset.reset()
+            ### All ranks start the next epoch with a new dataset
+            if is_distributed():
+                torch.distributed.barrier()
 
@@ -0,0 +1,186 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+### The profiler that is currently collecting timings. None means that profiling is disabled.
+_active_profiler = None
+
+### Shared no-op scope, so a disabled profiler costs a single global lookup per phase.
+_null_scope = nullcontext()
+
+
+def profile_phase(name):
+    '''
+    Returns a context manager that times the code inside it as the phase "name".
+    When no ProfilerCallback is active this is a shared no-op context.
+    :param name: name of the phase (sender, receiver, predictor, ...)
+    '''
+    if _active_profiler is None:
+        return _null_scope
+    return _PhaseScope(_active_profiler, name)
+
+
+class _PhaseScope:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record_function = torch.autograd.profiler.record_function(name)
+
+    def __enter__(self):
+        self.record_function.__enter__()
+        self.profiler.depth += 1
+        self.start = self.profiler.timestamp()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.depth -= 1
+        ### Only the outermost phase is timed, so the measures do not count the forward passes they make
+        if self.profiler.depth == 0:
+            end = self.profiler.timestamp()
+            self.profiler.add_timing(self.name, self.start, end)
+            self.profiler.last_phase_end = end
+        self.record_function.__exit__(*args)
+        return False
+
+
+class ProfilerCallback(pl.Callback):
+    '''
+    Times every phase of a training step (data, sender, pack, receiver, predictor, loss, backward, optimizer) and the
+    end-of-epoch work of the other callbacks. Phases are marked with profile_phase scopes, the backward pass with the
+    backward hooks and the optimizer phase is the rest of the step after the backward pass.
+    Put this callback last in the list so that the end-of-epoch phases of the other callbacks are included.
+    '''
+
+    def __init__(self, percentiles=(50, 90, 99), trace_steps=(), trace_dir='traces'):
+        """
+        Inputs:
+            percentiles - The percentiles of the phase timings (in ms) that are logged every epoch
+            trace_steps - Global steps for which a chrome trace is written to disk
+            trace_dir - Directory the chrome traces are written to
+        """
+        super().__init__()
+        self.percentiles = percentiles
+        self.trace_steps = set(trace_steps)
+        self.trace_dir = trace_dir
+
+        self.use_cuda = torch.cuda.is_available()
+        self.timings = defaultdict(list)
+        self.pending = []
+        self.depth = 0
+        self.paused = False
+        self.batch_start = None
+        self.last_batch_end = None
+        self.last_phase_end = None
+        self.backward_start = None
+        self.backward_end = None
+        self.trace = None
+
+    def timestamp(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def add_timing(self, name, start, end):
+        ### Cuda events can only be read out after a synchronize, so they are resolved at the end of the step
+        if not self.paused:
+            self.pending.append((name, start, end))
+
+    def resolve(self):
+        '''
+        Converts the pending timings to milliseconds and stores them
+        :return: list of (name, elapsed) pairs that were resolved
+        '''
+        if self.use_cuda and len(self.pending) > 0:
+            torch.cuda.synchronize()
+        resolved = []
+        for name, start, end in self.pending:
+            if self.use_cuda:
+                elapsed = start.elapsed_time(end)
+            else:
+                elapsed = (end - start) * 1000
+            self.timings[name].append(elapsed)
+            resolved.append((name, elapsed))
+        self.pending = []
+        return resolved
+
+    def on_train_start(self, trainer, pl_module):
+        global _active_profiler
+        _active_profiler = self
+
+    def on_train_end(self, trainer, pl_module):
+        global _active_profiler
+        _active_profiler = None
+        self.stop_trace(trainer)
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx):
+        if trainer.global_step in self.trace_steps:
+            self.trace = torch.autograd.profiler.profile(use_cuda=self.use_cuda)
+            self.trace.__enter__()
+
+        self.batch_start = self.timestamp()
+        if self.last_batch_end is not None:
+            self.add_timing('data', self.last_batch_end, self.batch_start)
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        self.backward_start = self.timestamp()
+
+    def on_after_backward(self, trainer, pl_module):
+        ### Lightning versions without the on_before_backward hook start the backward pass after the last phase of the
+        ### forward, which is the loss
+        start = self.backward_start if self.backward_start is not None else self.last_phase_end
+        self.backward_end = self.timestamp()
+        if start is not None:
+            self.add_timing('backward', start, self.backward_end)
+        self.backward_start = None
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx):
+        end = self.timestamp()
+        self.add_timing('step', self.batch_start, end)
+        if self.backward_end is not None:
+            ### The optimizer step and the rest of the training step after the backward pass
+            self.add_timing('optimizer', self.backward_end, end)
+        self.last_batch_end = self.timestamp()
+        self.last_phase_end = None
+        self.backward_end = None
+
+        self.resolve()
+
+        self.stop_trace(trainer)
+
+    def stop_trace(self, trainer):
+        if self.trace is None:
+            return
+        self.trace.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        self.trace.export_chrome_trace(os.path.join(self.trace_dir, 'trace_step_{}.json'.format(trainer.global_step)))
+        self.trace = None
+
+    def on_validation_start(self, trainer, pl_module):
+        self.paused = True
+
+    def on_validation_end(self, trainer, pl_module):
+        self.paused = False
+
+    def on_epoch_end(self, trainer, pl_module):
+        """
+        Logs the percentiles of every phase of this epoch and starts collecting again.
+        """
+        self.resolve()
+        self.last_batch_end = None
+
+        logger = trainer.logger.experiment
+        for name, values in self.timings.items():
+            if len(values) == 0:
+                continue
+            for percentile, value in zip(self.percentiles, np.percentile(values, self.percentiles)):
+                logger.add_scalar('profile/{}_p{}_ms'.format(name, percentile), value, trainer.current_epoch)
+
+        self.timings = defaultdict(list)
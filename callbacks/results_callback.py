@@ -0,0 +1,47 @@
+import pytorch_lightning as pl
+import torch
+
+from results_store import ResultsStore, config_metrics
+
+
+class ResultsStoreCallback(pl.Callback):
+    '''
+    Adds the metrics of the config to the results store at the end of every epoch, so the store holds the whole
+    learning curve of a run and not only its final results.
+    Put it after the measure callbacks, so the measures of the epoch are included.
+    '''
+
+    def __init__(self, store_path, config, seed, measure_callbacks=None):
+        """
+        Inputs:
+            store_path - Path of the sqlite file of the ResultsStore
+            config - Config of the run, its metrics are stored, see results_store.config_metrics
+            seed - Seed of the run
+            measure_callbacks - Callback with the latest message measures, e.g. MeasureCallbacks
+        """
+        super().__init__()
+        self.store_path = store_path
+        self.config = config
+        self.seed = seed
+        self.measure_callbacks = measure_callbacks
+
+        ### Opened on the first write, so the callback can still be sent to spawned processes
+        self.store = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["store"] = None
+        return state
+
+    def on_epoch_end(self, trainer, pl_module):
+        if trainer.global_rank != 0 or getattr(trainer, "running_sanity_check", False):
+            return
+        if self.store is None:
+            self.store = ResultsStore(self.store_path)
+
+        metrics = dict(trainer.callback_metrics)
+        if self.measure_callbacks is not None:
+            metrics.update(self.measure_callbacks.latest)
+        results = {metric: metrics[metric].item() if isinstance(metrics[metric], torch.Tensor) else metrics[metric]
+                   for metric in config_metrics(self.config) if metric in metrics}
+        self.store.add_results(self.config, self.seed, results, epoch=trainer.current_epoch)
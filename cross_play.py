@@ -0,0 +1,185 @@
+import argparse
+
+import numpy as np
+import torch
+import yaml
+
+from attribute_game.pl_model import AttributeModelMerged, unpack_batch
+from attribute_game.receiver import ReceiverFixed
+from attribute_game.utils import pack
+from callbacks.checkpoint_callback import latest_checkpoint
+from datasets.AttributeDataset import get_attribute_loaders
+from decoding import use_decode_mode
+from experiment_utils import load_trained_game, get_datasets, get_batch_size, get_checkpoint_dir
+from message import Message
+
+
+def get_episodes(dataloader, in_batch_negatives=False):
+    '''
+    One pass over the dataloader, kept in memory, so every pair of agents plays the same episodes
+    :return: list of (sender inputs, candidates, targets) batches
+    '''
+    return [unpack_batch(batch, torch.device("cpu"), in_batch_negatives) for batch in dataloader]
+
+
+@torch.no_grad()
+def get_messages(games, episodes, decode_mode='argmax'):
+    '''
+    The message of every sender for every episode, every sender runs once per batch
+    :return: list with for every game a list with the Message of every batch
+    '''
+    messages = []
+    for game in games:
+        with use_decode_mode(game.sender, decode_mode):
+            messages.append([Message(game.sender(sender_input)) for sender_input, _, _ in episodes])
+    return messages
+
+
+class StackedReceiverFixed:
+    '''
+    N ReceiverFixed receivers with their weights stacked, which score the messages of all senders at once.
+    The candidates are encoded once per receiver, the first layer of the prediction head is split into its candidate
+    part, which does not depend on the message, and its message part, so only the message part and the last layer
+    are computed for every (sender, receiver) pair, with batched matrix products.
+    '''
+
+    @torch.no_grad()
+    def __init__(self, receivers):
+        self.receivers = receivers
+        self.n_symbols = receivers[0].n_symbols
+        self.n_xs = receivers[0].n_xs
+        hidden = receivers[0].hidden_state_size
+
+        msg_layers = [receiver.msg_to_hidden[2] for receiver in receivers]
+        self.msg_in_features = msg_layers[0].in_features
+        ### All the message weights in one table, the rows of receiver r start at r * msg_in_features
+        self.msg_weight = torch.cat([layer.weight.t() for layer in msg_layers])
+        self.msg_bias = torch.stack([layer.bias for layer in msg_layers])
+
+        first = torch.stack([receiver.to_prediction[1].weight for receiver in receivers])
+        self.candidate_weight = first[:, :, :hidden * self.n_xs]
+        self.message_weight = first[:, :, hidden * self.n_xs:]
+        self.first_bias = torch.stack([receiver.to_prediction[1].bias for receiver in receivers])
+        self.last_weight = torch.stack([receiver.to_prediction[3].weight for receiver in receivers])
+        self.last_bias = torch.stack([receiver.to_prediction[3].bias for receiver in receivers])
+
+    def encode_candidates(self, xs):
+        '''
+        The candidate part of the first layer of the prediction head, [receivers, batch, hidden]
+        '''
+        candidates = torch.stack([torch.cat([receiver.feature_encoder(x) for x in xs], dim=1)
+                                  for receiver in self.receivers])
+        return torch.einsum('rbi,rhi->rbh', torch.relu(candidates), self.candidate_weight) + self.first_bias[:, None]
+
+    def encode_messages(self, indices):
+        '''
+        The hidden states of the messages of all senders for all receivers, [receivers, senders, batch, hidden]
+        :param indices: [senders, msg_len, batch] symbols
+        '''
+        n_senders, msg_len, batch_size = indices.shape
+        ### The flattened layout of ReceiverFixed, see message.linear_of_flat_message
+        columns = indices.reshape(n_senders, batch_size, msg_len) + torch.arange(msg_len) * self.n_symbols
+        offsets = torch.arange(len(self.receivers)) * self.msg_in_features
+        columns = columns.unsqueeze(dim=0) + offsets[:, None, None, None]
+        hidden = torch.nn.functional.embedding_bag(columns.reshape(-1, msg_len), self.msg_weight, mode='sum')
+        return hidden.reshape(len(self.receivers), n_senders, batch_size, -1) + self.msg_bias[:, None, None]
+
+    @torch.no_grad()
+    def __call__(self, xs, indices):
+        '''
+        The choices of every receiver for the messages of every sender, [receivers, senders, batch]
+        '''
+        hidden = self.encode_candidates(xs).unsqueeze(dim=1) + torch.einsum(
+            'rsbi,rhi->rsbh', torch.relu(self.encode_messages(indices)), self.message_weight)
+        out = torch.einsum('rsbi,rki->rsbk', torch.relu(hidden), self.last_weight) + self.last_bias[:, None, None]
+        return torch.argmax(out, dim=-1)
+
+
+@torch.no_grad()
+def receiver_choices(game, xs, messages):
+    '''
+    The choices of one receiver for the messages of all senders, with all the senders in a single batch.
+    Works for every receiver, used when the receivers can not be stacked.
+    :param messages: the Message of every sender for the same episodes
+    :return: [senders, batch]
+    '''
+    n_senders = len(messages)
+    one_hot = torch.cat([msg.one_hot for msg in messages], dim=1)
+    msg = Message(one_hot)
+    if game.pack_message:
+        msg = pack(msg, game.sender.msg_len)
+    ### A tensor of candidates is shared by all messages (in batch negatives), a list has candidates per message
+    if isinstance(xs, (list, tuple)):
+        xs = [torch.cat([x] * n_senders) for x in xs]
+    _, out_probs = game.receiver(xs, msg)
+    return torch.argmax(out_probs, dim=-1).reshape(n_senders, -1)
+
+
+def cross_play(games, episodes, decode_mode='argmax'):
+    '''
+    Plays every sender with every receiver on the same episodes
+    :return: [senders, receivers] accuracy matrix
+    '''
+    if any(isinstance(game, AttributeModelMerged) for game in games):
+        raise ValueError("The receivers of merged games read the message with their own predictor, "
+                         "they can not be paired with other senders")
+    for game in games:
+        game.eval()
+
+    messages = get_messages(games, episodes, decode_mode)
+    stacked = None
+    if all(type(game.receiver) == ReceiverFixed for game in games):
+        stacked = StackedReceiverFixed([game.receiver for game in games])
+
+    correct = torch.zeros(len(games), len(games))
+    total = 0
+    for i, (_, xs, target) in enumerate(episodes):
+        batch_messages = [sender_messages[i] for sender_messages in messages]
+        if stacked is not None:
+            indices = torch.stack([msg.indices for msg in batch_messages])
+            ### [receivers, senders, batch] to [senders, receivers, batch]
+            choices = stacked(xs, indices).transpose(0, 1)
+        else:
+            choices = torch.stack([receiver_choices(game, xs, batch_messages) for game in games], dim=1)
+        correct += (choices == target).sum(dim=-1).float()
+        total += len(target)
+    return (correct / total).numpy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pair the sender of every run with the receiver of every other run '
+                                                 'of a config')
+
+    parser.add_argument('--config', default="config/example_experiment.yaml", required=False)
+    parser.add_argument('--checkpoints', nargs='+', default=None, required=False,
+                        help='Checkpoints of the runs, the latest checkpoint of every seed of the config if not given')
+    parser.add_argument('--batch_size', type=int, default=256, required=False,
+                        help='Episodes per batch, the stacked receivers hold senders * receivers * batch_size hidden states')
+    parser.add_argument('--out', default=None, required=False, help='csv file for the accuracy matrix')
+
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    checkpoints = args.checkpoints
+    if checkpoints is None:
+        checkpoints = [latest_checkpoint(get_checkpoint_dir(config, seed)) for seed in range(config["n_runs"])]
+        checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint is not None]
+    games = [load_trained_game(config, checkpoint) for checkpoint in checkpoints]
+
+    in_batch_negatives = config.get("in_batch_negatives", False)
+    batch_size = get_batch_size(config) if in_batch_negatives else args.batch_size
+    _, test_dataloader = get_attribute_loaders(*get_datasets(config), batch_size=batch_size,
+                                               in_batch_negatives=in_batch_negatives)
+    episodes = get_episodes(test_dataloader, in_batch_negatives)
+
+    accuracy = cross_play(games, episodes, decode_mode=config.get("eval_decode_mode", "argmax"))
+
+    print("Rows are senders, columns receivers")
+    print(np.array2string(accuracy, precision=3))
+    off_diagonal = accuracy[~np.eye(len(accuracy), dtype=bool)]
+    print("self play: {:.3f}, cross play: {:.3f}".format(np.diag(accuracy).mean(),
+                                                          off_diagonal.mean() if len(off_diagonal) else float('nan')))
+    if args.out:
+        np.savetxt(args.out, accuracy, delimiter=",", fmt="%.4f")
@@ -1,12 +1,55 @@
-from itertools import permutations, product
-
 import torch
 from torch.utils.data import Dataset, DataLoader
 
 import numpy as np
 
+from datasets.loading import EpochDataset, get_loader_kwargs
+
+
+def place_values(n_attributes, size_attributes):
+    '''
+    The value of every attribute in a class id. A class id is the number with the attribute values as its digits in
+    base size_attributes, the first attribute being the most significant, which is the order of
+    itertools.product over the attribute values.
+    '''
+    return size_attributes ** np.arange(n_attributes - 1, -1, -1, dtype=np.int64)
+
+
+def decode_classes(ids, n_attributes, size_attributes):
+    '''
+    The [len(ids), n_attributes] attribute values of the given class ids
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    return (ids[:, None] // place_values(n_attributes, size_attributes)) % size_attributes
+
+
+def encode_classes(attributes, n_attributes, size_attributes):
+    '''
+    The class ids of [n, n_attributes] attribute values
+    '''
+    return np.asarray(attributes, dtype=np.int64) @ place_values(n_attributes, size_attributes)
+
+
+def get_held_out_classes(n_attributes, size_attributes, n_remove_classes):
+    '''
+    The class ids of the test set: the classes with the same value i for every attribute, for the first
+    n_remove_classes values
+    '''
+    return encode_classes(np.repeat(np.arange(n_remove_classes)[:, None], n_attributes, axis=1),
+                          n_attributes, size_attributes)
+
+
+def classes_to_one_hot(ids, n_attributes, size_attributes):
+    '''
+    The [len(ids), n_attributes * size_attributes] sender inputs of the given class ids
+    '''
+    columns = decode_classes(ids, n_attributes, size_attributes) + np.arange(n_attributes) * size_attributes
+    one_hot = torch.zeros(len(columns), n_attributes * size_attributes)
+    one_hot.scatter_(1, torch.from_numpy(columns), 1)
+    return one_hot
+
 
-class AttributeDataset(Dataset):
+class AttributeDataset(EpochDataset):
     '''
     The dataset for a simple attribute passing game.
     '''
@@ -19,49 +62,38 @@ class AttributeDataset(Dataset):
         self.size_attributes = size_attributes
         self.n_classes = size_attributes ** n_attributes
 
-        self.attribute_indexes = [
-            [i for i in range(self.size_attributes)] for j in range(self.n_attributes)
-        ]
+        self.init_epochs()
 
-        self.permutations = list(product(*self.attribute_indexes))
-        self.class_indexes = {i: att for i, att in enumerate(self.permutations)}
-
-        self.sender_items, self.targets = self.generate_items()
-
-    def generate_items(self):
-        # First generate the pairs we want
-        sender_items = []
-        receiver_items = []
-        targets = np.random.choice(self.n_classes, self.samples_per_epoch, replace=True)
-        sender_items = [self.to_tensor(self.class_indexes[t]) for t in targets]
-
-        return sender_items, targets
+    def generate_item(self, rng):
+        target = int(rng.integers(self.n_classes))
+        return self.to_tensor(target), target
 
     def __len__(self):
         return self.samples_per_epoch
 
     def __getitem__(self, idx):
-        sender_item = self.sender_items[idx]
+        return self.generate_item(self.rng(self.global_index(idx)))
 
-        return sender_item, self.targets[idx]
+    def to_tensor(self, class_id):
+        return classes_to_one_hot([class_id], self.n_attributes, self.size_attributes)[0]
 
-    def to_tensor(self, attributes):
-        attribute_tensor = torch.zeros(self.n_attributes * self.size_attributes)
-        for i, att in enumerate(attributes):
-            attribute_tensor[i * self.size_attributes + att] = 1
-        return attribute_tensor
 
-    def reset(self):
-        self.sender_items, self.receiver_items, self.targets = self.generate_items()
-
-
-class AttributeGameDataset(Dataset):
+class AttributeGameDataset(EpochDataset):
     '''
     The dataset for a simple attribute passing game.
+    The classes are only handled as ids, so the size of the attribute space does not matter.
     '''
 
-    def __init__(self, n_attributes, size_attributes, n_receiver=3, samples_per_epoch=int(10e4), transform=None, n_remove_classes=0, train=True):
+    def __init__(self, n_attributes, size_attributes, n_receiver=3, samples_per_epoch=int(10e4), transform=None, n_remove_classes=0, train=True,
+                 class_ids=False, targets_only=False):
+        '''
+        :param class_ids: yield the class ids instead of the one hot attributes, for models with a ClassEmbeddingEncoder
+        :param targets_only: only draw the targets, for training with a distractor sampler that draws the candidates on
+        the device, see attribute_game.distractor_sampler.ConfusionSampler. The items have no candidates and target 0.
+        '''
         self.samples_per_epoch = samples_per_epoch
+        self.class_ids = class_ids
+        self.targets_only = targets_only
         self.n_receiver = n_receiver
         self.transform = transform
         self.n_attributes = n_attributes
@@ -71,74 +103,222 @@ class AttributeGameDataset(Dataset):
         self.n_classes = (size_attributes ** n_attributes)
         self.n_remove_classes = n_remove_classes
 
-        self.attribute_indexes = [
-            [i for i in range(self.size_attributes)] for j in range(self.n_attributes)
-        ]
-
-        self.permutations = list(product(*self.attribute_indexes))
-        self.class_indexes = {i: att for i, att in enumerate(self.permutations)}
-
-        remove_classes_train = set([tuple([i for j in range(n_attributes)]) for i in range(size_attributes)][:n_remove_classes])
-        self.keep_classes = []
-        if train or n_remove_classes==0:
-            for i in range(len(self.permutations)):
-                if self.permutations[i] not in remove_classes_train:
-                    self.keep_classes.append(i)          
+        self.held_out_classes = get_held_out_classes(n_attributes, size_attributes, n_remove_classes)
+        ### The train set (or both sets when nothing is held out) keeps all the other classes
+        self.keep_held_out = not train and n_remove_classes > 0
+        if self.keep_held_out:
+            self.n_keep_classes = n_remove_classes
         else:
-            for i in range(len(self.permutations)):
-                if self.permutations[i] in remove_classes_train:
-                    self.keep_classes.append(i)
-        
-
-        self.sender_items, self.receiver_items, self.targets = self.generate_items()
-
-    def generate_items(self):
-        # First generate the pairs we want
-        sender_items = []
-        receiver_items = []
-        targets = []
-        for i in range(self.samples_per_epoch):
-            item_ids = np.random.choice(self.keep_classes, self.n_receiver, replace=False) 
-            items = [
-                self.to_tensor(self.class_indexes[id]) for id in item_ids
-            ]
-            target_index = int(np.random.choice(self.n_receiver, 1)[0])
-            sender_items.append(items[target_index])
-            receiver_items.append(items)
-            targets.append(target_index)
-
-        return sender_items, receiver_items, targets
+            self.n_keep_classes = self.n_classes - n_remove_classes
+
+        self.init_epochs()
+
+    def is_kept(self, ids):
+        '''
+        Boolean array that tells for every class id if it is part of this dataset
+        '''
+        held_out = np.isin(ids, self.held_out_classes)
+        return held_out if self.keep_held_out else ~held_out
+
+    def keep_classes(self):
+        '''
+        All the class ids of this dataset, this enumerates the classes so only use it for small attribute spaces
+        '''
+        if self.keep_held_out:
+            return self.held_out_classes
+        return np.flatnonzero(self.is_kept(np.arange(self.n_classes)))
+
+    def sample_classes(self, rng, n):
+        '''
+        n distinct random class ids of this dataset
+        '''
+        if self.keep_held_out or 2 * n > self.n_keep_classes:
+            return rng.choice(self.keep_classes(), n, replace=False)
+
+        ### Few classes are held out, so drawing from all classes and skipping the held out ones and the doubles
+        ### finishes quickly and never enumerates the classes
+        chosen = []
+        while len(chosen) < n:
+            for c in rng.integers(self.n_classes, size=n - len(chosen)):
+                if c not in chosen and self.is_kept(c):
+                    chosen.append(c)
+        return np.array(chosen, dtype=np.int64)
+
+    def generate_item(self, rng):
+        if self.targets_only:
+            return self.to_item(self.sample_classes(rng, 1)[0]), [], 0
+
+        item_ids = self.sample_classes(rng, self.n_receiver)
+        items = list(self.to_item(item_ids))
+        target_index = int(rng.integers(self.n_receiver))
+
+        return items[target_index], items, target_index
+
+    def class_table(self):
+        '''
+        The sender input of every class that can occur in this dataset and how often it is the target.
+        The targets are drawn uniformly from the kept classes.
+        '''
+        inputs = self.to_item(self.keep_classes())
+        frequencies = torch.full((self.n_keep_classes,), 1 / self.n_keep_classes)
+        return inputs, frequencies
 
     def __len__(self):
         return self.samples_per_epoch
 
     def __getitem__(self, idx):
-        sender_item = self.sender_items[idx]
+        return self.generate_item(self.rng(self.global_index(idx)))
+
+    def to_item(self, class_ids):
+        '''
+        The inputs of the models for an array of class ids or a single class id: the ids or their one hots
+        '''
+        if self.class_ids:
+            return torch.as_tensor(class_ids, dtype=torch.long)
+        return self.to_tensor(class_ids)
+
+    def to_tensor(self, class_ids):
+        '''
+        The one hot sender inputs of an array of class ids, or of a single class id
+        '''
+        if np.ndim(class_ids) == 0:
+            return classes_to_one_hot([class_ids], self.n_attributes, self.size_attributes)[0]
+        return classes_to_one_hot(class_ids, self.n_attributes, self.size_attributes)
+
+
+class AttributeInBatchDataset(AttributeGameDataset):
+    '''
+    The attribute game in which the other targets of a batch are the distractors of a message.
+    Every batch contains distinct classes. A fraction of them can be hard negatives: classes that differ in a single
+    attribute from another class in the batch.
+    Use it with a DataLoader with shuffle=False and batch_size=dataset.batch_size, so the batches stay intact.
+    The random generators are keyed by the batch instead of the item, as the classes of a batch depend on each other.
+    '''
 
-        return sender_item, self.receiver_items[idx], self.targets[idx]
+    def __init__(self, n_attributes, size_attributes, batch_size=32, samples_per_epoch=int(10e4), transform=None,
+                 n_remove_classes=0, train=True, hard_negative_fraction=0.0, class_ids=False):
+        self.hard_negative_fraction = hard_negative_fraction
+        super().__init__(n_attributes, size_attributes, n_receiver=batch_size, samples_per_epoch=samples_per_epoch,
+                         transform=transform, n_remove_classes=n_remove_classes, train=train, class_ids=class_ids)
+        ### A batch can not contain more distinct classes than there are
+        self.batch_size = min(batch_size, self.n_keep_classes)
+        self.cached_batch = None
+
+    def generate_batch(self, rng):
+        n_hard = int(self.batch_size * self.hard_negative_fraction)
+
+        batch = list(self.sample_classes(rng, self.batch_size - n_hard))
+        chosen = set(batch)
+
+        if n_hard > 0:
+            neighbours = self.neighbours(rng.choice(batch, n_hard), rng)
+            for neighbour, kept in zip(neighbours, self.is_kept(neighbours)):
+                if kept and neighbour not in chosen:
+                    batch.append(neighbour)
+                    chosen.add(neighbour)
+
+        ### Neighbours that were held out or already in the batch are replaced by random classes
+        while len(batch) < self.batch_size:
+            c = self.sample_classes(rng, 1)[0]
+            if c not in chosen:
+                batch.append(c)
+                chosen.add(c)
+
+        rng.shuffle(batch)
+        return [int(c) for c in batch]
+
+    def neighbours(self, classes, rng):
+        '''
+        For every class a random class that differs in exactly one attribute.
+        Computed from the mixed radix class ids, without a lookup table.
+        '''
+        values = place_values(self.n_attributes, self.size_attributes)
+        attribute = rng.integers(self.n_attributes, size=len(classes))
+        value = (classes // values[attribute]) % self.size_attributes
+        new_value = (value + rng.integers(1, self.size_attributes, size=len(classes))) % self.size_attributes
+        return classes + (new_value - value) * values[attribute]
+
+    def __len__(self):
+        return self.samples_per_epoch // self.batch_size * self.batch_size
 
-    def to_tensor(self, attributes):
-        attribute_tensor = torch.zeros(self.n_attributes * self.size_attributes)
-        for i, att in enumerate(attributes):
-            attribute_tensor[i * self.size_attributes + att] = 1
-        return attribute_tensor
+    def __getitem__(self, idx):
+        batch_idx = self.global_index(idx // self.batch_size)
+        epoch = int(self.epoch[0])
+        ### The items of a batch are loaded one after the other, so the batch is only generated for the first one
+        if self.cached_batch is None or self.cached_batch[:2] != (epoch, batch_idx):
+            self.cached_batch = (epoch, batch_idx, self.generate_batch(self.rng(batch_idx, epoch)))
+        target = self.cached_batch[2][idx % self.batch_size]
+        sender_item = self.to_item(target)
 
-    def reset(self):
-        self.sender_items, self.receiver_items, self.targets = self.generate_items()
+        ### The sender item is also the candidate of the receiver, the model uses the other items of the batch
+        return sender_item, sender_item, target
 
 
 def get_attribute_game(n_attributes, size_attributes, samples_per_epoch_train=int(10e4),
-                       samples_per_epoch_test=int(10e3), batch_size=32, n_receiver=3, n_remove_classes=0):
+                       samples_per_epoch_test=int(10e3), batch_size=32, n_receiver=3, n_remove_classes=0,
+                       in_batch_negatives=False, hard_negative_fraction=0.0, num_workers=0, persistent_workers=False,
+                       prefetch_factor=2, pin_memory=False, class_ids=False):
     '''
     Get a dataloader for the signalling Game
+    :param in_batch_negatives: use the other targets in a batch as distractors, see AttributeInBatchDataset
+    :param hard_negative_fraction: fraction of each batch that are attribute neighbours of other targets
+    :param class_ids: the items are class ids instead of one hot attributes
+    :param num_workers, persistent_workers, prefetch_factor, pin_memory: settings of the dataloaders
+    '''
+    datasets = get_attribute_datasets(n_attributes, size_attributes, samples_per_epoch_train=samples_per_epoch_train,
+                                      samples_per_epoch_test=samples_per_epoch_test, batch_size=batch_size,
+                                      n_receiver=n_receiver, n_remove_classes=n_remove_classes,
+                                      in_batch_negatives=in_batch_negatives,
+                                      hard_negative_fraction=hard_negative_fraction, class_ids=class_ids)
+
+    return get_attribute_loaders(*datasets, batch_size=batch_size, in_batch_negatives=in_batch_negatives,
+                                 num_workers=num_workers, persistent_workers=persistent_workers,
+                                 prefetch_factor=prefetch_factor, pin_memory=pin_memory)
+
+
+def get_attribute_datasets(n_attributes, size_attributes, samples_per_epoch_train=int(10e4),
+                           samples_per_epoch_test=int(10e3), batch_size=32, n_receiver=3, n_remove_classes=0,
+                           in_batch_negatives=False, hard_negative_fraction=0.0, class_ids=False, targets_only=False):
+    '''
+    Get the train and test datasets of the signalling game, see get_attribute_game
+    :param targets_only: the train set only draws the targets, see AttributeGameDataset
     '''
+    if in_batch_negatives:
+        signalling_game_train = AttributeInBatchDataset(n_attributes, size_attributes, batch_size=batch_size,
+                                                        samples_per_epoch=samples_per_epoch_train,
+                                                        n_remove_classes=n_remove_classes, train=True,
+                                                        hard_negative_fraction=hard_negative_fraction,
+                                                        class_ids=class_ids)
+        signalling_game_test = AttributeInBatchDataset(n_attributes, size_attributes, batch_size=batch_size,
+                                                       samples_per_epoch=samples_per_epoch_test,
+                                                       n_remove_classes=n_remove_classes, train=False,
+                                                       class_ids=class_ids)
+        return signalling_game_train, signalling_game_test
 
     signalling_game_train = AttributeGameDataset(n_attributes, size_attributes, n_receiver=n_receiver,
-                                                 samples_per_epoch=samples_per_epoch_train, n_remove_classes=n_remove_classes, train=True )
-    signalling_game_test = AttributeGameDataset(n_attributes, size_attributes, n_receiver=n_receiver, samples_per_epoch=samples_per_epoch_test, n_remove_classes=n_remove_classes, train=False)
+                                                 samples_per_epoch=samples_per_epoch_train, n_remove_classes=n_remove_classes, train=True,
+                                                 class_ids=class_ids, targets_only=targets_only)
+    signalling_game_test = AttributeGameDataset(n_attributes, size_attributes, n_receiver=n_receiver, samples_per_epoch=samples_per_epoch_test, n_remove_classes=n_remove_classes, train=False,
+                                                class_ids=class_ids)
+    return signalling_game_train, signalling_game_test
+
+
+def get_attribute_loaders(signalling_game_train, signalling_game_test, batch_size=32, in_batch_negatives=False,
+                          num_workers=0, persistent_workers=False, prefetch_factor=2, pin_memory=False):
+    '''
+    Get the dataloaders of the train and test datasets of the signalling game
+    '''
+    loader_kwargs = get_loader_kwargs(num_workers, persistent_workers, prefetch_factor, pin_memory)
+
+    if in_batch_negatives:
+        train_dataloader = DataLoader(signalling_game_train, shuffle=False, batch_size=signalling_game_train.batch_size,
+                                      **loader_kwargs)
+        test_dataloader = DataLoader(signalling_game_test, shuffle=False, batch_size=signalling_game_test.batch_size,
+                                     **loader_kwargs)
 
+        return train_dataloader, test_dataloader
 
-    train_dataloader = DataLoader(signalling_game_train, shuffle=True, batch_size=batch_size, )
-    test_dataloader = DataLoader(signalling_game_test, shuffle=False, batch_size=batch_size, )
+    train_dataloader = DataLoader(signalling_game_train, shuffle=True, batch_size=batch_size, **loader_kwargs)
+    test_dataloader = DataLoader(signalling_game_test, shuffle=False, batch_size=batch_size, **loader_kwargs)
 
     return train_dataloader, test_dataloader
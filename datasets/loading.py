@@ -0,0 +1,75 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+def seed_worker(worker_id):
+    '''
+    Seeds numpy in a dataloader worker. Torch gives every worker its own seed, derived from the main process,
+    so the episodes stay reproducible with pl.seed_everything.
+    '''
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+def get_loader_kwargs(num_workers=0, persistent_workers=False, prefetch_factor=2, pin_memory=False):
+    '''
+    The keyword arguments of a DataLoader for the given worker settings.
+    Persistent workers and the prefetch factor only exist when there are workers.
+    '''
+    kwargs = {"num_workers": num_workers, "pin_memory": pin_memory}
+    if num_workers > 0:
+        kwargs["persistent_workers"] = persistent_workers
+        kwargs["prefetch_factor"] = prefetch_factor
+        kwargs["worker_init_fn"] = seed_worker
+    return kwargs
+
+
+class EpochDataset(Dataset):
+    '''
+    Base of the datasets that generate new items every epoch.
+    Every item is generated by its own counter based random generator (Philox), keyed by (seed, epoch, index).
+    Any item can so be generated on its own, in any order and in any process, which gives random access,
+    sharding over dataloader workers and ranks, and regenerating a single episode for debugging.
+    The epoch counter is in shared memory, so a reset in the main process also reaches the copies of the dataset in
+    persistent dataloader workers.
+    '''
+
+    def init_epochs(self):
+        ### Drawn from the global random state, so pl.seed_everything still determines the whole run
+        self.seed = int(np.random.randint(2 ** 31))
+        self.epoch = torch.zeros(1, dtype=torch.long).share_memory_()
+        self.rank = 0
+        self.world_size = 1
+
+    def rng(self, index, epoch=None):
+        '''
+        The random generator of one item (or one batch), independent of all the other items
+        :param index: index of the item in the whole epoch, over all ranks
+        :param epoch: epoch of the item, the current epoch if None
+        '''
+        if epoch is None:
+            epoch = int(self.epoch[0])
+        ### The first counter word is advanced by the draws, the others hold the item and the epoch
+        return np.random.Generator(np.random.Philox(key=self.seed, counter=[0, 0, index, epoch]))
+
+    def global_index(self, idx):
+        '''
+        The index in the whole epoch of the idx-th item of this rank
+        '''
+        return idx * self.world_size + self.rank
+
+    def reset(self):
+        self.epoch += 1
+
+    def set_epoch(self, epoch):
+        self.epoch.fill_(epoch)
+
+    def shard(self, rank, world_size):
+        '''
+        Makes the dataset generate only the items of every epoch that belong to the given rank.
+        '''
+        self.samples_per_epoch = self.samples_per_epoch * self.world_size // world_size
+        self.rank = rank
+        self.world_size = world_size
+        ### Spawned processes receive the same shared counter, every rank resets its own
+        self.epoch = self.epoch.clone().share_memory_()
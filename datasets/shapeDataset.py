@@ -1,12 +1,10 @@
 from itertools import product
 
-from torch.utils.data import Dataset
-import numpy as np
-
 from datasets.gen_shapes_data import COLORS, SHAPES, make_img_one_shape
+from datasets.loading import EpochDataset
 
 
-class ShapeDataset(Dataset):
+class ShapeDataset(EpochDataset):
     '''
     The dataset for a simple mnist signlalling game.
     Each image gets n_receiver-1 other images to be compared with.
@@ -21,44 +19,34 @@ class ShapeDataset(Dataset):
 
         self.possible_items = list(product(COLORS, SHAPES))
 
-        self.items, self.targets = self.generate_items()
         self.transform = transform
+        self.init_epochs()
 
-    def generate_items(self):
-        # First generate the pairs we want
-
-        colors = np.random.choice(COLORS, self.samples_per_epoch)
-        shapes = np.random.choice(SHAPES, self.samples_per_epoch)
-        x_coordinates = np.random.choice(self.possible_coordinates, self.samples_per_epoch)
-        y_coordinates = np.random.choice(self.possible_coordinates, self.samples_per_epoch)
-
-        classes = [
-            self.possible_items.index((col, shape)) for col, shape in zip(colors, shapes)
-        ]
+    def generate_item(self, rng):
+        x, y = rng.choice(self.possible_coordinates, 2)
+        target = int(rng.integers(len(self.possible_items)))
+        color, shape = self.possible_items[target]
 
-        items = [
-            make_img_one_shape(x, y, col, shape, size=self.shape_size, picture_size=self.picture_size) for
-            x, y, col, shape in
-            zip(x_coordinates, y_coordinates, colors, shapes)
-        ]
+        item = make_img_one_shape(int(x), int(y), color, shape, size=self.shape_size, picture_size=self.picture_size)
 
-        return items, classes
+        return item, target
 
     def __len__(self):
         return self.samples_per_epoch
 
     def __getitem__(self, idx):
-        item = self.items[idx]
+        item, target = self.generate_item(self.rng(self.global_index(idx)))
         if self.transform:
             item = self.transform(item)
 
-        return item, self.targets[idx]
+        return item, target
 
 
-class ShapeGameDataset(Dataset):
+class ShapeGameDataset(EpochDataset):
     '''
     The dataset for a simple mnist signlalling game.
     Each image gets n_receiver-1 other images to be compared with.
+    Every episode is generated and drawn when it is loaded.
     '''
 
     def __init__(self, samples_per_epoch=10e4, n_receiver=3, picture_size=32, shape_size=8, transform=None):
@@ -69,48 +57,32 @@ class ShapeGameDataset(Dataset):
         self.picture_size = picture_size
         self.shape_size = shape_size
         self.possible_coordinates = [i * shape_size for i in range(int(picture_size / shape_size))]
+        self.possible_items = list(product(COLORS, SHAPES))
 
-        self.sender_items, self.receiver_items, self.targets = self.generate_items()
         self.transform = transform
 
-    def generate_items(self):
-        # First generate the pairs we want
-
-        sender_items = []
-        receiver_items = []
-        targets = []
-
-        possible_items = list(product(COLORS, SHAPES))
-        for i in range(self.samples_per_epoch):
-            item_ids = np.random.choice(len(possible_items), self.n_receiver, replace=False)
-            x_coordinates = np.random.choice(self.possible_coordinates, self.n_receiver)
-            y_coordinates = np.random.choice(self.possible_coordinates, self.n_receiver)
-            items = [
-                make_img_one_shape(x, y, possible_items[id][0], possible_items[id][1], size=self.shape_size,
-                                   picture_size=self.picture_size) for
-                x, y, id in
-                zip(x_coordinates, y_coordinates, item_ids)
-            ]
-            target_index = int(np.random.choice(self.n_receiver, 1)[0])
-            sender_items.append(items[target_index])
-            receiver_items.append(items)
-            targets.append(target_index)
-
-        return sender_items, receiver_items, targets
+        self.init_epochs()
 
-    def __len__(self):
-        return self.samples_per_epoch
+    def generate_item(self, rng):
+        item_ids = rng.choice(len(self.possible_items), self.n_receiver, replace=False)
+        x_coordinates = rng.choice(self.possible_coordinates, self.n_receiver)
+        y_coordinates = rng.choice(self.possible_coordinates, self.n_receiver)
+        items = [
+            self.make_img(x, y, id) for x, y, id in zip(x_coordinates, y_coordinates, item_ids)
+        ]
+        target_index = int(rng.integers(self.n_receiver))
 
-    def __getitem__(self, idx):
-        sender_item = self.sender_items[idx]
-        receiver_item = self.receiver_items[idx]
+        return items[target_index], items, target_index
+
+    def make_img(self, x, y, id):
+        color, shape = self.possible_items[id]
+        img = make_img_one_shape(int(x), int(y), color, shape, size=self.shape_size, picture_size=self.picture_size)
         if self.transform:
-            sender_item = self.transform(sender_item)
-            receiver_item = [
-                self.transform(item) for item in receiver_item
-            ]
+            img = self.transform(img)
+        return img
 
-        return sender_item, receiver_item, self.targets[idx]
+    def __len__(self):
+        return self.samples_per_epoch
 
-    def reset(self):
-        self.sender_items, self.receiver_items, self.targets = self.generate_items()
+    def __getitem__(self, idx):
+        return self.generate_item(self.rng(self.global_index(idx)))
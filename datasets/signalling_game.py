@@ -1,34 +1,40 @@
 from torch.utils.data import Dataset, DataLoader
-from torchvision.datasets import MNIST, FashionMNIST, CIFAR10
-import numpy as np
 
+from datasets.loading import EpochDataset
 
-class SignallingGameDataset(Dataset):
+
+class SignallingGameDataset(EpochDataset):
     '''
     The dataset for a simple mnist signlalling game.
     Each image gets n_receiver-1 other images to be compared with.
+    The distractors are drawn per (epoch, index), use a ResetDatasetCallback to get new distractors every epoch.
     '''
 
     def __init__(self, n_receiver=3, train=True, transform=None, root='./data'):
+        ### Imported here, so importing the datasets does not import torchvision
+        from torchvision.datasets import MNIST
+
         self.data = MNIST(root=root, download=True, train=train, transform=transform)
         self.n_receiver = n_receiver
+        self.samples_per_epoch = len(self.data)
+        self.init_epochs()
 
     def __len__(self):
-        return len(self.data)
+        return self.samples_per_epoch
 
     def __getitem__(self, idx):
+        idx = self.global_index(idx)
+        rng = self.rng(idx)
         sender_img = self.data[idx][0]
 
-        receiver_indices = np.random.choice(len(self), self.n_receiver - 1)
+        receiver_indices = rng.choice(len(self.data), self.n_receiver - 1)
 
-        receiver_choices = [sender_img] + [self.data[i][0] for i in receiver_indices]
+        receiver_choices = [sender_img] + [self.data[int(i)][0] for i in receiver_indices]
         shuffle = [i for i in range(self.n_receiver)]
-        np.random.shuffle(shuffle)
+        rng.shuffle(shuffle)
 
         target = shuffle.index(0)
 
         receiver_choices = [receiver_choices[i] for i in shuffle]
 
         return sender_img, receiver_choices, target
-
-
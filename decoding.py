@@ -0,0 +1,41 @@
+from contextlib import contextmanager
+
+import torch
+
+DECODE_MODES = ('gumbel', 'argmax', 'top_k')
+
+
+def decode_symbols(logits, decode_mode='gumbel', tau=1.0, hard=True, top_k=2):
+    '''
+    Turns the logits of the symbols into (one hot) symbols
+    :param logits: logits of the symbols, the symbols are the last dimension
+    :param decode_mode: 'gumbel' samples with gumbel softmax, 'argmax' takes the most likely symbol without noise and
+        softmax, 'top_k' samples with gumbel softmax among the top_k most likely symbols
+    :param tau: temperature of the gumbel softmax
+    :param hard: return one hot symbols with straight through gradients instead of soft samples
+    :param top_k: number of symbols that are sampled from with 'top_k'
+    '''
+    if decode_mode == 'argmax':
+        return torch.nn.functional.one_hot(torch.argmax(logits, dim=-1), logits.shape[-1]).float()
+    if decode_mode == 'top_k':
+        kth_logit = torch.topk(logits, top_k, dim=-1)[0][..., -1:]
+        logits = logits.masked_fill(logits < kth_logit, float('-inf'))
+    elif decode_mode != 'gumbel':
+        raise ValueError("decode_mode should be one of {}, got {}".format(DECODE_MODES, decode_mode))
+    return torch.nn.functional.gumbel_softmax(logits, tau=tau, hard=hard, dim=-1)
+
+
+@contextmanager
+def use_decode_mode(module, decode_mode):
+    '''
+    Sets the decode mode of all the senders in module for the duration of the context
+    '''
+    senders = [m for m in module.modules() if hasattr(m, 'decode_mode')]
+    previous = [sender.decode_mode for sender in senders]
+    for sender in senders:
+        sender.decode_mode = decode_mode
+    try:
+        yield
+    finally:
+        for sender, mode in zip(senders, previous):
+            sender.decode_mode = mode
@@ -1,56 +1,67 @@
-import torch
-from numpy import infty
-import numpy as np
-
-import pytorch_lightning as pl
-
 import argparse
 import yaml
 
-from experiment_utils import run_game_with_config, create_name, result_to_file, get_summary_results
-
-parser = argparse.ArgumentParser(description='Run a grid defined in a given ')
-
-parser.add_argument('--config', default="config/example_experiment.yaml", required=False)
+from results_store import ResultsStore, load_summary
 
-args = parser.parse_args()
+if __name__ == '__main__':
+    ### The guard is needed for data parallel training, the spawned processes import this file
+    parser = argparse.ArgumentParser(description='Run a grid defined in a given ')
 
-with open(args.config) as f:
-    config = yaml.load(f)
+    parser.add_argument('--config', default="config/example_experiment.yaml", required=False)
+    parser.add_argument('--store', default="results.sqlite", required=False)
+    parser.add_argument('--summarize', action='store_true',
+                        help='Only print the summary of the stored results, without importing torch')
 
+    args = parser.parse_args()
 
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
 
 
 
-results = { metric: [] for metric in config["metrics"]}
 
 
-for i in range(config["n_runs"]):
-    print(config)
-    pl.seed_everything(i)
-    result_run = run_game_with_config(config)
-    print(result_run)
-    for metric in config["metrics"]:
-        if isinstance(result_run[metric], torch.Tensor):
-
-            results[metric].append(result_run[metric].item())
-        else:
-            results[metric].append(result_run[metric])
+    store = ResultsStore(args.store)
 
+    if args.summarize:
+        print(load_summary(store, config))
+        raise SystemExit
 
-name = create_name(config)
+    ### Torch and Lightning take seconds to import, so they are only imported when there is something to train
+    import torch
+    import pytorch_lightning as pl
 
-result_to_file(name, results)
-results_summary = get_summary_results(name)
+    from experiment_utils import run_game_with_config, get_checkpoint_dir
 
-print(results_summary)
+    results = { metric: [] for metric in config["metrics"]}
 
 
-print(results)
-
+    finished_seeds = store.seeds(config)
 
+    for i in range(config["n_runs"]):
+        if i in finished_seeds:
+            ### This run already finished, for example before the experiment was interrupted
+            result_seed = store.results(config, i)
+        else:
+            print(config)
+            pl.seed_everything(i)
+            result_run = run_game_with_config(config, checkpoint_dir=get_checkpoint_dir(config, i), store_path=args.store,
+                                              seed=i)
+            print(result_run)
+            result_seed = {}
+            for metric in config["metrics"]:
+                if isinstance(result_run[metric], torch.Tensor):
+                    result_seed[metric] = result_run[metric].item()
+                else:
+                    result_seed[metric] = result_run[metric]
+            store.add_results(config, i, result_seed)
+        for metric in config["metrics"]:
+            results[metric].append(result_seed[metric])
 
 
+    results_summary = store.summary(config)
 
+    print(results_summary)
 
 
+    print(results)
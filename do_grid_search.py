@@ -1,61 +1,75 @@
-from itertools import product
-
-import torch
-import pytorch_lightning as pl
-from numpy import infty
+import argparse
 import numpy as np
-from attribute_game.pl_model import AttributeBaseLineModel, AttributeModelWithPrediction
-from attribute_game.utils import get_sender, get_receiver, get_predictor
-from callbacks.msg_callback import MsgCallback, MsgFrequencyCallback, EntropyMeasure, MeasureCallbacks, \
-    ResetDatasetCallback, DistinctSymbolMeasure
+import yaml
 
-from att_game_pl_config import run
+from experiment_config import construct_configs, print_best_pretty
+from results_store import ResultsStore
 
-import torch
-import pytorch_lightning as pl
+if __name__ == '__main__':
+    ### The guard is needed for data parallel training, the spawned processes import this file
+    parser = argparse.ArgumentParser(description='Run a grid defined in a given ')
 
-import argparse
-import yaml
+    parser.add_argument('--config', default="config/gridsearch_config_example.yaml", required=False)
+    parser.add_argument('--store', default="results.sqlite", required=False)
+    parser.add_argument('--summarize', action='store_true',
+                        help='Only print the summaries of the stored results, without importing torch')
+
+    args = parser.parse_args()
 
-from experiment_utils import construct_configs, run_game_with_config, print_best_pretty
-from utils import cross_entropy_loss_2
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
 
-parser = argparse.ArgumentParser(description='Run a grid defined in a given ')
 
-parser.add_argument('--config', default="config/gridsearch_config_example.yaml", required=False)
 
-args = parser.parse_args()
+    configs = construct_configs(config)
 
-with open(args.config) as f:
-    config = yaml.load(f)
+    store = ResultsStore(args.store)
 
+    if args.summarize:
+        for config, summary in zip(configs, store.summaries(configs)):
+            print(config)
+            print(summary)
+        raise SystemExit
 
+    ### Torch and Lightning take seconds to import, so they are only imported when there is something to train
+    import torch
+    import pytorch_lightning as pl
 
-configs = construct_configs(config)
+    from experiment_utils import run_game_with_config, get_checkpoint_dir
 
-lowest_loss = infty
-best = None
+    lowest_loss = np.inf
+    best = None
 
-for config in configs:
-    loss_ar = []
-    for i in range(config["n_runs"]):
-        print(config)
-        pl.seed_everything(i)
-        val_loss = run_game_with_config(config)[config["metric"]]
-        loss_ar.append(val_loss)
+    for config in configs:
+        loss_ar = []
+        finished_seeds = store.seeds(config)
+        for i in range(config["n_runs"]):
+            if i in finished_seeds:
+                ### Finished before the grid search was interrupted
+                loss_ar.append(store.results(config, i)[config["metric"]])
+                continue
+            print(config)
+            pl.seed_everything(i)
+            result_run = run_game_with_config(config, checkpoint_dir=get_checkpoint_dir(config, i), store_path=args.store,
+                                              seed=i)
+            result_run = {key: value.item() if isinstance(value, torch.Tensor) else value
+                          for key, value in result_run.items()}
+            store.add_results(config, i, result_run)
+            val_loss = result_run[config["metric"]]
+            loss_ar.append(val_loss)
 
-    loss = np.mean(loss_ar)
+        loss = np.mean(loss_ar)
 
-    if loss < lowest_loss:
-        lowest_loss = loss
-        best = config
+        if loss < lowest_loss:
+            lowest_loss = loss
+            best = config
 
-print(lowest_loss)
-print(best)
+    print(lowest_loss)
+    print(best)
 
-print_best_pretty(config, best)
+    print_best_pretty(config, best)
 
 
 
 
-###Config (Move to some file or something for easy training and experimentiation
+    ###Config (Move to some file or something for easy training and experimentiation
@@ -0,0 +1,79 @@
+from itertools import product
+
+import numpy as np
+import yaml
+
+
+def print_best_pretty(base_config, best):
+    names = [
+        var[:-1] for var in base_config["grid_search_vars"]
+    ]
+    for name in names:
+        print("{}, {}".format(name, best[name]))
+
+
+def is_grid_config(config):
+    '''
+    If the config is a grid search, with a list of values for every var in grid_search_vars. Many experiment configs
+    still list grid_search_vars but hold single values, those are one run each.
+    '''
+    return "grid_search_vars" in config and all(var in config for var in config["grid_search_vars"])
+
+
+def construct_configs(base_config):
+    '''
+    Construct configs
+    '''
+    to_combine = [
+        list(base_config[var]) for var in base_config["grid_search_vars"]
+    ]
+
+    names = [
+        var[:-1] for var in base_config["grid_search_vars"]
+    ]
+
+    vars = list(product(*to_combine))
+
+    configs = []
+    for vals in vars:
+        c = base_config.copy()
+        for i, name in enumerate(names):
+            c[name] = vals[i]
+        configs.append(c)
+    return configs
+
+
+def result_to_file(name, results):
+    with open(name, 'w') as outfile:
+        yaml.dump(results, outfile)
+
+
+def get_summary_results(name):
+    with open(name) as f:
+        results = yaml.safe_load(f)
+
+    return {k: (np.mean(v), np.std(v)) for k, v in results.items()}
+
+def get_summary_results_filtered(name):
+    with open(name) as f:
+        results = yaml.safe_load(f)
+    useidc = []
+    for k, v in results.items():
+        if k == "val_accuracy_epoch":
+            for i in range(len(v)):
+                if v[i] > 0.0:
+                    useidc.append(i)
+    resultreturn = dict()
+    for k, v in results.items():
+        vgood = [v[i] for i in useidc]
+        resultreturn[k] = (np.mean(vgood), np.std(vgood))
+
+    return resultreturn
+
+
+def create_name(config):
+    if "name" in config.keys():
+        return config["name"] + ".yml"
+    else:
+        return "experiment_{}_{}_{}_{}_{}.yml".format(config["n_receiver"], config["n_attributes"], config["attributes_size"],
+                                               config["with_predictor"], config["n_remove_classes"])
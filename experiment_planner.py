@@ -0,0 +1,311 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pytorch_lightning as pl
+import torch
+import yaml
+
+from attribute_game.pl_model import unpack_batch
+from attribute_game.utils import get_pretrained_feature_encoder
+from callbacks.msg_callback import MessageTableCallback
+from decoding import use_decode_mode
+from experiment_config import is_grid_config
+from experiment_utils import construct_configs, get_game, get_datasets, run_game_with_config, get_measures, \
+    get_batch_size
+from datasets.AttributeDataset import get_attribute_loaders
+from message import to_indices
+from results_store import ResultsStore, IGNORED_CONFIG_KEYS, config_metrics
+
+### The settings every stage depends on. The train stage depends on all the other settings of a config.
+PRETRAIN_KEYS = ("n_attributes", "attributes_size", "pretrain_n_epochs")
+### The batch size only changes the dataset with in batch negatives, see dataset_settings
+DATASET_KEYS = ("n_attributes", "attributes_size", "samples_per_epoch_train", "samples_per_epoch_test", "n_receiver",
+                "n_remove_classes", "in_batch_negatives", "hard_negative_fraction", "frozen_encoder",
+                "adaptive_distractors")
+### Settings that only change how a trained game is evaluated
+EVALUATE_KEYS = ("eval_decode_mode", "message_table_measures")
+
+STAGE_KINDS = ("pretrain_encoder", "build_dataset", "train", "evaluate")
+
+
+def stage_hash(kind, settings, seed, dependencies):
+    '''
+    A stable hash of a stage, from its settings, the seed and the hashes of the stages it depends on
+    '''
+    description = {"kind": kind, "settings": settings, "seed": seed, "dependencies": dependencies}
+    return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class Stage:
+    '''
+    One step of an experiment. Stages with the same hash compute the same artefact, so they are only run once.
+    '''
+
+    def __init__(self, kind, config, seed, settings, dependencies=None):
+        '''
+        :param kind: one of STAGE_KINDS
+        :param config: the config of the run the stage belongs to
+        :param settings: the part of the config the result of the stage depends on
+        :param dependencies: dict of name to the stage whose artefact this stage needs
+        '''
+        self.kind = kind
+        self.config = config
+        self.seed = seed
+        self.settings = settings
+        self.dependencies = dependencies or {}
+        self.key = stage_hash(kind, settings, seed, {name: stage.key for name, stage in self.dependencies.items()})
+
+    @property
+    def stage_seed(self):
+        '''
+        The pretrain and dataset stages draw their random numbers from their own seed, so their artefact does not
+        depend on the order in which the stages run. The train and evaluate stages use the seed of the run.
+        '''
+        return int(self.key, 16) % 2 ** 31
+
+    def __repr__(self):
+        return "{}({})".format(self.kind, self.key)
+
+
+def select(config, keys):
+    return {key: config.get(key) for key in keys}
+
+
+def results_config(config):
+    '''
+    The config under which the results of a run of the planner are stored. Its stages are seeded differently than
+    the runs of do_experiment and do_grid_search, so their results are kept apart.
+    '''
+    return {**config, "runner": "experiment_planner"}
+
+
+def dataset_settings(config):
+    '''
+    The settings of the build_dataset stage. The batch size is only one of them with in batch negatives, so a grid
+    over the batch size otherwise shares the datasets.
+    '''
+    settings = select(config, DATASET_KEYS)
+    if config.get("in_batch_negatives", False):
+        settings["batch_size"] = config["batch_size"]
+    return settings
+
+
+def load_configs(paths):
+    '''
+    The configs of the given yaml files, grid search configs are expanded into one config per combination
+    '''
+    configs = []
+    for path in paths:
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        configs += construct_configs(config) if is_grid_config(config) else [config]
+    return configs
+
+
+def plan_run(config, seed):
+    '''
+    The stages of one run of a config, the evaluate stage is the last one
+    '''
+    pretrained = {}
+    ### The merged receiver reads the message with the hidden state of the predictor, so its encoder has that size
+    merged = config["with_predictor"] and config.get("merged_predictor", False)
+    hidden_sizes = {"sender": 128, "receiver": config["hidden_size_predictor"] if merged else 128}
+    for role, hidden_size in hidden_sizes.items():
+        ### The role is part of the settings, the sender and the receiver start from different encoders
+        settings = {"role": role, "hidden_size": hidden_size, **select(config, PRETRAIN_KEYS)}
+        pretrained[role] = Stage("pretrain_encoder", config, seed, settings)
+
+    dataset = Stage("build_dataset", config, seed, dataset_settings(config))
+
+    ### The name and the lists of values of a grid search do not change the run, only the chosen values do
+    ignored = set(IGNORED_CONFIG_KEYS) | set(EVALUATE_KEYS) | {"name", "grid_search_vars"} | \
+        set(config.get("grid_search_vars", []))
+    train_settings = {key: value for key, value in config.items() if key not in ignored}
+    train = Stage("train", config, seed, train_settings, {"dataset": dataset, **pretrained})
+
+    return Stage("evaluate", config, seed, select(config, EVALUATE_KEYS), {"train": train, "dataset": dataset})
+
+
+def plan(configs, store=None):
+    '''
+    Expands the configs into the stages of all their runs, identical stages are only kept once
+    :param configs: list of configs, each with n_runs seeds
+    :param store: ResultsStore, the runs of which the results are already stored are left out
+    :return: dict of hash to stage, in an order in which every stage comes after its dependencies, and a list of
+    (config, seed, evaluate stage) of every run
+    '''
+    stages = {}
+    evaluations = []
+
+    def add(stage):
+        for dependency in stage.dependencies.values():
+            add(dependency)
+        if stage.key not in stages:
+            stages[stage.key] = stage
+        return stages[stage.key]
+
+    for config in configs:
+        finished_seeds = store.seeds(results_config(config)) if store is not None else []
+        for seed in range(config["n_runs"]):
+            if seed in finished_seeds:
+                continue
+            evaluations.append((config, seed, add(plan_run(config, seed))))
+    return stages, evaluations
+
+
+class ArtefactStore:
+    '''
+    Directory with the artefact of every stage that finished, in a file named after the hash of the stage
+    '''
+
+    def __init__(self, root='artefacts'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key + ".pt")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def save(self, key, artefact):
+        path = self.path(key)
+        ### Write to a temporary file first, so a killed stage never leaves a broken artefact behind
+        torch.save(artefact, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def load(self, key):
+        return torch.load(self.path(key))
+
+
+@torch.no_grad()
+def evaluate_game(model, test_dataloader, measures, message_table=False):
+    '''
+    The accuracy and the message measures of a trained game on the test set
+    :param message_table: compute the measures on the messages of the test classes, see MessageTableCallback
+    '''
+    model.eval()
+    correct = 0
+    total = 0
+    msgs = []
+    with use_decode_mode(model.sender, model.eval_decode_mode):
+        for batch in test_dataloader:
+            sender_img, receiver_imgs, target = unpack_batch(batch, model.device, model.in_batch_negatives)
+            msg, msg_packed, out, out_probs, _, _ = model.forward(sender_img, receiver_imgs)
+            correct += (torch.argmax(out_probs, dim=-1) == target).sum().item()
+            total += len(target)
+            msgs.append(to_indices(msg).permute(1, 0))
+    results = {"eval_accuracy": correct / total}
+    if message_table:
+        table_callback = MessageTableCallback(test_dataloader.dataset, measures)
+        msgs, weights = table_callback.make_table(model.sender, model.device), table_callback.frequencies
+    else:
+        msgs, weights = torch.cat(msgs), None
+    for measure in measures:
+        results[measure.name] = float(measure.make_measure(msgs, weights=weights))
+    return results
+
+
+def run_stage(stage, artefact_root):
+    '''
+    Runs one stage, with the artefacts of its dependencies, and saves its artefact. Runs in a worker process.
+    '''
+    artefacts = ArtefactStore(artefact_root)
+    inputs = {name: artefacts.load(dependency.key) for name, dependency in stage.dependencies.items()}
+    config = stage.config
+    pl.seed_everything(stage.stage_seed if stage.kind in ("pretrain_encoder", "build_dataset") else stage.seed)
+
+    if stage.kind == "pretrain_encoder":
+        ### The frozen ClassEmbeddingEncoder is built from the encoder in the train stage
+        artefact = get_pretrained_feature_encoder(config["n_attributes"], config["attributes_size"],
+                                                  n_epochs=config["pretrain_n_epochs"],
+                                                  hidden_state_size=stage.settings["hidden_size"]).cpu()
+    elif stage.kind == "build_dataset":
+        artefact = get_datasets(config)
+    elif stage.kind == "train":
+        encoders = {"sender": inputs["sender"], "receiver": inputs["receiver"]}
+        results, model = run_game_with_config(config, checkpoint_dir=os.path.join(artefact_root, stage.key),
+                                              encoders=encoders, datasets=inputs["dataset"], return_model=True)
+        results = {metric: float(value) for metric, value in results.items()}
+        ### With data parallel training only the metrics of the training are known, not the trained weights
+        state_dict = model.cpu().state_dict() if config.get("num_processes", 1) == 1 else None
+        artefact = {"results": results, "state_dict": state_dict}
+    elif stage.kind == "evaluate":
+        artefact = dict(inputs["train"]["results"])
+        if inputs["train"]["state_dict"] is not None:
+            model = get_game(config, pretrain=False)
+            model.load_state_dict(inputs["train"]["state_dict"])
+            _, test_dataloader = get_attribute_loaders(*inputs["dataset"], batch_size=get_batch_size(config),
+                                                       in_batch_negatives=config.get("in_batch_negatives", False))
+            artefact.update(evaluate_game(model, test_dataloader, get_measures(config),
+                                          message_table=config.get("message_table_measures", False)))
+    else:
+        raise ValueError("Stage kind should be one of {}, got {}".format(STAGE_KINDS, stage.kind))
+
+    artefacts.save(stage.key, artefact)
+    return stage.key
+
+
+def run_plan(stages, evaluations, artefacts, store, n_workers=1):
+    '''
+    Runs all the stages that have no artefact yet, every stage as soon as the stages it depends on are done.
+    Stages that do not depend on each other run at the same time in n_workers processes.
+    The results of the evaluate stages are added to the results store.
+    '''
+    done = {key for key in stages if artefacts.exists(key)}
+    todo = [stage for key, stage in stages.items() if key not in done]
+    print("{} stages, {} already done".format(len(stages), len(done)))
+
+    def ready():
+        return [stage for stage in todo if all(dep.key in done for dep in stage.dependencies.values())]
+
+    if n_workers <= 1:
+        ### The stages are in dependency order
+        for stage in todo:
+            print("Running {}".format(stage))
+            done.add(run_stage(stage, artefacts.root))
+    else:
+        ### Spawn instead of fork, the workers use torch and possibly cuda
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            running = {}
+            while todo or running:
+                for stage in ready():
+                    print("Running {}".format(stage))
+                    running[executor.submit(run_stage, stage, artefacts.root)] = stage
+                    todo.remove(stage)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    running.pop(future)
+                    done.add(future.result())
+
+    for config, seed, stage in evaluations:
+        ### A shared stage holds the config of the run that added it first, the results belong to every run
+        results = artefacts.load(stage.key)
+        store.add_results(results_config(config), seed,
+                          {metric: results[metric] for metric in config_metrics(config) if metric in results})
+
+
+if __name__ == '__main__':
+    ### The guard is needed for the worker processes, they import this file
+    parser = argparse.ArgumentParser(description='Run the stages of the experiments of the given configs, reusing '
+                                                 'the stages they have in common')
+
+    parser.add_argument('--config', nargs='+', default=["config/example_experiment.yaml"], required=False)
+    parser.add_argument('--store', default="results.sqlite", required=False)
+    parser.add_argument('--artefacts', default="artefacts", required=False)
+    parser.add_argument('--workers', type=int, default=1, required=False)
+
+    args = parser.parse_args()
+
+    configs = load_configs(args.config)
+
+    store = ResultsStore(args.store)
+    stages, evaluations = plan(configs, store)
+    run_plan(stages, evaluations, ArtefactStore(args.artefacts), store, n_workers=args.workers)
+
+    for config in configs:
+        print(config.get("name"), store.summary(results_config(config)))
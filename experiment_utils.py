@@ -1,74 +1,188 @@
-from itertools import product
+import copy
 
 import torch
-import yaml
-import numpy as np
-from attribute_game.pl_model import AttributeModelWithPrediction, AttributeBaseLineModel
-from attribute_game.utils import get_sender, get_receiver, get_predictor
+from attribute_game.pl_model import AttributeModelWithPrediction, AttributeBaseLineModel, AttributeModelMerged, \
+    PopulationModel
+from attribute_game.distractor_sampler import ConfusionSampler
+from attribute_game.population import SenderPool, ReceiverPool
+from attribute_game.utils import get_sender, get_receiver, get_predictor, get_receiver_predictor, \
+    get_pretrained_feature_encoder
 from callbacks.msg_callback import MsgCallback, MsgFrequencyCallback, EntropyMeasure, DistinctSymbolMeasure, \
-    MeasureCallbacks, ResetDatasetCallback, MsgLength
-from datasets.AttributeDataset import get_attribute_game
+    MeasureCallbacks, ResetDatasetCallback, MsgLength, MessageTableCallback
+from callbacks.profiler_callback import ProfilerCallback
+from callbacks.results_callback import ResultsStoreCallback
+from callbacks.async_logger import get_logger
+from callbacks.checkpoint_callback import AsyncCheckpointCallback, latest_checkpoint
+from callbacks.distributed_callback import DistributedDatasetCallback, SaveResultsCallback, \
+    get_distributed_trainer_kwargs
+from datasets.AttributeDataset import get_attribute_datasets, get_attribute_loaders
+from results_store import config_hash
+### The helpers that do not need torch live in experiment_config, so the analysis scripts can import them quickly
+from experiment_config import construct_configs, print_best_pretty, result_to_file, get_summary_results, \
+    get_summary_results_filtered, create_name
 from utils import cross_entropy_loss_2
 import pytorch_lightning as pl
+import os
+import tempfile
 
 
-def get_game(config):
+def get_game(config, pretrain=True, encoders=None):
+    '''
+    Get the model of the game
+    :param pretrain: pretrain the feature encoders, can be turned off when the weights come from a checkpoint
+    :param encoders: dict with the already pretrained "sender" and "receiver" feature encoders, which are used instead
+    of pretraining new ones
+    '''
+    if config.get("population_size", 1) > 1:
+        return get_population_game(config, pretrain=pretrain, encoders=encoders)
+    encoders = encoders or {}
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     n_attributes = config["n_attributes"]
     attributes_size = config["attributes_size"]
     n_symbols = config["n_symbols"]
     msg_len = config["msg_len"]
 
-    pretrain_n_epochs = config["pretrain_n_epochs"]
+    pretrain_n_epochs = config["pretrain_n_epochs"] if pretrain else 0
     fixed_size = config["fixed_size"]
     pack_message = not fixed_size
     n_receiver = config["n_receiver"]
     hparams = config
     loss_module = torch.nn.CrossEntropyLoss()
     pack_massage = not fixed_size
+    ### Freeze the pretrained encoders and feed the class ids of the items to an embedding table
+    frozen_encoder = config.get("frozen_encoder", False)
     sender = get_sender(n_attributes, attributes_size, n_symbols, msg_len, device, fixed_size=fixed_size,
-                        pretrain_n_epochs=pretrain_n_epochs, )
-    receiver = get_receiver(n_attributes, attributes_size, n_receiver, n_symbols, msg_len, device,
-                            fixed_size=fixed_size,
-                            pretrain_n_epochs=pretrain_n_epochs)
-
-    if config["with_predictor"]:
-        predictor = get_predictor(n_symbols, config["hidden_size_predictor"], device)
+                        pretrain_n_epochs=pretrain_n_epochs, decode_mode=config.get("decode_mode", "gumbel"),
+                        top_k=config.get("decode_top_k", 2), message_head=config.get("message_head", "dense"),
+                        frozen_encoder=frozen_encoder, encoder=encoders.get("sender"))
+    in_batch_negatives = config.get("in_batch_negatives", False)
+    ### With in batch negatives the number of candidates is the batch size, only the dot product receiver can do that
+    receiver_type = "dot_product" if in_batch_negatives else config.get("receiver_type", "concat")
+    ### The merged model reads the message once, with the predictor, so the receiver only scores the candidates
+    merged = config["with_predictor"] and config.get("merged_predictor", False)
+    if merged:
+        receiver = get_receiver_predictor(n_attributes, attributes_size, n_receiver, n_symbols, msg_len, device,
+                                          fixed_size=fixed_size, pretrain_n_epochs=pretrain_n_epochs,
+                                          encoder_hidden_state_size=config["hidden_size_predictor"],
+                                          frozen_encoder=frozen_encoder, encoder=encoders.get("receiver"))
+    else:
+        receiver = get_receiver(n_attributes, attributes_size, n_receiver, n_symbols, msg_len, device,
+                                fixed_size=fixed_size,
+                                pretrain_n_epochs=pretrain_n_epochs,
+                                receiver_type=receiver_type, message_head=config.get("message_head", "dense"),
+                                n_heads=config.get("transformer_heads", 4),
+                                n_layers=config.get("transformer_layers", 2), frozen_encoder=frozen_encoder,
+                                encoder=encoders.get("receiver"))
+
+    eval_decode_mode = config.get("eval_decode_mode", "argmax")
+    distractor_sampler = get_distractor_sampler(config, device)
+
+    if merged:
+        predictor = get_predictor(n_symbols, config["hidden_size_predictor"], device,
+                                  predictor_type=config.get("predictor_type", "lstm"), msg_len=msg_len,
+                                  n_heads=config.get("transformer_heads", 4),
+                                  n_layers=config.get("transformer_layers", 2))
+        signalling_game_model = AttributeModelMerged(sender, receiver, loss_module, predictor, cross_entropy_loss_2,
+                                                     hparams=hparams, pack_message=pack_message,
+                                                     eval_decode_mode=eval_decode_mode,
+                                                     distractor_sampler=distractor_sampler).to(device)
+    elif config["with_predictor"]:
+        predictor = get_predictor(n_symbols, config["hidden_size_predictor"], device,
+                                  predictor_type=config.get("predictor_type", "lstm"), msg_len=msg_len,
+                                  n_heads=config.get("transformer_heads", 4),
+                                  n_layers=config.get("transformer_layers", 2))
         loss_module_predictor = cross_entropy_loss_2
         signalling_game_model = AttributeModelWithPrediction(sender, receiver, loss_module, predictor,
                                                              loss_module_predictor,
-                                                             hparams=hparams, pack_message=pack_message).to(device)
+                                                             hparams=hparams, pack_message=pack_message,
+                                                             in_batch_negatives=in_batch_negatives,
+                                                             eval_decode_mode=eval_decode_mode,
+                                                             distractor_sampler=distractor_sampler).to(device)
     else:
         signalling_game_model = AttributeBaseLineModel(sender, receiver, loss_module, hparams=hparams,
-                                                       pack_message=pack_massage).to(device)
+                                                       pack_message=pack_massage,
+                                                       in_batch_negatives=in_batch_negatives,
+                                                       eval_decode_mode=eval_decode_mode,
+                                                       distractor_sampler=distractor_sampler).to(device)
 
     return signalling_game_model
 
 
-def run_game_with_config(config):
+def get_distractor_sampler(config, device):
+    '''
+    The ConfusionSampler of the training episodes if the config asks for adaptive distractors, otherwise None
+    '''
+    if not config.get("adaptive_distractors", False):
+        return None
+    if config.get("in_batch_negatives", False):
+        raise ValueError("With in batch negatives the distractors are the other targets of the batch, they can not "
+                         "be sampled adaptively")
+    return ConfusionSampler(config["n_attributes"], config["attributes_size"], config["n_receiver"],
+                            n_remove_classes=config.get("n_remove_classes", 0),
+                            uniform_mixture=config.get("adaptive_uniform_mixture", 0.5),
+                            decay=config.get("adaptive_confusion_decay", 0.99),
+                            class_ids=config.get("frozen_encoder", False)).to(device)
+
+
+def get_population_game(config, pretrain=True, encoders=None):
+    '''
+    Get the model of the game with population_size senders and receivers, see PopulationModel.
+    The encoder of every role is pretrained once, all the agents of a role start from a copy of it.
+    '''
+    encoders = encoders or {}
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if config["with_predictor"] or config.get("in_batch_negatives", False) or \
+            config.get("receiver_type", "concat") != "concat" or config.get("message_head", "dense") != "dense":
+        raise ValueError("Populations are made of the dense senders and concat receivers, without a predictor or "
+                         "in batch negatives")
     n_attributes = config["n_attributes"]
     attributes_size = config["attributes_size"]
+    n_symbols = config["n_symbols"]
+    msg_len = config["msg_len"]
+    fixed_size = config["fixed_size"]
+    frozen_encoder = config.get("frozen_encoder", False)
+    pretrain_n_epochs = config["pretrain_n_epochs"] if pretrain else 0
 
-    samples_per_epoch_train = config["samples_per_epoch_train"]
-    samples_per_epoch_test = config["samples_per_epoch_test"]
-    pretrain_n_epochs = config["pretrain_n_epochs"]
-    max_epochs = config["max_epochs"]
+    for role in ("sender", "receiver"):
+        if encoders.get(role) is None:
+            encoders[role] = get_pretrained_feature_encoder(n_attributes, attributes_size, n_epochs=pretrain_n_epochs)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    senders = [get_sender(n_attributes, attributes_size, n_symbols, msg_len, device, fixed_size=fixed_size,
+                          decode_mode=config.get("decode_mode", "gumbel"), top_k=config.get("decode_top_k", 2),
+                          frozen_encoder=frozen_encoder, encoder=copy.deepcopy(encoders["sender"]))
+               for _ in range(config["population_size"])]
+    receivers = [get_receiver(n_attributes, attributes_size, config["n_receiver"], n_symbols, msg_len, device,
+                              fixed_size=fixed_size, frozen_encoder=frozen_encoder,
+                              encoder=copy.deepcopy(encoders["receiver"]))
+                 for _ in range(config["population_size"])]
 
-    train_dataloader, test_dataloader = get_attribute_game(n_attributes, attributes_size,
-                                                           samples_per_epoch_train=samples_per_epoch_train,
-                                                           samples_per_epoch_test=samples_per_epoch_test,
-                                                           n_receiver=config["n_receiver"], n_remove_classes=config["n_remove_classes"])
+    return PopulationModel(SenderPool(senders), ReceiverPool(receivers), torch.nn.CrossEntropyLoss(), hparams=config,
+                           eval_decode_mode=config.get("eval_decode_mode", "argmax"),
+                           distractor_sampler=get_distractor_sampler(config, device)).to(device)
 
-    signalling_game_model = get_game(config)
 
-    to_sample_from = next(iter(test_dataloader))[:5]
+def load_trained_game(config, checkpoint_path):
+    '''
+    The game of the config with the weights of a checkpoint, for example one of the AsyncCheckpointCallback, on the
+    cpu and in eval mode
+    '''
+    model = get_game(config, pretrain=False)
+    model.load_state_dict(torch.load(checkpoint_path, map_location="cpu")["state_dict"])
+    return model.cpu().eval()
 
-    msg_callback = MsgCallback(to_sample_from, )
 
-    freq_callback = MsgFrequencyCallback(to_sample_from)
+def get_checkpoint_dir(config, seed, root='checkpoints'):
+    '''
+    Directory in which the checkpoints of one run of a config are kept. It is named after the settings that define
+    the run, so a run still resumes after a change of e.g. num_workers or async_logger, see results_store.config_hash
+    '''
+    return os.path.join(root, config_hash(config), "seed_{}".format(seed))
+
 
+def get_measures(config):
+    '''
+    The measures of the messages of the game defined in the config
+    '''
     if config["fixed_size"]:
         stop_symbol = config["n_symbols"]
     else:
@@ -81,89 +195,122 @@ def run_game_with_config(config):
 
 
     msg_len_measure = MsgLength("msg_len", stop_symbol=stop_symbol)
-    measure_callbacks = MeasureCallbacks(test_dataloader,
-                                         measures=[symbol_entropy, bi_gram_entropy, distinct_measure, msg_len_measure,
-                                                   tri_gram_entropy])
+    return [symbol_entropy, bi_gram_entropy, distinct_measure, msg_len_measure, tri_gram_entropy]
 
-    reset_trainer = ResetDatasetCallback(train_dataloader.dataset)
 
-    trainer = pl.Trainer(default_root_dir='logs',
-                         checkpoint_callback=False,
-                         # checkpoint_callback=ModelCheckpoint(save_weights_only=True, mode="min", monitor="val_loss"),
-                         gpus=1 if torch.cuda.is_available() else 0,
-                         max_epochs=max_epochs,
-                         log_every_n_steps=1,
-                         callbacks=[msg_callback, freq_callback, measure_callbacks, reset_trainer],
-                         progress_bar_refresh_rate=1)
-    trainer.logger._default_hp_metric = None  # Optional logging argument that we don't need
-
-    trainer.fit(signalling_game_model, train_dataloader, test_dataloader)
-
-    return {**trainer.callback_metrics, **measure_callbacks.latest}
-
-
-def print_best_pretty(base_config, best):
-    names = [
-        var[:-1] for var in base_config["grid_search_vars"]
-    ]
-    for name in names:
-        print("{}, {}".format(name, best[name]))
+def get_batch_size(config):
+    '''
+    The batch size is the number of candidates with in batch negatives, the other games keep batches of 32
+    '''
+    return config["batch_size"] if config.get("in_batch_negatives", False) else 32
 
 
-def construct_configs(base_config):
+def get_datasets(config):
+    '''
+    The train and test datasets of the attribute game defined in the config
     '''
-    Construct configs
+    return get_attribute_datasets(config["n_attributes"], config["attributes_size"], batch_size=get_batch_size(config),
+                                  samples_per_epoch_train=config["samples_per_epoch_train"],
+                                  samples_per_epoch_test=config["samples_per_epoch_test"],
+                                  n_receiver=config["n_receiver"], n_remove_classes=config.get("n_remove_classes", 0),
+                                  in_batch_negatives=config.get("in_batch_negatives", False),
+                                  hard_negative_fraction=config.get("hard_negative_fraction", 0.0),
+                                  class_ids=config.get("frozen_encoder", False),
+                                  ### The distractor sampler replaces the candidates of the training episodes
+                                  targets_only=config.get("adaptive_distractors", False))
+
+
+def run_game_with_config(config, checkpoint_dir=None, encoders=None, datasets=None, return_model=False,
+                         store_path=None, seed=None):
     '''
-    to_combine = [
-        list(base_config[var]) for var in base_config["grid_search_vars"]
-    ]
+    Train the attribute game defined in the config
+    :param checkpoint_dir: if given, checkpoints are saved to this directory and the run resumes from the latest one
+    :param encoders: pretrained feature encoders to start from, see get_game
+    :param datasets: the already built (train, test) datasets, see get_datasets
+    :param store_path: if given, the metrics of every epoch are added to this results store, as the run with seed
+    :return: the metrics, or (the metrics, the trained model) with return_model
+    '''
+    max_epochs = config["max_epochs"]
+
+    in_batch_negatives = config.get("in_batch_negatives", False)
 
-    names = [
-        var[:-1] for var in base_config["grid_search_vars"]
-    ]
+    if datasets is None:
+        datasets = get_datasets(config)
+    train_dataloader, test_dataloader = get_attribute_loaders(*datasets, batch_size=get_batch_size(config),
+                                                              in_batch_negatives=in_batch_negatives,
+                                                              num_workers=config.get("num_workers", 0),
+                                                              persistent_workers=config.get("persistent_workers", False),
+                                                              prefetch_factor=config.get("prefetch_factor", 2),
+                                                              pin_memory=config.get("pin_memory", False))
 
-    vars = list(product(*to_combine))
+    resume_from = latest_checkpoint(checkpoint_dir) if checkpoint_dir else None
 
-    configs = []
-    for vals in vars:
-        c = base_config.copy()
-        for i, name in enumerate(names):
-            c[name] = vals[i]
-        configs.append(c)
-    return configs
+    ### When resuming, all the weights come from the checkpoint so pretraining can be skipped
+    signalling_game_model = get_game(config, pretrain=resume_from is None, encoders=encoders)
 
+    to_sample_from = next(iter(test_dataloader))[:5]
 
-def result_to_file(name, results):
-    with open(name, 'w') as outfile:
-        yaml.dump(results, outfile)
+    msg_callback = MsgCallback(to_sample_from, )
 
+    freq_callback = MsgFrequencyCallback(to_sample_from)
 
-def get_summary_results(name):
-    with open(name) as f:
-        results = yaml.load(f)
+    measures = get_measures(config)
+    if config.get("message_table_measures", False):
+        ### Compute the measures on the messages of the test classes instead of the whole test set
+        measure_callbacks = MessageTableCallback(test_dataloader.dataset, measures=measures)
+    else:
+        measure_callbacks = MeasureCallbacks(test_dataloader, measures=measures)
 
-    return {k: (np.mean(v), np.std(v)) for k, v in results.items()}
+    reset_trainer = ResetDatasetCallback(train_dataloader.dataset)
 
-def get_summary_results_filtered(name):
-    with open(name) as f:
-        results = yaml.load(f)
-    useidc = []
-    for k, v in results.items():
-        if k == "val_accuracy_epoch":
-            for i in range(len(v)):
-                if v[i] > 0.0:
-                    useidc.append(i)
-    resultreturn = dict()
-    for k, v in results.items():
-        vgood = [v[i] for i in useidc]
-        resultreturn[k] = (np.mean(vgood), np.std(vgood))
+    num_processes = config.get("num_processes", 1)
+
+    callbacks = [DistributedDatasetCallback([train_dataloader.dataset, test_dataloader.dataset]),
+                 msg_callback, freq_callback, measure_callbacks]
+    if store_path:
+        callbacks.append(ResultsStoreCallback(store_path, config, seed, measure_callbacks))
+    if checkpoint_dir:
+        ### Should come before the reset, so the dataset epoch and random state from before the reset are saved
+        callbacks.append(AsyncCheckpointCallback(checkpoint_dir, every_n_epochs=config.get("checkpoint_every_n_epochs", 1),
+                                                 keep_last_k=config.get("checkpoint_keep_last_k", 2),
+                                                 dataset=train_dataloader.dataset))
+    callbacks.append(reset_trainer)
+    if config.get("profile", False):
+        ### The profiler should be last, so it also times the end of epoch work of the other callbacks
+        callbacks.append(ProfilerCallback(trace_steps=config.get("profile_trace_steps", [])))
+    if num_processes > 1:
+        results_path = os.path.join(tempfile.mkdtemp(), "results.pt")
+        callbacks.append(SaveResultsCallback(results_path, measure_callbacks))
+
+    ### The metrics and message texts are written to disk by a background thread
+    logger = get_logger('logs', async_logger=config.get("async_logger", True),
+                        max_queue=config.get("logger_queue_size", 10000),
+                        flush_secs=config.get("logger_flush_secs", 5.0),
+                        block_timeout=config.get("logger_block_timeout", 0.1))
 
-    return resultreturn
+    trainer = pl.Trainer(default_root_dir='logs',
+                         logger=logger,
+                         checkpoint_callback=False,
+                         # checkpoint_callback=ModelCheckpoint(save_weights_only=True, mode="min", monitor="val_loss"),
+                         max_epochs=max_epochs,
+                         log_every_n_steps=1,
+                         callbacks=callbacks,
+                         **get_distributed_trainer_kwargs(num_processes),
+                         resume_from_checkpoint=resume_from,
+                         # The sanity check would use up random numbers of the restored random state
+                         num_sanity_val_steps=0 if resume_from else 2,
+                         progress_bar_refresh_rate=1)
+    trainer.logger._default_hp_metric = None  # Optional logging argument that we don't need
 
+    trainer.fit(signalling_game_model, train_dataloader, test_dataloader)
 
-def create_name(config):
-    if "name" in config.keys():
-        return config["name"] + ".yml"
+    if num_processes > 1:
+        ### The training happened in spawned processes, rank 0 saved the results
+        results = torch.load(results_path)
     else:
-        return "experiment_{}_{}_{}_{}_{}.yml".format(config["n_receiver"], config["n_attributes"], config["attributes_size"],
-                                               config["with_predictor"], config["n_remove_classes"])
+        results = {**trainer.callback_metrics, **measure_callbacks.latest}
+
+    if return_model:
+        ### With data parallel training the weights of this process are not the trained ones
+        return results, signalling_game_model
+    return results
@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import yaml
+
+from datasets.AttributeDataset import encode_classes, classes_to_one_hot
+from decoding import use_decode_mode
+from experiment_utils import load_trained_game
+from message import to_indices
+
+### Bounds of a single request, larger requests are refused instead of slowing down every other client
+MAX_BODY_BYTES = 1 << 20
+MAX_HEADERS = 64
+MAX_EPISODES_PER_REQUEST = 256
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ServerStats:
+    '''
+    Latency and throughput of the server. The percentiles are over the last n_latencies episodes.
+    '''
+
+    def __init__(self, n_latencies=10000):
+        self.latencies = deque(maxlen=n_latencies)
+        self.start = time.perf_counter()
+        self.episodes = 0
+        self.batches = 0
+        self.rejected = 0
+
+    def add_batch(self, latencies):
+        self.latencies.extend(latencies)
+        self.episodes += len(latencies)
+        self.batches += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        summary = {
+            "episodes": self.episodes,
+            "batches": self.batches,
+            "rejected": self.rejected,
+            "episodes_per_second": self.episodes / elapsed,
+            "mean_batch_size": self.episodes / max(self.batches, 1),
+        }
+        if self.latencies:
+            p50, p90, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 90, 99])
+            summary.update({"latency_ms_p50": float(p50), "latency_ms_p90": float(p90), "latency_ms_p99": float(p99)})
+        return summary
+
+
+class MicroBatcher:
+    '''
+    Collects the episodes of concurrent requests into batches. A batch is run as soon as it has max_batch_size
+    episodes, or max_wait_ms after its first episode arrived. The model runs in a worker thread, so the server keeps
+    accepting requests in the meantime.
+    '''
+
+    def __init__(self, run_batch, max_batch_size=64, max_wait_ms=5, max_queue=4096):
+        '''
+        :param run_batch: function from a list of episodes to the list of their results
+        :param max_queue: number of episodes that can wait, more are refused with Overloaded
+        '''
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        ### One thread, torch parallelises inside the batch
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = ServerStats()
+
+    async def submit(self, episodes):
+        '''
+        Queues the episodes of one request and waits for their results
+        '''
+        if self.queue.maxsize - self.queue.qsize() < len(episodes):
+            self.stats.rejected += len(episodes)
+            raise Overloaded()
+        loop = asyncio.get_running_loop()
+        futures = []
+        for episode in episodes:
+            future = loop.create_future()
+            self.queue.put_nowait((episode, future, time.perf_counter()))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [item[0] for item in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            end = time.perf_counter()
+            for (_, future, _), result in zip(batch, results):
+                ### The client may have disconnected in the meantime
+                if not future.done():
+                    future.set_result(result)
+            self.stats.add_batch([end - start for _, _, start in batch])
+
+
+class GameRunner:
+    '''
+    Runs batches of episodes through a trained attribute game: the message of the sender, the choice of the receiver
+    and, when the game has a predictor, the surprisal of every symbol under the predictor
+    '''
+
+    def __init__(self, model, config, decode_mode=None):
+        self.model = model.cpu().eval()
+        self.n_attributes = config["n_attributes"]
+        self.attributes_size = config["attributes_size"]
+        self.n_classes = self.attributes_size ** self.n_attributes
+        self.n_candidates = config["n_receiver"]
+        self.class_ids = config.get("frozen_encoder", False)
+        self.decode_mode = decode_mode or model.eval_decode_mode
+
+    def parse_item(self, item):
+        '''
+        A class id from a class id or from a list of attribute values
+        '''
+        if isinstance(item, list):
+            if len(item) != self.n_attributes or not all(
+                    isinstance(value, int) and not isinstance(value, bool) and 0 <= value < self.attributes_size
+                    for value in item):
+                raise BadRequest("an item should be {} attribute values below {}".format(self.n_attributes,
+                                                                                       self.attributes_size))
+            return int(encode_classes([item], self.n_attributes, self.attributes_size)[0])
+        if isinstance(item, bool) or not isinstance(item, int) or not 0 <= item < self.n_classes:
+            raise BadRequest("a class id should be below {}".format(self.n_classes))
+        return item
+
+    def parse_episode(self, episode):
+        '''
+        An episode is {"sender": item, "candidates": [item, ...]}, with n_receiver candidates
+        '''
+        if not isinstance(episode, dict) or "sender" not in episode or "candidates" not in episode:
+            raise BadRequest("an episode should have a sender and candidates")
+        candidates = episode["candidates"]
+        if not isinstance(candidates, list) or len(candidates) != self.n_candidates:
+            raise BadRequest("an episode should have {} candidates".format(self.n_candidates))
+        return self.parse_item(episode["sender"]), [self.parse_item(item) for item in candidates]
+
+    def to_items(self, ids):
+        if self.class_ids:
+            return torch.as_tensor(ids, dtype=torch.long)
+        return classes_to_one_hot(ids, self.n_attributes, self.attributes_size)
+
+    @torch.no_grad()
+    def __call__(self, episodes):
+        senders = self.to_items([sender for sender, _ in episodes])
+        candidates = [self.to_items([episode[1][i] for episode in episodes]) for i in range(self.n_candidates)]
+
+        with use_decode_mode(self.model.sender, self.decode_mode):
+            msg, _, out, out_probs, _, prediction_probs = self.model.forward(senders, candidates)
+
+        ### Time first, the symbols of every episode are a column
+        symbols = to_indices(msg)
+        choices = torch.argmax(out_probs, dim=-1)
+
+        surprisal = None
+        if prediction_probs is not None:
+            probs = prediction_probs.gather(-1, symbols.unsqueeze(dim=-1)).squeeze(dim=-1)
+            surprisal = -torch.log2(probs.clamp_min(1e-12))
+
+        results = []
+        for i in range(len(episodes)):
+            result = {
+                "message": symbols[:, i].tolist(),
+                "choice": int(choices[i]),
+                "choice_probabilities": out_probs[i].tolist(),
+            }
+            if surprisal is not None:
+                result["surprisal"] = surprisal[:, i].tolist()
+            results.append(result)
+        return results
+
+
+class InferenceServer:
+    '''
+    A small HTTP/1.1 server, over tcp or a unix socket, with the routes
+        POST /episodes  {"episodes": [{"sender": ..., "candidates": [...]}, ...]} -> {"results": [...]}
+        GET /stats      latency percentiles and throughput
+        GET /health
+    Items are class ids or lists of attribute values.
+    '''
+
+    def __init__(self, runner, batcher):
+        self.runner = runner
+        self.batcher = batcher
+
+    async def route(self, method, path, body):
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/stats":
+            return 200, self.batcher.stats.summary()
+        if path != "/episodes":
+            return 404, {"error": "unknown path"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        try:
+            request = json.loads(body)
+            episodes = request["episodes"] if isinstance(request, dict) and "episodes" in request else [request]
+            if not isinstance(episodes, list) or not 0 < len(episodes) <= MAX_EPISODES_PER_REQUEST:
+                raise BadRequest("a request should have 1 to {} episodes".format(MAX_EPISODES_PER_REQUEST))
+            episodes = [self.runner.parse_episode(episode) for episode in episodes]
+        except (ValueError, BadRequest) as e:
+            return 400, {"error": str(e)}
+
+        try:
+            return 200, {"results": await self.batcher.submit(episodes)}
+        except Overloaded:
+            return 503, {"error": "too many episodes are waiting, retry later"}
+
+    async def read_request(self, reader):
+        '''
+        Reads one request, returns None when the client closed the connection
+        '''
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise BadRequest("malformed request line")
+        method, path, version = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                return method, path, version, headers, 431
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            return method, path, version, headers, 413
+        body = await reader.readexactly(length)
+        return method, path, version, headers, body
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except (BadRequest, ValueError, asyncio.LimitOverrunError):
+                    self.respond(writer, 400, {"error": "malformed request"}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+                if isinstance(body, int):
+                    ### The body was too large or there were too many headers, it was not read so the connection ends
+                    status, payload, keep_alive = body, {"error": REASONS[body]}, False
+                else:
+                    try:
+                        status, payload = await self.route(method, path.split("?")[0], body)
+                    except Exception as e:
+                        status, payload = 500, {"error": repr(e)}
+
+                self.respond(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        head = "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+            status, REASONS[status], len(body), "keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + body)
+
+    async def serve(self, host="127.0.0.1", port=8080, unix_socket=None):
+        ### The limit bounds the length of the request line and of every header line
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket, limit=16384)
+            print("Serving on {}".format(unix_socket))
+        else:
+            server = await asyncio.start_server(self.handle, host, port, limit=16384)
+            print("Serving on http://{}:{}".format(host, port))
+        batching = asyncio.ensure_future(self.batcher.run())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batching.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a trained attribute game, the episodes of concurrent requests '
+                                                 'are run in batches')
+
+    parser.add_argument('--config', default="config/example_experiment.yaml", required=False)
+    parser.add_argument('--checkpoint', required=True,
+                        help='Checkpoint of the trained game, for example from the AsyncCheckpointCallback')
+    parser.add_argument('--host', default="127.0.0.1", required=False)
+    parser.add_argument('--port', type=int, default=8080, required=False)
+    parser.add_argument('--unix_socket', default=None, required=False, help='Listen on a unix socket instead of tcp')
+    parser.add_argument('--max_batch_size', type=int, default=64, required=False)
+    parser.add_argument('--max_wait_ms', type=float, default=5, required=False)
+    parser.add_argument('--max_queue', type=int, default=4096, required=False)
+    parser.add_argument('--int8', action='store_true', help='Serve the dynamically quantized game, see quantize.py')
+
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    game = load_trained_game(config, args.checkpoint)
+    if args.int8:
+        from quantize import quantize_game
+
+        game = quantize_game(game)
+
+    runner = GameRunner(game, config)
+
+    async def main():
+        ### The queue of the batcher belongs to the event loop, so it is made inside it
+        batcher = MicroBatcher(runner, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                               max_queue=args.max_queue)
+        await InferenceServer(runner, batcher).serve(args.host, args.port, args.unix_socket)
+
+    asyncio.run(main())
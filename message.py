@@ -0,0 +1,95 @@
+import torch
+
+
+class Message:
+    '''
+    A batch of messages. Holds the straight through one hot tensor, which is needed for the gradients, together with
+    the symbol indices and the lengths of the messages. The indices and lengths are computed once, when they are
+    first needed, so the consumers of a message do not each take the argmax again.
+    '''
+
+    def __init__(self, one_hot, stop_symbol=0, time_dim=0):
+        '''
+        :param one_hot: the one hot symbols, [msg_len, batch, n_symbols] or [batch, msg_len, n_symbols]
+        :param stop_symbol: the symbol that ends a message, it is included in the length
+        :param time_dim: the dimension of one_hot that is the position in the message
+        '''
+        self.one_hot = one_hot
+        self.stop_symbol = stop_symbol
+        self.time_dim = time_dim
+        self._indices = None
+        self._lengths = None
+
+    @property
+    def indices(self):
+        '''
+        The symbols as a long tensor, with the same layout as one_hot without the symbol dimension
+        '''
+        if self._indices is None:
+            self._indices = torch.argmax(self.one_hot, dim=-1)
+        return self._indices
+
+    @property
+    def lengths(self):
+        '''
+        The length of every message up to and including the first stop symbol, as a long tensor on the cpu
+        '''
+        if self._lengths is None:
+            is_stop = self.indices == self.stop_symbol
+            msg_len = is_stop.shape[self.time_dim]
+            first_stop = torch.argmax(is_stop.int(), dim=self.time_dim) + 1
+            self._lengths = torch.where(is_stop.any(dim=self.time_dim), first_stop,
+                                        torch.full_like(first_stop, msg_len)).cpu()
+        return self._lengths
+
+    @property
+    def requires_grad(self):
+        '''
+        If the gradients should flow back through the symbols, otherwise the indices can be used instead
+        '''
+        return torch.is_grad_enabled() and self.one_hot.requires_grad
+
+    @property
+    def shape(self):
+        return self.one_hot.shape
+
+    def __len__(self):
+        return len(self.one_hot)
+
+
+def to_one_hot(msg):
+    '''
+    The one hot tensor of a Message or a one hot tensor
+    '''
+    if isinstance(msg, Message):
+        return msg.one_hot
+    return msg
+
+
+def to_indices(msg):
+    '''
+    The symbol indices of a Message or a one hot tensor
+    '''
+    if isinstance(msg, Message):
+        return msg.indices
+    return torch.argmax(msg, dim=-1)
+
+
+def linear_of_flat_message(linear, indices, n_symbols):
+    '''
+    Computes linear(msg.view(msg.shape[1], -1)) of a [msg_len, batch, n_symbols] one hot message from its
+    [msg_len, batch] indices, with an embedding bag over the columns of the weight instead of a matrix product.
+    The flattened view makes row b out of the (position, batch) pairs b * msg_len ... (b + 1) * msg_len - 1 in
+    memory order, the k-th of which is at columns k * n_symbols ... (k + 1) * n_symbols - 1.
+    :param linear: the nn.Linear with n_symbols * msg_len inputs
+    '''
+    msg_len, batch_size = indices.shape
+    columns = indices.reshape(batch_size, msg_len) + torch.arange(msg_len, device=indices.device) * n_symbols
+    weight, bias = linear.weight, linear.bias
+    if callable(weight):
+        ### A dynamically quantized linear layer, see quantize.quantize_game, has its int8 weight behind a method
+        weight, bias = weight().dequantize(), bias()
+    hidden = torch.nn.functional.embedding_bag(columns, weight.t(), mode='sum')
+    if bias is not None:
+        hidden = hidden + bias
+    return hidden
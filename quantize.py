@@ -0,0 +1,122 @@
+import argparse
+import copy
+import io
+import time
+
+import torch
+import yaml
+from torch import nn
+
+from attribute_game.pl_model import unpack_batch
+from decoding import use_decode_mode
+from experiment_utils import get_game, get_datasets, get_batch_size, load_trained_game
+from datasets.AttributeDataset import get_attribute_loaders
+from message import to_indices
+
+### The layers that get int8 weights, their activations are quantized on the fly for every batch
+QUANTIZED_LAYERS = {nn.Linear, nn.LSTM}
+
+
+def quantize_game(model):
+    '''
+    Returns a copy of a trained game for inference on the cpu, in which the Linear and LSTM layers of the sender,
+    the receiver and the predictor are dynamically quantized to int8
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.quantization.quantize_dynamic(model, QUANTIZED_LAYERS, dtype=torch.qint8, inplace=True)
+
+
+def load_quantized(config, path):
+    '''
+    Loads the weights of a quantized game, as saved by this script
+    :param config: the config the game was trained with
+    '''
+    model = quantize_game(get_game(config, pretrain=False))
+    model.load_state_dict(torch.load(path))
+    return model
+
+
+def model_size(model):
+    '''
+    Size of the saved weights of a model in bytes
+    '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+@torch.no_grad()
+def run_inference(model, dataloader, decode_mode='argmax'):
+    '''
+    Runs a game batch by batch over a dataloader on the cpu
+    :param decode_mode: decode mode of the sender, argmax makes the messages deterministic
+    :return: the messages [n, msg_len], the predicted candidates [n] and the targets [n]
+    '''
+    model = model.cpu().eval()
+    device = torch.device("cpu")
+    msgs, predictions, targets = [], [], []
+    with use_decode_mode(model.sender, decode_mode):
+        for batch in dataloader:
+            sender_img, receiver_imgs, target = unpack_batch(batch, device, model.in_batch_negatives)
+            msg, msg_packed, out, out_probs, _, _ = model.forward(sender_img, receiver_imgs)
+
+            msgs.append(to_indices(msg).permute(1, 0))
+            predictions.append(torch.argmax(out_probs, dim=-1))
+            targets.append(target)
+    return torch.cat(msgs), torch.cat(predictions), torch.cat(targets)
+
+
+def parity_report(model, quantized, dataloader):
+    '''
+    Compares the quantized game with the fp32 game on the same data, both with argmax messages
+    :return: dict with the accuracy of both, how often they send the same message and choose the same candidate,
+    their throughput in samples per second and the size of their weights
+    '''
+    report = {}
+    outputs = {}
+    for name, game in (("fp32", model), ("int8", quantized)):
+        start = time.perf_counter()
+        outputs[name] = run_inference(game, dataloader)
+        elapsed = time.perf_counter() - start
+
+        msgs, predictions, targets = outputs[name]
+        report[name + "_accuracy"] = (predictions == targets).float().mean().item()
+        report[name + "_samples_per_second"] = len(targets) / elapsed
+        report[name + "_bytes"] = model_size(game)
+
+    msgs, predictions, _ = outputs["fp32"]
+    msgs_int8, predictions_int8, _ = outputs["int8"]
+    report["message_agreement"] = (msgs == msgs_int8).all(dim=-1).float().mean().item()
+    report["symbol_agreement"] = (msgs == msgs_int8).float().mean().item()
+    report["prediction_agreement"] = (predictions == predictions_int8).float().mean().item()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export an int8 quantized copy of a trained attribute game and '
+                                                 'compare it with the fp32 game')
+
+    parser.add_argument('--config', default="config/example_experiment.yaml", required=False)
+    parser.add_argument('--checkpoint', required=True,
+                        help='Checkpoint of the trained game, for example from the AsyncCheckpointCallback')
+    parser.add_argument('--out', default="game_int8.pt", required=False)
+    parser.add_argument('--batch_size', type=int, default=1024, required=False,
+                        help='Batch size of the inference, with in batch negatives the batch size of the config is used')
+
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    game = load_trained_game(config, args.checkpoint)
+
+    in_batch_negatives = config.get("in_batch_negatives", False)
+    batch_size = get_batch_size(config) if in_batch_negatives else args.batch_size
+    _, test_dataloader = get_attribute_loaders(*get_datasets(config), batch_size=batch_size,
+                                               in_batch_negatives=in_batch_negatives)
+
+    quantized_game = quantize_game(game)
+    torch.save(quantized_game.state_dict(), args.out)
+
+    for key, value in parity_report(game, quantized_game, test_dataloader).items():
+        print("{}: {}".format(key, value))
@@ -0,0 +1,225 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+
+import yaml
+
+from experiment_config import create_name
+
+### Config keys that only steer the experiment scripts and do not change the results of a run
+IGNORED_CONFIG_KEYS = {"n_runs", "metrics", "metric"}
+### Settings of the data loading, profiling, checkpointing and logging, a run gives the same results with any of them
+RUNTIME_CONFIG_KEYS = {"num_workers", "persistent_workers", "prefetch_factor", "pin_memory", "profile",
+                       "profile_trace_steps", "checkpoint_every_n_epochs", "checkpoint_keep_last_k", "async_logger",
+                       "logger_queue_size", "logger_flush_secs", "logger_block_timeout"}
+
+
+def config_hash(config):
+    '''
+    A stable hash of all the settings of a config that influence the results of a run
+    '''
+    relevant = {key: value for key, value in config.items()
+                if key not in IGNORED_CONFIG_KEYS and key not in RUNTIME_CONFIG_KEYS}
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def config_metrics(config):
+    '''
+    The metrics that are stored for the runs of a config: its "metrics" and the "metric" of a grid search
+    '''
+    metrics = list(config.get("metrics", []))
+    if config.get("metric") is not None and config["metric"] not in metrics:
+        metrics.append(config["metric"])
+    return metrics
+
+
+def final_epoch(config):
+    '''
+    The index of the last epoch of the runs of a config
+    '''
+    return config["max_epochs"] - 1
+
+
+class ResultsStore:
+    '''
+    Append only store of the results of all experiments, with one row per (config hash, seed, epoch, metric).
+    Uses sqlite in WAL mode, so several runs can write to the same file at the same time.
+    The runs write their metrics every epoch (see callbacks.results_callback.ResultsStoreCallback), a run counts as
+    finished once it has results for its last epoch.
+    '''
+
+    def __init__(self, path='results.sqlite', timeout=60):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS configs (
+                config_hash TEXT PRIMARY KEY,
+                name TEXT,
+                config TEXT
+            )''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                config_hash TEXT,
+                seed INTEGER,
+                epoch INTEGER,
+                metric TEXT,
+                value REAL,
+                PRIMARY KEY (config_hash, seed, epoch, metric)
+            )''')
+
+    def add_results(self, config, seed, results, epoch=None):
+        '''
+        Stores the results of one run
+        :param config: config of the run
+        :param seed: seed of the run
+        :param results: dict of metric name to value
+        :param epoch: epoch the results belong to, the last epoch of the run if None
+        '''
+        if epoch is None:
+            epoch = final_epoch(config)
+        key = config_hash(config)
+        rows = [(key, seed, epoch, metric, float(value)) for metric, value in results.items()]
+
+        ### One write transaction per run, BEGIN IMMEDIATE makes concurrent writers wait for each other
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute('INSERT OR IGNORE INTO configs VALUES (?, ?, ?)',
+                                    (key, config.get("name"), json.dumps(config, sort_keys=True, default=str)))
+            self.connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', rows)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def seeds(self, config):
+        '''
+        Returns the seeds of the finished runs of this config, the runs with results for the last epoch
+        '''
+        rows = self.connection.execute('SELECT DISTINCT seed FROM results WHERE config_hash = ? AND epoch = ?',
+                                       (config_hash(config), final_epoch(config)))
+        return sorted(row[0] for row in rows)
+
+    def results(self, config, seed, epoch=None):
+        '''
+        Returns the results of one epoch of one run as a dict of metric name to value
+        :param epoch: the last epoch of the run if None
+        '''
+        if epoch is None:
+            epoch = final_epoch(config)
+        rows = self.connection.execute('SELECT metric, value FROM results WHERE config_hash = ? AND seed = ? AND epoch = ?',
+                                       (config_hash(config), seed, epoch))
+        return {metric: value for metric, value in rows}
+
+    def history(self, config, seed, metric):
+        '''
+        The value of a metric at every stored epoch of one run, as a list of (epoch, value)
+        '''
+        rows = self.connection.execute('''
+            SELECT epoch, value FROM results WHERE config_hash = ? AND seed = ? AND metric = ? ORDER BY epoch''',
+                                       (config_hash(config), seed, metric))
+        return list(rows)
+
+    def summaries(self, configs, filter_metric=None, filter_threshold=0.0):
+        '''
+        Mean and std of every metric at the last epoch of the finished runs, for all configs in a single query.
+        :param configs: list of configs
+        :param filter_metric: if given, only runs for which this metric is above filter_threshold are used
+        :return: list with for every config a dict of metric name to (mean, std)
+        '''
+        if len(configs) == 0:
+            return []
+        keys = [config_hash(config) for config in configs]
+        ### The last epoch of every config, as a table to join the results with
+        finals = ','.join(['(?, ?)'] * len(keys))
+
+        filter_clause = ''
+        params = [value for key, config in zip(keys, configs) for value in (key, final_epoch(config))]
+        if filter_metric is not None:
+            filter_clause = '''
+                AND EXISTS (SELECT 1 FROM results f
+                            WHERE f.config_hash = r.config_hash AND f.seed = r.seed AND f.epoch = r.epoch
+                                  AND f.metric = ? AND f.value > ?)'''
+            params += [filter_metric, filter_threshold]
+
+        ### The variance is the mean squared distance to the mean, AVG(x * x) - AVG(x) * AVG(x) loses its precision
+        ### when the values are close together
+        query = '''
+            WITH finals(config_hash, epoch) AS (VALUES {}),
+            runs AS (SELECT r.config_hash, r.metric, r.value
+                     FROM results r JOIN finals l ON l.config_hash = r.config_hash AND l.epoch = r.epoch
+                     WHERE 1 {}),
+            means AS (SELECT config_hash, metric, AVG(value) AS mean FROM runs GROUP BY config_hash, metric)
+            SELECT runs.config_hash, runs.metric, means.mean, AVG((runs.value - means.mean) * (runs.value - means.mean))
+            FROM runs JOIN means ON means.config_hash = runs.config_hash AND means.metric = runs.metric
+            GROUP BY runs.config_hash, runs.metric
+            ORDER BY runs.metric'''.format(finals, filter_clause)
+
+        per_key = {key: {} for key in keys}
+        for key, metric, mean, variance in self.connection.execute(query, params):
+            ### Population std, the same as np.std
+            per_key[key][metric] = (mean, math.sqrt(max(variance, 0.0)))
+
+        return [per_key[key] for key in keys]
+
+    def summary(self, config, filter_metric=None, filter_threshold=0.0):
+        return self.summaries([config], filter_metric=filter_metric, filter_threshold=filter_threshold)[0]
+
+    def import_yaml(self, path, config):
+        '''
+        Imports a results file written by experiment_config.result_to_file.
+        The runs in these files were seeded with their index.
+        '''
+        with open(path) as f:
+            results = yaml.safe_load(f)
+
+        n_runs = max(len(values) for values in results.values())
+        for seed in range(n_runs):
+            run = {metric: values[seed] for metric, values in results.items() if seed < len(values)}
+            self.add_results(config, seed, run)
+
+    def close(self):
+        self.connection.close()
+
+
+def import_legacy_results(store, config):
+    '''
+    Imports the old yaml results file of a config when the store has no results for it yet
+    '''
+    name = create_name(config)
+    if len(store.seeds(config)) == 0 and os.path.exists(name):
+        store.import_yaml(name, config)
+
+
+def load_summary(store, config, filtered=False):
+    '''
+    Summary of the results of a config, see ResultsStore.summary
+    '''
+    import_legacy_results(store, config)
+
+    if filtered:
+        return store.summary(config, filter_metric="val_accuracy_epoch")
+    return store.summary(config)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import the yaml results of experiment configs into the results store')
+
+    parser.add_argument('configs', nargs='+')
+    parser.add_argument('--store', default='results.sqlite', required=False)
+
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    for config_name in args.configs:
+        with open(config_name) as f:
+            config = yaml.safe_load(f)
+        name = create_name(config)
+        if os.path.exists(name):
+            store.import_yaml(name, config)
+            print("imported {}".format(name))
+        else:
+            print("no results found for {}".format(config_name))
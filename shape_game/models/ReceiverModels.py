@@ -1,13 +1,14 @@
 import torch
 from torch import nn
 
-from shape_game.models.VisualModels import HiddenStateModel
+from shape_game.models.VisualModels import HiddenStateModel, encode_fused
 
 
 class ReceiverModuleFixedLength(nn.Module):
-    def __init__(self, output_dim, msg_len=5, n_symbols=3, n_xs=3, hidden_state_model=None, tau=0.5):
+    def __init__(self, output_dim, msg_len=5, n_symbols=3, n_xs=3, hidden_state_model=None, tau=0.5, fused=False):
         '''
         A receiver that receives fixed length messages
+        :param fused: run all the candidates through the visual model as one batch instead of one call per candidate
         '''
         super(ReceiverModuleFixedLength, self).__init__()
 
@@ -27,15 +28,30 @@ class ReceiverModuleFixedLength(nn.Module):
         self.n_xs = n_xs
         self.msg_len = msg_len
         self.n_symbols = n_symbols
+        self.fused = fused
+
+    def encode_candidates(self, xs):
+        '''
+        The hidden states of the candidates, [batch, n_xs, hidden_state_size]
+        '''
+        if self.fused:
+            return torch.stack(encode_fused(self.to_hidden, xs), dim=1)
 
-    def forward(self, xs, msg):
         hidden_states = []
         for x in xs:
             hidden_state = self.to_hidden(x).unsqueeze(1)
 
             hidden_states.append(hidden_state)
 
-        hidden = torch.cat(hidden_states, dim=1)
+        return torch.cat(hidden_states, dim=1)
+
+    def forward(self, xs, msg):
+        return self.receive(self.encode_candidates(xs), msg)
+
+    def receive(self, hidden, msg):
+        '''
+        The prediction of the target given the hidden states of the candidates
+        '''
         hidden = hidden.reshape(-1, self.hidden_state_size * self.n_xs)
 
         ### Put it one after the other
@@ -47,3 +63,52 @@ class ReceiverModuleFixedLength(nn.Module):
 
         out_probs = torch.softmax(out, dim=-1)
         return out, out_probs
+
+
+class ReceiverModuleDotProduct(nn.Module):
+    def __init__(self, output_dim, msg_len=5, n_symbols=3, hidden_state_model=None):
+        '''
+        A receiver that scores every candidate image against the fixed length message with a shared bilinear head.
+        All the candidates go through the visual model as one batch, and any number of candidates can be used.
+        '''
+        super(ReceiverModuleDotProduct, self).__init__()
+
+        if hidden_state_model:
+            self.to_hidden = hidden_state_model
+        else:
+            self.to_hidden = HiddenStateModel(output_dim)
+
+        self.hidden_state_size = self.to_hidden.hidden_state_size
+        self.msg_len = msg_len
+        self.n_symbols = n_symbols
+
+        self.msg_to_hidden = nn.Sequential(
+            nn.Linear(msg_len * n_symbols, 128),
+            nn.ReLU(),
+            nn.Linear(128, self.hidden_state_size)
+        )
+
+    def encode_candidates(self, xs):
+        '''
+        The hidden states of the candidates, [batch, n_xs, hidden_state_size]
+        '''
+        if isinstance(xs, (list, tuple)):
+            xs = torch.stack(xs, dim=1)
+        batch_size, n_xs = xs.shape[:2]
+
+        hidden = self.to_hidden(xs.reshape(batch_size * n_xs, *xs.shape[2:]))
+        return hidden.reshape(batch_size, n_xs, self.hidden_state_size)
+
+    def forward(self, xs, msg):
+        return self.receive(self.encode_candidates(xs), msg)
+
+    def receive(self, hidden, msg):
+        '''
+        The prediction of the target given the hidden states of the candidates
+        '''
+        hidden_msg = self.msg_to_hidden(msg.reshape(-1, self.msg_len * self.n_symbols)).unsqueeze(dim=-1)
+
+        out = torch.bmm(hidden, hidden_msg).squeeze(dim=-1) / self.hidden_state_size ** 0.5
+
+        out_probs = torch.softmax(out, dim=-1)
+        return out, out_probs
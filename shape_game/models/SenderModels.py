@@ -2,12 +2,14 @@ import torch
 from torch import nn
 import numpy as np
 
+from decoding import decode_symbols
 from shape_game.models.VisualModels import HiddenStateModel
 
 
 class SenderModelFixedLength(nn.Module):
 
-    def __init__(self, output_dim, msg_len=5, n_symbols=3, hidden_state_model=None, tau=0.5, discreet=True):
+    def __init__(self, output_dim, msg_len=5, n_symbols=3, hidden_state_model=None, tau=0.5, discreet=True,
+                 decode_mode='gumbel', top_k=2):
         '''
         A sender that send fixed length messages
         '''
@@ -28,17 +30,26 @@ class SenderModelFixedLength(nn.Module):
         self.msg_len = msg_len
         self.n_symbols = n_symbols
         self.discreet = discreet
+        ### How the symbols are chosen from the logits, see decoding.decode_symbols
+        self.decode_mode = decode_mode
+        self.top_k = top_k
 
     def forward(self, x):
-        hidden_state = self.to_hidden(x)
+        return self.send(self.to_hidden(x))
+
+    def send(self, hidden_state):
+        '''
+        The message of the hidden states of the sender images
+        '''
         output_logits = self.to_msg(hidden_state)
         output_logits = output_logits.reshape(-1, self.msg_len, self.n_symbols)
-        msg = torch.nn.functional.gumbel_softmax(output_logits, tau=self.tau, hard=self.discreet, dim=-1)
+        msg = decode_symbols(output_logits, self.decode_mode, tau=self.tau, hard=self.discreet, top_k=self.top_k)
         return msg
 
 
 class SenderRnn(nn.Module):
-    def __init__(self, output_dim, msg_len=5, n_symbols=3, hidden_state_model=None, tau=1.2):
+    def __init__(self, output_dim, msg_len=5, n_symbols=3, hidden_state_model=None, tau=1.2, decode_mode='gumbel',
+                 top_k=2):
         '''
         A sender that send fixed length messages
         '''
@@ -62,16 +73,24 @@ class SenderRnn(nn.Module):
         self.tau = tau
         self.msg_len = msg_len
         self.n_symbols = n_symbols
+        ### How the symbols are chosen from the logits, see decoding.decode_symbols
+        self.decode_mode = decode_mode
+        self.top_k = top_k
 
     def forward(self, x):
+        return self.send(self.to_hidden(x))
 
-        ###Generate messages of length msg_len. Once the stop symbol (highest number in our alphabet) is generated the rest of the string will be filled with that sign
+    def send(self, hidden_state):
+        '''
+        The message of the hidden states of the sender images
+        '''
 
-        hidden_state = self.to_hidden(x)
+        ###Generate messages of length msg_len. Once the stop symbol (highest number in our alphabet) is generated the rest of the string will be filled with that sign
 
+        batch_size = len(hidden_state)
         hidden_state = hidden_state.unsqueeze(dim=0)
-        cell_state = torch.zeros(1, len(x), self.hidden_state_size).to(hidden_state.device)
-        start_symbol = torch.zeros((1, len(x), self.n_symbols)).to(hidden_state.device)
+        cell_state = torch.zeros(1, batch_size, self.hidden_state_size).to(hidden_state.device)
+        start_symbol = torch.zeros((1, batch_size, self.n_symbols)).to(hidden_state.device)
         current_symbol = start_symbol
         result = []
 
@@ -79,7 +98,7 @@ class SenderRnn(nn.Module):
             out, (hidden_state, cell_state) = self.gru(current_symbol, (hidden_state, cell_state))
 
             out = self.to_symbol(out).reshape(1, -1, self.n_symbols)
-            symbol = torch.nn.functional.gumbel_softmax(out, tau=self.tau, hard=True, dim=-1)
+            symbol = decode_symbols(out, self.decode_mode, tau=self.tau, top_k=self.top_k)
 
             result.append(symbol)
 
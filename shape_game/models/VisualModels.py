@@ -1,5 +1,9 @@
+import copy
+from itertools import chain
+
 import torch
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class HiddenStateModel(nn.Module):
@@ -111,3 +115,63 @@ class VisualLayer(nn.Module):
     def forward(self, x):
 
         return self.layer(x)
+
+
+def fold_batch_norm(model):
+    '''
+    Returns a copy of the model for evaluation, in which every BatchNorm2d that directly follows a Conv2d in a
+    Sequential is folded into the weights of the convolution
+    '''
+    folded = copy.deepcopy(model).eval()
+    for module in folded.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(module[i], module[i + 1])
+                module[i + 1] = nn.Identity()
+    return folded
+
+
+class ChannelsLastEncoder(nn.Module):
+    def __init__(self, hidden_state_model):
+        '''
+        Runs a visual model in the channels last memory format, which the convolutions of oneDNN on the cpu and of
+        cudnn are fastest in. Outside of training the batch norms are folded into the convolutions.
+        :param hidden_state_model: the HiddenStateModel or VisualModel to run
+        '''
+        super(ChannelsLastEncoder, self).__init__()
+        self.hidden_state_model = hidden_state_model.to(memory_format=torch.channels_last)
+        self.hidden_state_size = hidden_state_model.hidden_state_size
+        ### A list, so the folded copy is not a submodule and does not end up in the state dict
+        self.folded = []
+
+    def folded_model(self):
+        '''
+        The model with the batch norms folded, made again when any of the weights changed since it was made
+        '''
+        versions = [tensor._version for tensor in chain(self.hidden_state_model.parameters(),
+                                                        self.hidden_state_model.buffers())]
+        if not self.folded or self.folded[0] != versions:
+            self.folded = [versions, fold_batch_norm(self.hidden_state_model)]
+        return self.folded[1]
+
+    def to_predictions(self, x):
+        return self.hidden_state_model.to_predictions(x.contiguous(memory_format=torch.channels_last))
+
+    def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        if self.training or torch.is_grad_enabled():
+            return self.hidden_state_model(x)
+        return self.folded_model()(x)
+
+
+def encode_fused(hidden_state_model, images):
+    '''
+    Runs several batches of images through the visual model as a single batch and splits the hidden states again
+    :param images: list of image batches, for example the sender images and the images of every candidate
+    :return: list with the hidden states of every batch
+    '''
+    sizes = [len(x) for x in images]
+    hidden = hidden_state_model(torch.cat(list(images)))
+    return torch.split(hidden, sizes)
@@ -1,16 +1,24 @@
 import pytorch_lightning as pl
 import torch
 
+from callbacks.profiler_callback import profile_phase
+from message import to_indices
+from shape_game.models.VisualModels import encode_fused
+
 
 class BaseSignaallingGameModel(pl.LightningModule):
     def __init__(self, sender, receiver, loss_module_receiver, predictor=None, loss_module_predictor=None,
-                 hparams=None):
+                 hparams=None, eval_decode_mode='argmax', fused_visual=False):
         super().__init__()
         self.sender = sender
         self.receiver = receiver
         self.predictor = predictor
         self.loss_module_receiver = loss_module_receiver
         self.loss_module_predictor = loss_module_predictor
+        ### The decode mode of the sender during the measures
+        self.eval_decode_mode = eval_decode_mode
+        ### When the sender and the receiver share their visual model, run the images of both in one batch
+        self.fused_visual = fused_visual and sender.to_hidden is receiver.to_hidden
         self.hparams = hparams
 
     def training_step(self, batch, batch_idx):
@@ -27,10 +35,11 @@ class BaseSignaallingGameModel(pl.LightningModule):
         if self.predictor:
             prediction_squeezed = prediction_logits.reshape(-1, self.sender.n_symbols)
             prediction_probs = prediction_probs.reshape(-1, self.sender.n_symbols)
-            msg_target = msg.reshape(-1, self.sender.n_symbols)
+            ### The symbols are taken once and used as the targets and for the accuracy
+            indices = to_indices(msg).reshape(-1)
 
-            loss_predictor = self.loss_module_predictor(prediction_squeezed, msg_target)
-            indices = torch.argmax(msg_target, dim=-1)
+            with profile_phase('loss'):
+                loss_predictor = self.loss_module_predictor(prediction_squeezed, indices)
             accuracyPredictions = torch.argmax(prediction_probs, dim=-1)
 
             correct = (accuracyPredictions == indices).sum().item()
@@ -38,9 +47,10 @@ class BaseSignaallingGameModel(pl.LightningModule):
             ### Log the accuracy
             self.log("accuracy predictor", predictor_accuracy, on_step=True, on_epoch=True)
 
-        loss_receiver = self.loss_module_receiver(out_probs, target)
+        with profile_phase('loss'):
+            loss_receiver = self.loss_module_receiver(out_probs, target)
 
-        loss = loss_receiver + self.hparams['predictor_loss_weight'] * loss_predictor
+            loss = loss_receiver + self.hparams['predictor_loss_weight'] * loss_predictor
 
         predicted_indices = torch.argmax(out_probs, dim=-1)
 
@@ -57,6 +67,8 @@ class BaseSignaallingGameModel(pl.LightningModule):
         parameters = list(self.sender.parameters()) + list(self.receiver.parameters())
         if self.predictor:
             parameters += list(self.predictor.parameters())
+        ### A visual model shared by the sender and the receiver should only be in the optimizer once
+        parameters = list({id(parameter): parameter for parameter in parameters}.values())
         optimizer = torch.optim.Adam(
             parameters,
             lr=self.hparams['learning_rate'])
@@ -66,18 +78,34 @@ class BaseSignaallingGameModel(pl.LightningModule):
 class SignallingGameModel(BaseSignaallingGameModel):
 
     def forward(self, sender_img, receiver_choices):
-        msg = self.sender(sender_img)
+        candidates_hidden = None
+        if self.fused_visual:
+            if not isinstance(receiver_choices, (list, tuple)):
+                receiver_choices = receiver_choices.unbind(dim=1)
+            with profile_phase('visual'):
+                sender_hidden, *candidates_hidden = encode_fused(self.sender.to_hidden,
+                                                                 [sender_img, *receiver_choices])
+            with profile_phase('sender'):
+                msg = self.sender.send(sender_hidden)
+        else:
+            with profile_phase('sender'):
+                msg = self.sender(sender_img)
         ##Make an all zeros msg to test if we are not just remembering the dataset.
         # msg = torch.zeros((len(msg), 5, 3)).to(self.device)
         prediction_logits, prediction_probs = None, None
 
         if self.predictor:
-            start_symbols = torch.zeros(len(sender_img), 1, self.sender.n_symbols).to(self.device)
-            msgs = torch.cat([start_symbols, msg], dim=1)[:]
-            msg_in = msgs
-            prediction_logits, prediction_probs, hidden = self.predictor(msg_in)
-
-        out, out_probs = self.receiver(receiver_choices, msg)
+            with profile_phase('predictor'):
+                start_symbols = torch.zeros(len(sender_img), 1, self.sender.n_symbols).to(self.device)
+                msgs = torch.cat([start_symbols, msg], dim=1)[:]
+                msg_in = msgs
+                prediction_logits, prediction_probs, hidden = self.predictor(msg_in)
+
+        with profile_phase('receiver'):
+            if candidates_hidden is not None:
+                out, out_probs = self.receiver.receive(torch.stack(candidates_hidden, dim=1), msg)
+            else:
+                out, out_probs = self.receiver(receiver_choices, msg)
 
         return msg, out, out_probs, prediction_logits, prediction_probs
 
@@ -85,19 +113,22 @@ class SignallingGameModel(BaseSignaallingGameModel):
 class SharedSignallingGameModel(BaseSignaallingGameModel):
 
     def __init__(self, sender, receiver, loss_module_receiver, predictor=None, loss_module_predictor=None,
-                 hparams=None):
+                 hparams=None, eval_decode_mode='argmax'):
         super().__init__(sender, receiver, loss_module_receiver, predictor=True,
                          loss_module_predictor=loss_module_predictor,
-                         hparams=hparams)
+                         hparams=hparams, eval_decode_mode=eval_decode_mode)
 
 
     def forward(self, sender_img, receiver_choices):
-        msg = self.sender(sender_img)
+        with profile_phase('sender'):
+            msg = self.sender(sender_img)
 
         start_symbols = torch.zeros(len(sender_img), 1, self.sender.n_symbols).to(self.device)
         msgs = torch.cat([start_symbols, msg], dim=1)[:]
         msg_in = msgs
-        out, out_probs, prediction_logits, prediction_probs, hidden = self.receiver(receiver_choices, msg_in)
+        ### The receiver and the predictor share one module, so they are timed as one phase
+        with profile_phase('receiver'):
+            out, out_probs, prediction_logits, prediction_probs, hidden = self.receiver(receiver_choices, msg_in)
 
 
 
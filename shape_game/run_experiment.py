@@ -4,98 +4,133 @@ import pytorch_lightning as pl
 import argparse
 import yaml
 
+from callbacks.async_logger import get_logger
 from callbacks.msg_callback import MsgCallback, MsgFrequencyCallback, EntropyMeasure, MeasureCallbacks, \
     ResetDatasetCallback, MsgLength, DistinctSymbolMeasure
+from callbacks.profiler_callback import ProfilerCallback
+from callbacks.distributed_callback import DistributedDatasetCallback, get_distributed_trainer_kwargs
 from shape_game.models.pl_model import SharedSignallingGameModel, SignallingGameModel
 
 from utils import get_sender, get_receiver, get_shape_signalling_game, get_predictor, cross_entropy_loss_2, \
-    get_receiver_predictor_combined
+    get_receiver_predictor_combined, get_visual_model
 
-parser = argparse.ArgumentParser(description='Run an experiment defined an a yml file')
+if __name__ == '__main__':
+    ### The guard is needed for data parallel training, the spawned processes import this file
+    parser = argparse.ArgumentParser(description='Run an experiment defined an a yml file')
 
-parser.add_argument('--config', default="config/example_config.yml", required=False)
+    parser.add_argument('--config', default="config/example_config.yml", required=False)
 
-args = parser.parse_args()
+    args = parser.parse_args()
 
-with open(args.config) as f:
-    config = yaml.load(f)
+    with open(args.config) as f:
+        config = yaml.load(f)
 
-### We first load the datasets
+    ### We first load the datasets
 
-pl.seed_everything(config["seed"])
+    pl.seed_everything(config["seed"])
 
-samples_per_epoch_train = config['samples_per_epoch_train']
-samples_per_epoch_test = config['samples_per_epoch_test']
+    samples_per_epoch_train = config['samples_per_epoch_train']
+    samples_per_epoch_test = config['samples_per_epoch_test']
 
-max_epochs = config["max_epochs"]
+    max_epochs = config["max_epochs"]
 
-msg_len = config["msg_len"]
-n_symbols = config["n_symbols"]
+    msg_len = config["msg_len"]
+    n_symbols = config["n_symbols"]
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-pretrain = config["pretrain"]
+    pretrain = config["pretrain"]
 
-sender = get_sender(n_symbols, msg_len, device, fixed_size=config["fixed_size"], pretrain=pretrain,
-                    pretrain_n_epochs=config["pretrain_n_epochs"], )
+    ### Run the visual models in the channels last format, with all the candidates of a step in one batch
+    fused_visual = config.get("fused_visual", False)
+    hidden_state_model = None
+    if config.get("shared_visual_model", False):
+        ### The sender and the receiver use the same visual model, so their images are also fused into one batch
+        hidden_state_model = get_visual_model(device, pretrain, config["pretrain_n_epochs"],
+                                              channels_last=fused_visual)
 
-if config["model_type"] == "shared":
-    receiver_predictor = get_receiver_predictor_combined(n_symbols, config["n_choices"], device, pretrain,
-                                                               pretrain_n_epochs=config["pretrain_n_epochs"],
-                                                               hidden_size=config["hidden_size_predictor"])
-else:
-    receiver = get_receiver(n_symbols, msg_len, device, pretrain=pretrain,
-                            pretrain_n_epochs=config["pretrain_n_epochs"],
-                            )
+    sender = get_sender(n_symbols, msg_len, device, fixed_size=config["fixed_size"], pretrain=pretrain,
+                        pretrain_n_epochs=config["pretrain_n_epochs"], decode_mode=config.get("decode_mode", "gumbel"),
+                        top_k=config.get("decode_top_k", 2), fused_visual=fused_visual,
+                        hidden_state_model=hidden_state_model)
 
-    predictor = get_predictor(n_symbols, 128, device)
+    if config["model_type"] == "shared":
+        receiver_predictor = get_receiver_predictor_combined(n_symbols, config["n_choices"], device, pretrain,
+                                                                   pretrain_n_epochs=config["pretrain_n_epochs"],
+                                                                   hidden_size=config["hidden_size_predictor"])
+    else:
+        receiver = get_receiver(n_symbols, msg_len, device, pretrain=pretrain,
+                                pretrain_n_epochs=config["pretrain_n_epochs"],
+                                receiver_type=config.get("receiver_type", "concat"), fused_visual=fused_visual,
+                                hidden_state_model=hidden_state_model)
 
-train_dataloader, test_dataloader = get_shape_signalling_game(batch_size=config["batch_size"],
-                                                              samples_per_epoch_train=samples_per_epoch_train,
-                                                              samples_per_epoch_test=samples_per_epoch_test)
+        predictor = get_predictor(n_symbols, 128, device)
 
-loss_module = torch.nn.CrossEntropyLoss()
+    train_dataloader, test_dataloader = get_shape_signalling_game(batch_size=config["batch_size"],
+                                                                  samples_per_epoch_train=samples_per_epoch_train,
+                                                                  samples_per_epoch_test=samples_per_epoch_test,
+                                                                  num_workers=config.get("num_workers", 0),
+                                                                  persistent_workers=config.get("persistent_workers", False),
+                                                                  prefetch_factor=config.get("prefetch_factor", 2),
+                                                                  pin_memory=config.get("pin_memory", False))
 
-loss_module_predictor = cross_entropy_loss_2
+    loss_module = torch.nn.CrossEntropyLoss()
 
+    loss_module_predictor = cross_entropy_loss_2
 
-if config["model_type"] == "shared":
 
-    signalling_game_model = SharedSignallingGameModel(sender, receiver_predictor, loss_module,
-                                            loss_module_predictor=loss_module_predictor, hparams=config).to(device)
-else:
-    signalling_game_model = SignallingGameModel(sender, receiver, loss_module, predictor=predictor,
-                                            loss_module_predictor=loss_module_predictor, hparams=config).to(device)
+    if config["model_type"] == "shared":
 
-to_sample_from = next(iter(test_dataloader))[:5]
+        signalling_game_model = SharedSignallingGameModel(sender, receiver_predictor, loss_module,
+                                                loss_module_predictor=loss_module_predictor, hparams=config,
+                                                eval_decode_mode=config.get("eval_decode_mode", "argmax")).to(device)
+    else:
+        signalling_game_model = SignallingGameModel(sender, receiver, loss_module, predictor=predictor,
+                                                loss_module_predictor=loss_module_predictor, hparams=config,
+                                                eval_decode_mode=config.get("eval_decode_mode", "argmax"),
+                                                fused_visual=fused_visual).to(device)
 
-msg_callback = MsgCallback(to_sample_from, )
+    to_sample_from = next(iter(test_dataloader))[:5]
 
-freq_callback = MsgFrequencyCallback(to_sample_from)
+    msg_callback = MsgCallback(to_sample_from, )
 
-### We create all the measures
-symbol_entropy = EntropyMeasure('symbol entropy')
-bi_gram_entropy = EntropyMeasure('bigram entropy', n_gram=2)
-len_measure = MsgLength('avg msg length', stop_symbol=config['n_symbols'] - 1)
-distinct_symbol_measure = DistinctSymbolMeasure('Number of distinct symbols')
+    freq_callback = MsgFrequencyCallback(to_sample_from)
 
-measure_callbacks = MeasureCallbacks(test_dataloader,
-                                     measures=[symbol_entropy, bi_gram_entropy, len_measure, distinct_symbol_measure])
+    ### We create all the measures
+    symbol_entropy = EntropyMeasure('symbol entropy')
+    bi_gram_entropy = EntropyMeasure('bigram entropy', n_gram=2)
+    len_measure = MsgLength('avg msg length', stop_symbol=config['n_symbols'] - 1)
+    distinct_symbol_measure = DistinctSymbolMeasure('Number of distinct symbols')
 
-reset_trainer = ResetDatasetCallback(train_dataloader.dataset)
+    measure_callbacks = MeasureCallbacks(test_dataloader,
+                                         measures=[symbol_entropy, bi_gram_entropy, len_measure, distinct_symbol_measure])
 
-trainer = pl.Trainer(default_root_dir='../logs',
-                     checkpoint_callback=False,
-                     # checkpoint_callback=ModelCheckpoint(save_weights_only=True, mode="min", monitor="val_loss"),
-                     gpus=1 if torch.cuda.is_available() else 0,
-                     max_epochs=max_epochs,
-                     log_every_n_steps=1,
-                     callbacks=[msg_callback, freq_callback, measure_callbacks, reset_trainer],
-                     progress_bar_refresh_rate=1,
-                     )
-trainer.logger._default_hp_metric = None  # Optional logging argument that we don't need
+    reset_trainer = ResetDatasetCallback(train_dataloader.dataset)
 
-### Save in the list the experiment number and the experiment
+    callbacks = [DistributedDatasetCallback([train_dataloader.dataset, test_dataloader.dataset]),
+                 msg_callback, freq_callback, measure_callbacks, reset_trainer]
+    if config.get("profile", False):
+        callbacks.append(ProfilerCallback(trace_steps=config.get("profile_trace_steps", [])))
 
+    ### The metrics and message texts are written to disk by a background thread
+    logger = get_logger('../logs', async_logger=config.get("async_logger", True),
+                        max_queue=config.get("logger_queue_size", 10000),
+                        flush_secs=config.get("logger_flush_secs", 5.0),
+                        block_timeout=config.get("logger_block_timeout", 0.1))
 
-trainer.fit(signalling_game_model, train_dataloader)
+    trainer = pl.Trainer(default_root_dir='../logs',
+                         logger=logger,
+                         checkpoint_callback=False,
+                         # checkpoint_callback=ModelCheckpoint(save_weights_only=True, mode="min", monitor="val_loss"),
+                         max_epochs=max_epochs,
+                         log_every_n_steps=1,
+                         callbacks=callbacks,
+                         **get_distributed_trainer_kwargs(config.get("num_processes", 1)),
+                         progress_bar_refresh_rate=1,
+                         )
+    trainer.logger._default_hp_metric = None  # Optional logging argument that we don't need
+
+    ### Save in the list the experiment number and the experiment
+
+
+    trainer.fit(signalling_game_model, train_dataloader)
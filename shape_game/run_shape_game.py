@@ -1,6 +1,7 @@
 import torch
 import pytorch_lightning as pl
 
+from callbacks.async_logger import get_logger
 from callbacks.msg_callback import MsgCallback, MsgFrequencyCallback, EntropyMeasure, MeasureCallbacks, \
     ResetDatasetCallback
 from shape_game.models import SignallingGameModel
@@ -53,6 +54,7 @@ reset_trainer = ResetDatasetCallback(train_dataloader.dataset)
 
 
 trainer = pl.Trainer(default_root_dir='../logs',
+                     logger=get_logger('../logs'),
                      checkpoint_callback=False,
                      # checkpoint_callback=ModelCheckpoint(save_weights_only=True, mode="min", monitor="val_loss"),
                      gpus=1 if torch.cuda.is_available() else 0,
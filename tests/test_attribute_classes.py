@@ -0,0 +1,55 @@
+import time
+from itertools import product
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from datasets.AttributeDataset import AttributeGameDataset, AttributeInBatchDataset, classes_to_one_hot, \
+    decode_classes, encode_classes, get_held_out_classes
+
+
+def test_class_ids_follow_the_order_of_product():
+    attributes = np.array(list(product(range(4), repeat=3)))
+    ids = np.arange(len(attributes))
+    assert np.array_equal(decode_classes(ids, 3, 4), attributes)
+    assert np.array_equal(encode_classes(attributes, 3, 4), ids)
+
+
+def test_one_hots_of_class_ids():
+    one_hot = classes_to_one_hot([0, 7, 63], 3, 4)
+    expected = torch.zeros(3, 12)
+    for row, attributes in enumerate([(0, 0, 0), (0, 1, 3), (3, 3, 3)]):
+        for attribute, value in enumerate(attributes):
+            expected[row, attribute * 4 + value] = 1
+    assert torch.equal(one_hot, expected)
+
+
+def test_held_out_classes_split_the_classes():
+    ### The held out classes have the same value i for every attribute, for i below n_remove_classes
+    assert np.array_equal(decode_classes(get_held_out_classes(3, 4, 2), 3, 4), [[0, 0, 0], [1, 1, 1]])
+
+    train = AttributeGameDataset(3, 4, n_remove_classes=2, train=True)
+    test = AttributeGameDataset(3, 4, n_remove_classes=2, train=False)
+    assert train.n_keep_classes == 62 and test.n_keep_classes == 2
+    assert not set(train.keep_classes()) & set(test.keep_classes())
+    assert set(train.keep_classes()) | set(test.keep_classes()) == set(range(64))
+
+
+def test_large_attribute_spaces_are_not_enumerated():
+    ### 10 ** 8 classes
+    start = time.monotonic()
+    dataset = AttributeGameDataset(8, 10, n_remove_classes=3, train=True)
+    target, candidates, target_index = dataset[0]
+    assert time.monotonic() - start < 1
+    assert target.shape == (80,) and len(candidates) == dataset.n_receiver
+    assert dataset.is_kept(encode_classes([[int(value) for value in target.view(8, 10).argmax(dim=-1)]], 8, 10)).all()
+
+
+def test_hard_negatives_differ_in_one_attribute():
+    dataset = AttributeInBatchDataset(5, 6, batch_size=16, hard_negative_fraction=0.5)
+    classes = np.arange(0, 6 ** 5, 97)
+    neighbours = dataset.neighbours(classes, np.random.default_rng(0))
+    differences = decode_classes(classes, 5, 6) != decode_classes(neighbours, 5, 6)
+    assert (differences.sum(axis=1) == 1).all()
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+import yaml
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+
+from callbacks.checkpoint_callback import AsyncCheckpointCallback, latest_checkpoint
+from experiment_utils import get_checkpoint_dir
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_runtime_settings_keep_the_checkpoint_dir():
+    with open(os.path.join(ROOT, "config", "example_experiment.yaml")) as f:
+        config = yaml.safe_load(f)
+    changed = dict(config, num_workers=4, async_logger=not config.get("async_logger", True), checkpoint_keep_last_k=5)
+    assert get_checkpoint_dir(changed, 0) == get_checkpoint_dir(config, 0)
+    assert get_checkpoint_dir(dict(config, learning_rate=1.0), 0) != get_checkpoint_dir(config, 0)
+
+
+def test_keep_last_k_should_keep_a_checkpoint(tmp_path):
+    with pytest.raises(ValueError):
+        AsyncCheckpointCallback(str(tmp_path), keep_last_k=0)
+
+
+def test_rotate_keeps_the_latest(tmp_path):
+    callback = AsyncCheckpointCallback(str(tmp_path), keep_last_k=1)
+    for epoch in range(3):
+        torch.save({}, os.path.join(str(tmp_path), 'checkpoint_epoch_{:04d}.ckpt'.format(epoch)))
+    callback.rotate()
+    assert os.listdir(str(tmp_path)) == ['checkpoint_epoch_0002.ckpt']
+    assert latest_checkpoint(str(tmp_path)).endswith('checkpoint_epoch_0002.ckpt')
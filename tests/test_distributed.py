@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+
+import torch.multiprocessing as mp
+
+from attribute_game.models import FeatureEncoder
+from attribute_game.sender import SenderFixed
+from callbacks.distributed_callback import DistributedDatasetCallback, all_gather_cat
+from callbacks.msg_callback import EntropyMeasure
+from datasets.AttributeDataset import AttributeGameDataset
+
+WORLD_SIZE = 2
+
+
+def make_dataset():
+    np.random.seed(0)
+    return AttributeGameDataset(3, 4, n_receiver=3, samples_per_epoch=64, n_remove_classes=2)
+
+
+def make_sender():
+    torch.manual_seed(0)
+    return SenderFixed(FeatureEncoder(3, 4, hidden_state_size=16), msg_len=4, n_symbols=5, decode_mode='argmax')
+
+
+def episodes(dataset):
+    ### The target and the index of the target of every episode, by its index in the whole epoch
+    return {dataset.global_index(i): (tuple(dataset[i][0].tolist()), dataset[i][2]) for i in range(len(dataset))}
+
+
+def messages(sender, dataset):
+    targets = torch.stack([dataset[i][0] for i in range(len(dataset))])
+    with torch.no_grad():
+        return torch.argmax(sender(targets), dim=-1).permute(1, 0)
+
+
+def run_rank(rank, dataset, sender, init_file, out_dir):
+    torch.distributed.init_process_group("gloo", init_method="file://" + init_file, rank=rank,
+                                         world_size=WORLD_SIZE)
+    ### Like a spawned trainer, which got the dataset of the parent
+    DistributedDatasetCallback([dataset]).on_train_start(None, None)
+
+    msgs = all_gather_cat(messages(sender, dataset))
+    torch.save({"episodes": episodes(dataset), "entropy": EntropyMeasure("entropy").make_measure(msgs)},
+               os.path.join(out_dir, "rank_{}.pt".format(rank)))
+    torch.distributed.destroy_process_group()
+
+
+def test_ranks_generate_disjoint_episodes(tmp_path):
+    dataset, sender = make_dataset(), make_sender()
+    mp.spawn(run_rank, args=(dataset, sender, str(tmp_path / "init"), str(tmp_path)), nprocs=WORLD_SIZE)
+    results = [torch.load(str(tmp_path / "rank_{}.pt".format(rank))) for rank in range(WORLD_SIZE)]
+
+    single = make_dataset()
+    expected = episodes(single)
+    rank_episodes = [result["episodes"] for result in results]
+    assert not set(rank_episodes[0]) & set(rank_episodes[1])
+    assert {**rank_episodes[0], **rank_episodes[1]} == expected
+
+    expected_entropy = EntropyMeasure("entropy").make_measure(messages(sender, single))
+    for result in results:
+        assert result["entropy"] == pytest.approx(expected_entropy)
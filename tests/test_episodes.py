@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from datasets.AttributeDataset import AttributeGameDataset, AttributeInBatchDataset
+
+
+def make_dataset(seed=0, cls=AttributeGameDataset, **kwargs):
+    ### The key of the generators is drawn from the global random state, as pl.seed_everything sets it
+    np.random.seed(seed)
+    return cls(3, 4, samples_per_epoch=64, n_remove_classes=2, **kwargs)
+
+
+def episode(dataset, idx):
+    sender_item, receiver_items, target = dataset[idx]
+    return sender_item.tolist(), [item.tolist() for item in receiver_items], int(target)
+
+
+def epoch_episodes(dataset, order=None):
+    order = range(len(dataset)) if order is None else order
+    return {idx: episode(dataset, idx) for idx in order}
+
+
+@pytest.mark.parametrize("epoch", [0, 3])
+def test_same_seed_and_epoch_give_the_same_episodes(epoch):
+    first, second = make_dataset(), make_dataset()
+    first.set_epoch(epoch)
+    second.set_epoch(epoch)
+    ### The second dataset generates its episodes in the reverse order
+    assert epoch_episodes(first) == epoch_episodes(second, reversed(range(len(second))))
+
+
+def test_an_episode_can_be_regenerated_on_its_own():
+    dataset = make_dataset()
+    dataset.set_epoch(2)
+    expected = epoch_episodes(dataset)
+
+    fresh = make_dataset()
+    fresh.set_epoch(2)
+    assert episode(fresh, 17) == expected[17]
+
+
+def test_epochs_and_seeds_give_new_episodes():
+    dataset = make_dataset()
+    first_epoch = epoch_episodes(dataset)
+    dataset.reset()
+    assert epoch_episodes(dataset) != first_epoch
+    assert epoch_episodes(make_dataset(seed=1)) != first_epoch
+
+
+def test_in_batch_episodes_are_reproducible():
+    first = make_dataset(cls=AttributeInBatchDataset, batch_size=8)
+    second = make_dataset(cls=AttributeInBatchDataset, batch_size=8)
+    targets = [first[idx][2] for idx in range(len(first))]
+    assert [second[idx][2] for idx in reversed(range(len(second)))] == targets[::-1]
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("torch", "pytorch_lightning", "torchvision", "matplotlib")
+### Generous, importing torch alone takes longer on most machines
+MAX_SECONDS = 10
+
+### Runs a script like `python script args` and prints the heavy modules it imported
+PROGRAM = '''
+import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+print("HEAVY", [name for name in {} if name in sys.modules])
+'''.format(HEAVY_MODULES)
+
+
+@pytest.mark.parametrize("script, args", [
+    ("do_experiment.py", ["--summarize", "--config", "config/experiment_with_predictor_3_4.yml"]),
+    ("do_grid_search.py", ["--summarize", "--config", "config/gridsearch_config_example.yaml"]),
+    ("analyse_experiments.py", ["--no_plot"]),
+])
+def test_summaries_do_not_import_heavy_modules(tmp_path, script, args):
+    store = str(tmp_path / "results.sqlite")
+    start = time.monotonic()
+    completed = subprocess.run([sys.executable, "-c", PROGRAM, script, "--store", store] + args, cwd=ROOT,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.monotonic() - start
+
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.splitlines()[-1] == "HEAVY []"
+    assert elapsed < MAX_SECONDS
@@ -0,0 +1,127 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+
+from torch import nn
+from torch.nn.utils.rnn import pack_padded_sequence
+
+from attribute_game.models import FeatureEncoder, PredictionRNN
+from attribute_game.pl_model import AttributeModelMerged, AttributeModelWithPrediction
+from attribute_game.receiver import ReceiverPredictor
+
+N_ATTRIBUTES, SIZE_ATTRIBUTES, N_SYMBOLS, MSG_LEN, N_RECEIVER, HIDDEN = 2, 3, 5, 5, 3, 8
+
+### Stopped early, never stopped, stopped at once and stopped at the last position
+SYMBOLS = [[2, 3, 0, 1, 4],
+           [1, 1, 1, 1, 1],
+           [0, 2, 2, 2, 2],
+           [3, 2, 4, 1, 0]]
+
+
+class FixedSender(nn.Module):
+    '''
+    Sends the messages of SYMBOLS, whatever the input
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.n_symbols = N_SYMBOLS
+        self.msg_len = MSG_LEN
+
+    def forward(self, x):
+        indices = torch.tensor(SYMBOLS).t()
+        return nn.functional.one_hot(indices, N_SYMBOLS).float()
+
+
+class UnusedReceiver(nn.Module):
+    '''
+    Stands in for the receiver of AttributeModelWithPrediction, of which only the predictions are compared
+    '''
+
+    def forward(self, xs, msg):
+        return None, None
+
+
+class RecordingReceiver(nn.Module):
+    '''
+    A ReceiverPredictor that keeps the message encoding it was given
+    '''
+
+    def __init__(self, receiver):
+        super().__init__()
+        self.receiver = receiver
+        self.encoding = None
+
+    def forward(self, xs, hidden):
+        self.encoding = hidden
+        return self.receiver(xs, hidden)
+
+
+def make_models(pack_message):
+    torch.manual_seed(0)
+    sender = FixedSender()
+    predictor = PredictionRNN(N_SYMBOLS, HIDDEN)
+    receiver = RecordingReceiver(ReceiverPredictor(FeatureEncoder(N_ATTRIBUTES, SIZE_ATTRIBUTES,
+                                                                  hidden_state_size=HIDDEN),
+                                                   N_RECEIVER, n_symbols=N_SYMBOLS, msg_len=MSG_LEN))
+    merged = AttributeModelMerged(sender, receiver, None, predictor, None, pack_message=pack_message)
+    separate = AttributeModelWithPrediction(sender, UnusedReceiver(), None, predictor, None, pack_message=pack_message)
+    return merged, separate
+
+
+def inputs():
+    torch.manual_seed(1)
+    sender_img = torch.rand(len(SYMBOLS), N_ATTRIBUTES * SIZE_ATTRIBUTES)
+    receiver_choices = [torch.rand(len(SYMBOLS), N_ATTRIBUTES * SIZE_ATTRIBUTES) for _ in range(N_RECEIVER)]
+    return sender_img, receiver_choices
+
+
+def final_states(predictor, lengths):
+    '''
+    The final hidden state of a separate nn.LSTM, with the weights of the predictor, run on the packed start symbol
+    and first lengths symbols of every message
+    '''
+    lstm = nn.LSTM(HIDDEN, HIDDEN)
+    lstm.load_state_dict(predictor.rnn.state_dict())
+    one_hot = FixedSender()(None)
+    msgs = torch.cat([torch.zeros(1, len(SYMBOLS), N_SYMBOLS), one_hot], dim=0)
+    embedded = nn.functional.linear(msgs, predictor.embedding.weight, predictor.embedding.bias)
+    _, (hidden, _) = lstm(pack_padded_sequence(embedded, lengths + 1, enforce_sorted=False))
+    return hidden[0]
+
+
+@pytest.mark.parametrize("pack_message", [True, False])
+@torch.no_grad()
+def test_receiver_gets_final_lstm_state(pack_message):
+    merged, _ = make_models(pack_message)
+    sender_img, receiver_choices = inputs()
+
+    msg, packed_msg, out, out_probs, prediction_logits, prediction_probs = merged.forward(sender_img, receiver_choices)
+    ### Three of the messages are shorter than MSG_LEN, without packing every message is read up to MSG_LEN
+    assert torch.equal(msg.lengths, torch.tensor([3, 5, 1, 5]))
+    lengths = msg.lengths if pack_message else torch.full((len(SYMBOLS),), MSG_LEN, dtype=torch.long)
+
+    expected = final_states(merged.predictor, lengths)
+    assert torch.allclose(merged.receiver.encoding, expected, atol=1e-6)
+    ### The encodings of the messages that stop early differ from the state after the whole message
+    if pack_message:
+        whole = final_states(merged.predictor, torch.full((len(SYMBOLS),), MSG_LEN, dtype=torch.long))
+        assert not torch.allclose(merged.receiver.encoding[[0, 2]], whole[[0, 2]], atol=1e-4)
+
+    expected_out, expected_probs = merged.receiver.receiver(receiver_choices, expected)
+    assert torch.allclose(out, expected_out, atol=1e-6)
+    assert torch.allclose(out_probs, expected_probs, atol=1e-6)
+
+
+@pytest.mark.parametrize("pack_message", [True, False])
+@torch.no_grad()
+def test_predictions_match_separate_model(pack_message):
+    merged, separate = make_models(pack_message)
+    sender_img, receiver_choices = inputs()
+
+    merged_outputs = merged.forward(sender_img, receiver_choices)
+    separate_outputs = separate.forward(sender_img, receiver_choices)
+    ### The prediction logits and probabilities
+    for merged_output, separate_output in zip(merged_outputs[4:], separate_outputs[4:]):
+        assert torch.allclose(merged_output, separate_output, atol=1e-6)
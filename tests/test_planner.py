@@ -0,0 +1,57 @@
+import glob
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+
+from experiment_planner import load_configs, plan, results_config
+from results_store import ResultsStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+### The configs of the attribute game, example_config.yml is the mnist game
+CONFIGS = [os.path.join(ROOT, "config", "example_experiment.yaml"), os.path.join(ROOT, "config", "example_ddp_cpu.yml")] + \
+    sorted(glob.glob(os.path.join(ROOT, "config", "experiment_*.yml"))) + \
+    sorted(glob.glob(os.path.join(ROOT, "config", "gridsearch_config_*.yaml")))
+
+
+@pytest.mark.parametrize("path", CONFIGS, ids=os.path.basename)
+def test_plan_example_configs(path):
+    configs = load_configs([path])
+    stages, evaluations = plan(configs)
+
+    assert len(evaluations) == sum(config["n_runs"] for config in configs)
+    ### Every stage comes after the stages it depends on
+    order = list(stages)
+    for position, stage in enumerate(stages.values()):
+        assert all(order.index(dependency.key) < position for dependency in stage.dependencies.values())
+
+
+def test_configs_with_single_values_are_not_expanded():
+    configs = load_configs([os.path.join(ROOT, "config", "experiment_with_predictor_3_4.yml")])
+    assert len(configs) == 1 and configs[0]["learning_rate"] == 0.001
+
+
+def test_batch_size_grid_shares_the_datasets():
+    configs = load_configs([os.path.join(ROOT, "config", "gridsearch_config_small_no_pred.yaml")])
+    stages, _ = plan(configs)
+    kinds = [stage.kind for stage in stages.values()]
+    ### Without in batch negatives the configs of the grid share one dataset per seed
+    assert kinds.count("build_dataset") == configs[0]["n_runs"]
+    assert kinds.count("train") == len(configs) * configs[0]["n_runs"]
+
+    in_batch = [dict(config, in_batch_negatives=True) for config in configs]
+    stages, _ = plan(in_batch)
+    batch_sizes = {config["batch_size"] for config in in_batch}
+    assert [stage.kind for stage in stages.values()].count("build_dataset") == len(batch_sizes) * configs[0]["n_runs"]
+
+
+def test_finished_runs_are_left_out(tmp_path):
+    configs = load_configs([os.path.join(ROOT, "config", "gridsearch_config_example.yaml")])
+    store = ResultsStore(str(tmp_path / "results.sqlite"))
+    ### A run of do_grid_search is not a run of the planner
+    store.add_results(configs[0], 0, {configs[0]["metric"]: 0.5})
+    assert len(plan(configs, store)[1]) == configs[0]["n_runs"]
+    store.add_results(results_config(configs[0]), 0, {configs[0]["metric"]: 0.5})
+    assert len(plan(configs, store)[1]) == configs[0]["n_runs"] - 1
@@ -0,0 +1,62 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+
+from torch import nn
+
+from datasets.AttributeDataset import get_attribute_loaders
+from experiment_utils import get_game, get_datasets
+from quantize import quantize_game, parity_report, run_inference, load_quantized
+
+REPORT_KEYS = {"fp32_accuracy", "int8_accuracy", "fp32_samples_per_second", "int8_samples_per_second", "fp32_bytes",
+               "int8_bytes", "message_agreement", "symbol_agreement", "prediction_agreement"}
+
+
+def small_config(fixed_size, with_predictor):
+    return {"n_attributes": 3, "attributes_size": 4, "n_symbols": 6, "msg_len": 4, "n_receiver": 3,
+            "pretrain_n_epochs": 0, "fixed_size": fixed_size, "with_predictor": with_predictor,
+            "hidden_size_predictor": 32, "samples_per_epoch_train": 64, "samples_per_epoch_test": 256,
+            "n_remove_classes": 0}
+
+
+def small_game(config):
+    torch.manual_seed(0)
+    game = get_game(config, pretrain=False)
+    _, test_dataloader = get_attribute_loaders(*get_datasets(config), batch_size=64)
+    return game, test_dataloader
+
+
+@pytest.mark.parametrize("fixed_size, with_predictor", [(True, False), (False, True)])
+def test_int8_game_matches_fp32(fixed_size, with_predictor):
+    game, test_dataloader = small_game(small_config(fixed_size, with_predictor))
+    quantized = quantize_game(game)
+
+    ### The Linear and LSTM layers are all replaced by their dynamically quantized versions
+    assert not [module for module in quantized.modules() if type(module) in (nn.Linear, nn.LSTM)]
+
+    report = parity_report(game, quantized, test_dataloader)
+    assert set(report) == REPORT_KEYS
+    assert report["int8_bytes"] < report["fp32_bytes"]
+    assert report["symbol_agreement"] >= 0.8
+    assert report["prediction_agreement"] >= 0.8
+    assert abs(report["int8_accuracy"] - report["fp32_accuracy"]) <= 0.1
+
+
+def test_report_of_the_same_game_agrees():
+    game, test_dataloader = small_game(small_config(True, False))
+    report = parity_report(game, game, test_dataloader)
+    assert report["fp32_accuracy"] == report["int8_accuracy"]
+    assert report["message_agreement"] == report["symbol_agreement"] == report["prediction_agreement"] == 1.0
+
+
+def test_saved_int8_game_loads(tmp_path):
+    config = small_config(False, True)
+    game, test_dataloader = small_game(config)
+    quantized = quantize_game(game)
+    path = str(tmp_path / "game_int8.pt")
+    torch.save(quantized.state_dict(), path)
+
+    expected = run_inference(quantized, test_dataloader)
+    for output, expected_output in zip(run_inference(load_quantized(config, path), test_dataloader), expected):
+        assert torch.equal(output, expected_output)
@@ -0,0 +1,31 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+
+from callbacks.results_callback import ResultsStoreCallback
+from experiment_config import construct_configs
+from results_store import ResultsStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_grid_config_stores_its_metric_every_epoch(tmp_path):
+    with open(os.path.join(ROOT, "config", "gridsearch_config_example.yaml")) as f:
+        config = construct_configs(yaml.safe_load(f))[0]
+    path = str(tmp_path / "results.sqlite")
+    callback = ResultsStoreCallback(path, config, 0)
+
+    for epoch in range(config["max_epochs"]):
+        trainer = SimpleNamespace(global_rank=0, running_sanity_check=False, current_epoch=epoch,
+                                  callback_metrics={"val_accuracy_epoch": torch.tensor(epoch / 10), "loss": 1.0})
+        callback.on_epoch_end(trainer, None)
+
+    store = ResultsStore(path)
+    assert store.seeds(config) == [0]
+    assert store.results(config, 0) == {"val_accuracy_epoch": pytest.approx((config["max_epochs"] - 1) / 10)}
+    assert len(store.history(config, 0, "val_accuracy_epoch")) == config["max_epochs"]
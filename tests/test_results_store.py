@@ -0,0 +1,64 @@
+import glob
+import math
+import os
+
+import pytest
+import yaml
+
+from experiment_config import construct_configs
+from results_store import ResultsStore, config_hash, config_metrics, RUNTIME_CONFIG_KEYS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_config(path):
+    with open(os.path.join(ROOT, path)) as f:
+        return yaml.safe_load(f)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultsStore(str(tmp_path / "results.sqlite"))
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize("path", sorted(glob.glob(os.path.join(ROOT, "config", "gridsearch_config_*.yaml"))))
+def test_grid_configs_store_their_metric(path):
+    for config in construct_configs(load_config(path)):
+        expected = set(config.get("metrics", [])) | ({config["metric"]} if "metric" in config else set())
+        assert set(config_metrics(config)) == expected
+
+
+def test_metrics_are_stored_once():
+    assert config_metrics({"metrics": ["a", "b"], "metric": "b"}) == ["a", "b"]
+    assert config_metrics({"metrics": ["a"]}) == ["a"]
+
+
+def test_runtime_settings_keep_the_hash():
+    config = load_config("config/example_experiment.yaml")
+    changed = dict(config, **{key: "changed" for key in RUNTIME_CONFIG_KEYS})
+    assert config_hash(changed) == config_hash(config)
+    assert config_hash(dict(config, learning_rate=1.0)) != config_hash(config)
+
+
+def test_only_finished_runs_are_summarized(store):
+    config = {"max_epochs": 3, "metrics": ["accuracy"]}
+    for epoch in range(3):
+        store.add_results(config, 0, {"accuracy": epoch / 10}, epoch=epoch)
+    store.add_results(config, 1, {"accuracy": 0.5}, epoch=0)
+
+    assert store.seeds(config) == [0]
+    assert store.history(config, 0, "accuracy") == [(0, 0.0), (1, 0.1), (2, 0.2)]
+    assert store.summary(config) == {"accuracy": (pytest.approx(0.2), 0.0)}
+
+
+def test_std_of_close_values_is_not_nan(store):
+    config = {"max_epochs": 1, "metrics": ["accuracy"]}
+    values = [0.1 + 1e-17 * i for i in range(5)] + [0.1] * 5
+    for seed, value in enumerate(values):
+        store.add_results(config, seed, {"accuracy": value})
+
+    mean, std = store.summary(config)["accuracy"]
+    assert mean == pytest.approx(0.1)
+    assert not math.isnan(std) and std >= 0
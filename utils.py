@@ -1,18 +1,27 @@
 import torch
 from torch import nn
 from torch.utils.data import DataLoader, Subset
-from torchvision.datasets import MNIST
-from torchvision.transforms import transforms
 
+from datasets.loading import get_loader_kwargs
 from datasets.shapeDataset import ShapeDataset, ShapeGameDataset
 from datasets.signalling_game import SignallingGameDataset
 from shape_game.models.PredictorModel import PredictionRNN
-from shape_game.models.ReceiverModels import ReceiverModuleFixedLength
+from shape_game.models.ReceiverModels import ReceiverModuleFixedLength, ReceiverModuleDotProduct
 from shape_game.models.SenderModels import SenderModelFixedLength, SenderRnn
-from shape_game.models.VisualModels import VisualModel, HiddenStateModel
+from shape_game.models.VisualModels import VisualModel, HiddenStateModel, ChannelsLastEncoder
 from shape_game.models.models import ReceiverCombined
 
 
+def to_tensor_transform():
+    '''
+    The transform of the image datasets. torchvision is imported here instead of at the top of the file, so the
+    attribute game and the analysis scripts do not pay for importing it.
+    '''
+    from torchvision.transforms import transforms
+
+    return transforms.Compose([transforms.ToTensor()])
+
+
 def train_hidden_state_model(hidden_state_model, device, train_dataloader, n_epochs):
     '''
     Function to pretrain the hidden state model. 
@@ -55,11 +64,13 @@ def train_hidden_state_model(hidden_state_model, device, train_dataloader, n_epo
         print(train_accuracy / batch_count)
 
 
-def get_mnist_signalling_game(batch_size=32, size=None):
+def get_mnist_signalling_game(batch_size=32, size=None, num_workers=0, persistent_workers=False, prefetch_factor=2,
+                              pin_memory=False):
     '''
     Get a dataloader for the signalling Game
     '''
-    transform = transforms.Compose([transforms.ToTensor()])
+    loader_kwargs = get_loader_kwargs(num_workers, persistent_workers, prefetch_factor, pin_memory)
+    transform = to_tensor_transform()
     signalling_game_train = SignallingGameDataset(transform=transform)
     signalling_game_test = SignallingGameDataset(train=False, transform=transform)
 
@@ -67,15 +78,18 @@ def get_mnist_signalling_game(batch_size=32, size=None):
         indices = [i for i in range(size)]
         signalling_game_train = Subset(signalling_game_train, indices)
         signalling_game_test = Subset(signalling_game_test, indices)
-    train_dataloader = DataLoader(signalling_game_train, shuffle=True, batch_size=batch_size, )
-    test_dataloader = DataLoader(signalling_game_test, shuffle=False, batch_size=batch_size, )
+    train_dataloader = DataLoader(signalling_game_train, shuffle=True, batch_size=batch_size, **loader_kwargs)
+    test_dataloader = DataLoader(signalling_game_test, shuffle=False, batch_size=batch_size, **loader_kwargs)
 
     return train_dataloader, test_dataloader
 
 
-def get_sender(n_symbols, msg_len, device, fixed_size=True, pretrain=None, pretrain_n_epochs=3):
+def get_visual_model(device, pretrain=None, pretrain_n_epochs=3, channels_last=False):
     '''
-    Get the sender model
+    Get the visual model of a sender or receiver
+    :param pretrain: 'MNIST' or 'shapes' to pretrain the model on that dataset
+    :param channels_last: run the model in the channels last format, see ChannelsLastEncoder
+    :return: the visual model, or None for the default HiddenStateModel of the agent
     '''
     hidden_state_model = None
     if pretrain:
@@ -83,17 +97,36 @@ def get_sender(n_symbols, msg_len, device, fixed_size=True, pretrain=None, pretr
             hidden_state_model = get_mnist_pretrain(device)
         if pretrain == 'shapes':
             hidden_state_model = get_shapes_pretrain(device, n_epochs=pretrain_n_epochs)
+    if channels_last:
+        if hidden_state_model is None:
+            hidden_state_model = HiddenStateModel(10)
+        hidden_state_model = ChannelsLastEncoder(hidden_state_model).to(device)
+    return hidden_state_model
+
+
+def get_sender(n_symbols, msg_len, device, fixed_size=True, pretrain=None, pretrain_n_epochs=3, decode_mode='gumbel',
+               top_k=2, fused_visual=False, hidden_state_model=None):
+    '''
+    Get the sender model
+    :param decode_mode: how the sender chooses its symbols during training, see decoding.decode_symbols
+    :param fused_visual: run the visual model in the channels last format, see ChannelsLastEncoder
+    :param hidden_state_model: the visual model to use, for example one that is shared with the receiver
+    '''
+    if hidden_state_model is None:
+        hidden_state_model = get_visual_model(device, pretrain, pretrain_n_epochs, channels_last=fused_visual)
 
     if fixed_size:
         sender = SenderModelFixedLength(10, n_symbols=n_symbols, msg_len=msg_len,
-                                        hidden_state_model=hidden_state_model).to(device)
+                                        hidden_state_model=hidden_state_model, decode_mode=decode_mode,
+                                        top_k=top_k).to(device)
     else:
-        sender = SenderRnn(10, n_symbols=n_symbols, msg_len=msg_len, hidden_state_model=hidden_state_model).to(device)
+        sender = SenderRnn(10, n_symbols=n_symbols, msg_len=msg_len, hidden_state_model=hidden_state_model,
+                           decode_mode=decode_mode, top_k=top_k).to(device)
     return sender
 
 
 def get_shapes_pretrain(device, n_epochs=3, samples_per_epoch=int(10e3)):
-    transform = transforms.Compose([transforms.ToTensor()])
+    transform = to_tensor_transform()
     data = ShapeDataset(samples_per_epoch=samples_per_epoch, transform=transform)
     train_dataloader = DataLoader(data, shuffle=True, batch_size=32, )
 
@@ -103,19 +136,23 @@ def get_shapes_pretrain(device, n_epochs=3, samples_per_epoch=int(10e3)):
     return hidden_state_model
 
 
-def get_receiver(n_symbols, msg_len, device, pretrain=True, pretrain_n_epochs=3):
+def get_receiver(n_symbols, msg_len, device, pretrain=True, pretrain_n_epochs=3, receiver_type="concat",
+                 fused_visual=False, hidden_state_model=None):
     '''
     Get the receiver model
+    :param receiver_type: "concat" or "dot_product", see ReceiverModuleDotProduct
+    :param fused_visual: run all the candidates through the visual model as one channels last batch
+    :param hidden_state_model: the visual model to use, for example one that is shared with the sender
     '''
-    hidden_state_model = None
-    if pretrain:
-        if pretrain == 'MNIST':
-            hidden_state_model = get_mnist_pretrain(device)
-        if pretrain == 'shapes':
-            hidden_state_model = get_shapes_pretrain(device, n_epochs=pretrain_n_epochs)
+    if hidden_state_model is None:
+        hidden_state_model = get_visual_model(device, pretrain, pretrain_n_epochs, channels_last=fused_visual)
+
+    if receiver_type == "dot_product":
+        return ReceiverModuleDotProduct(10, n_symbols=n_symbols, msg_len=msg_len,
+                                        hidden_state_model=hidden_state_model).to(device)
 
     receiver = ReceiverModuleFixedLength(10, n_symbols=n_symbols, msg_len=msg_len,
-                                         hidden_state_model=hidden_state_model).to(device)
+                                         hidden_state_model=hidden_state_model, fused=fused_visual).to(device)
     return receiver
 
 
@@ -127,12 +164,7 @@ def get_predictor(n_symbols, hidden_size, device):
     return predictor
 
 def get_receiver_predictor_combined(n_symbols, n_xs, device, pretrain=True, pretrain_n_epochs=3, hidden_size=128):
-    hidden_state_model = None
-    if pretrain:
-        if pretrain == 'MNIST':
-            hidden_state_model = get_mnist_pretrain(device)
-        if pretrain == 'shapes':
-            hidden_state_model = get_shapes_pretrain(device, n_epochs=pretrain_n_epochs)
+    hidden_state_model = get_visual_model(device, pretrain, pretrain_n_epochs)
 
     predictor = PredictionRNN(n_symbols, hidden_size).to(device)
 
@@ -140,7 +172,9 @@ def get_receiver_predictor_combined(n_symbols, n_xs, device, pretrain=True, pret
     return combined_model
 
 def get_mnist_pretrain(device, n_epochs=2, root='./data/'):
-    transform = transforms.Compose([transforms.ToTensor()])
+    from torchvision.datasets import MNIST
+
+    transform = to_tensor_transform()
     data = MNIST(root=root, download=True, train=True, transform=transform)
     train_dataloader = DataLoader(data, shuffle=True, batch_size=32, )
 
@@ -170,24 +204,28 @@ def cross_entropy_loss_2(predictions, targets, ignore_index=None):
     '''
     Custom version of the cross entropy loss. This one is used to make sure that the gradients are
     properly calculated. If we use the standard one, there is not way to
+    The targets are either one hot or already symbol indices (a long tensor).
     '''
 
-
-    targets = torch.argmax(targets, dim=-1)
+    if targets.is_floating_point():
+        targets = torch.argmax(targets, dim=-1)
 
     loss = torch.nn.functional.cross_entropy(predictions, targets, ignore_index=ignore_index)
     return loss
 
 
-def get_shape_signalling_game(samples_per_epoch_train=int(10e4), samples_per_epoch_test=int(10e3), batch_size=32):
+def get_shape_signalling_game(samples_per_epoch_train=int(10e4), samples_per_epoch_test=int(10e3), batch_size=32,
+                              num_workers=0, persistent_workers=False, prefetch_factor=2, pin_memory=False):
     '''
     Get a dataloader for the signalling Game
+    The images are drawn in __getitem__, so with num_workers > 0 this happens in the dataloader workers.
     '''
-    transform = transforms.Compose([transforms.ToTensor()])
+    loader_kwargs = get_loader_kwargs(num_workers, persistent_workers, prefetch_factor, pin_memory)
+    transform = to_tensor_transform()
     signalling_game_train = ShapeGameDataset(transform=transform, samples_per_epoch=samples_per_epoch_train)
     signalling_game_test = ShapeGameDataset(transform=transform, samples_per_epoch=samples_per_epoch_test)
 
-    train_dataloader = DataLoader(signalling_game_train, shuffle=True, batch_size=batch_size, )
-    test_dataloader = DataLoader(signalling_game_test, shuffle=False, batch_size=batch_size, )
+    train_dataloader = DataLoader(signalling_game_train, shuffle=True, batch_size=batch_size, **loader_kwargs)
+    test_dataloader = DataLoader(signalling_game_test, shuffle=False, batch_size=batch_size, **loader_kwargs)
 
     return train_dataloader, test_dataloader